@@ -6,187 +6,872 @@ The algorithm for least significant bit steganography
 
 """
 
+import math
+import os
+from collections import namedtuple
+
+import numpy as np
 from PIL import Image
 
+import ecc
+import payload
+import pngio
+import scatter
+from metrics import Metrics, get_logger
+
+logger = get_logger("LSB")
+
+CHANNELS = "RGBA"
+
+# The header is 4 pixels of big-endian length followed by 1 pixel of flags; in the legacy format the only flag is
+# is_string, a single 1 in the red channel of the fifth pixel. Every header byte takes one pixel in the legacy layout.
+_HEADER_PIXELS = 5
+_STRING_FLAG = 0b01000000
+_EXTENDED_FLAG = 0b10000000
+
+# If the extended flag is set, the header continues with a version byte, the codec byte and a byte of feature flags,
+# which record the stages the message went through before it was embedded (see payload.py)
+FORMAT_VERSION = 1
+_EXTENDED_HEADER_SIZE = 3
+
+# Messages with error correction follow the header with a protected copy of it: the 8 header bytes, the length of the
+# message before error correction and the parity bytes per block, Reed-Solomon coded so that the header can be
+# checked and repaired. Like the header, it takes one pixel per byte.
+_PROTECTED_HEADER_SYMBOLS = 16
+_PROTECTED_HEADER_SIZE = ecc.encoded_size(_HEADER_PIXELS + _EXTENDED_HEADER_SIZE + 5, _PROTECTED_HEADER_SYMBOLS)
+
+# The most pixels a header can take, i.e. the number read_header reads
+MAX_HEADER_PIXELS = _HEADER_PIXELS + _EXTENDED_HEADER_SIZE + _PROTECTED_HEADER_SIZE
+
+# Number of image rows the streaming functions hold in memory at once
+DEFAULT_BAND_ROWS = 256
+
+
+class Codec(namedtuple("Codec", ["bits", "channels"])):
+    """
+    Describes how message bits are laid out in the pixels: the 'bits' (1-4) least significant bits of every channel
+    named in 'channels' (any subset of "RGBA"), filled most significant bit first, channel by channel in RGBA order.
+    More bits per channel means fewer pixels touched per byte and more capacity, but a noisier image.
+    """
+
+    __slots__ = ()
+
+    def __new__(cls, bits=2, channels=CHANNELS):
+        channels = str(channels).upper()
+        if bits not in (1, 2, 3, 4):
+            raise ValueError("Bits per channel must be between 1 and 4; got " + str(bits))
+        if not channels or any(channels.count(channel) != 1 for channel in channels) or \
+                not set(channels) <= set(CHANNELS):
+            raise ValueError("Channels must be a non-empty subset of 'RGBA'; got '" + channels + "'")
+        return super(Codec, cls).__new__(cls, bits, "".join(channel for channel in CHANNELS if channel in channels))
+
+    @property
+    def bits_per_pixel(self):
+        return self.bits * len(self.channels)
+
+    @property
+    def indexes(self):
+        return [CHANNELS.index(channel) for channel in self.channels]
+
+    def pixels_for(self, size):
+        """Returns the number of pixels needed to hold 'size' bytes"""
+        return -(-size * 8 // self.bits_per_pixel)
+
+    def bytes_in(self, pixels):
+        """Returns the number of whole bytes 'pixels' pixels can hold"""
+        return max(pixels, 0) * self.bits_per_pixel // 8
+
+    def to_byte(self):
+        """Packs the codec into the header's codec byte: (bits - 1) in the high nibble, an RGBA channel mask below"""
+        mask = sum(0b1000 >> CHANNELS.index(channel) for channel in self.channels)
+        return (self.bits - 1) << 4 | mask
+
+    @classmethod
+    def from_byte(cls, value):
+        channels = "".join(channel for index, channel in enumerate(CHANNELS) if value & (0b1000 >> index))
+        return cls((value >> 4) + 1, channels)
+
+
+# The original format: 2 bits in every RGBA channel, so one byte occupies exactly one pixel
+LEGACY_CODEC = Codec(2, CHANNELS)
+
+# 'length' is the number of bytes stored in the image, i.e. after compression, encryption and error correction if
+# 'features' says so; 'payload_length' is the length before error correction, which adds 'ecc_symbols' parity bytes
+# to every block
+Header = namedtuple("Header", ["length", "is_string", "capacity", "codec", "version", "data_start", "features",
+                               "payload_length", "ecc_symbols"])
+
+
+def _split_bytes(data, codec=LEGACY_CODEC):
+    """Splits a bytes-like object into an (n, len(codec.channels)) array of codec.bits-bit groups, one row per pixel"""
+    byte_values = np.frombuffer(data, dtype=np.uint8)
+    if 8 % codec.bits == 0:
+        # whole groups fit in a byte, so they can be shifted out directly
+        shifts = np.arange(8 - codec.bits, -1, -codec.bits, dtype=np.uint8)
+        groups = ((byte_values[:, None] >> shifts) & ((1 << codec.bits) - 1)).reshape(-1)
+    else:
+        bits = np.unpackbits(byte_values)
+        bits = np.pad(bits, (0, -len(bits) % codec.bits)).reshape(-1, codec.bits)
+        weights = (1 << np.arange(codec.bits - 1, -1, -1)).astype(np.uint8)
+        groups = (bits * weights).sum(axis=1, dtype=np.uint8)
+    return np.pad(groups, (0, -len(groups) % len(codec.channels))).reshape(-1, len(codec.channels))
+
+
+def _join_bytes(pixels, size, codec=LEGACY_CODEC):
+    """The inverse of _split_bytes; takes an (n, 4) array of RGBA values and reassembles the 'size' bytes they
+    contain"""
+    groups = (pixels[:, codec.indexes] & ((1 << codec.bits) - 1)).reshape(-1)
+    if 8 % codec.bits == 0:
+        per_byte = 8 // codec.bits
+        shifts = np.arange(8 - codec.bits, -1, -codec.bits, dtype=np.uint8)
+        groups = groups[:size * per_byte].reshape(-1, per_byte) << shifts
+        return np.bitwise_or.reduce(groups, axis=1).astype(np.uint8).tobytes()
+    else:
+        shifts = np.arange(codec.bits - 1, -1, -1, dtype=np.uint8)
+        bits = ((groups[:, None] >> shifts) & 1).reshape(-1)
+        return np.packbits(bits[:size * 8]).tobytes()
+
+
+def _write_values(pixels, start, values, codec=LEGACY_CODEC):
+    """Writes groups from _split_bytes into the flat (n, 4) pixel array 'pixels' starting at pixel 'start'. Only the
+    pixels and channels that hold data are touched. Returns a boolean array marking the pixels whose values changed."""
+    end = start + len(values)
+    clear_mask = 0xFF ^ ((1 << codec.bits) - 1)
+    old = pixels[start:end, codec.indexes]
+    new = (old & clear_mask) | values
+    pixels[start:end, codec.indexes] = new
+    return np.any(old != new, axis=1)
+
+
+def _build_header(msg_len, is_string, codec=LEGACY_CODEC, features=0):
+    """Returns the header bytes. Plain messages in the legacy codec get the original 5-byte header so that older
+    versions can still read them; any other codec, and any feature flags, are recorded in the extended header."""
+    flags = _STRING_FLAG if is_string else 0
+    header = msg_len.to_bytes(4, byteorder="big", signed=False)
+    if codec == LEGACY_CODEC and not features:
+        return header + bytes([flags])
+    return header + bytes([flags | _EXTENDED_FLAG, FORMAT_VERSION, codec.to_byte(), features])
+
+
+class _ChunkReader:
+    """Reads exact byte counts from either a binary file-like object or an iterator of bytes-like chunks"""
+
+    def __init__(self, source):
+        self.file = source if hasattr(source, "read") else None
+        self.chunks = None if self.file else iter(source)
+        self.pending = b""
+
+    def read(self, size):
+        parts = []
+        while size > 0:
+            if not self.pending:
+                self.pending = self.file.read(size) if self.file else next(self.chunks, b"")
+                if not self.pending:
+                    break
+            part = memoryview(self.pending)[:size]
+            parts.append(part)
+            self.pending = self.pending[len(part):]
+            size -= len(part)
+        return b"".join(parts)
+
+
+def _stream_length(source):
+    """Returns the number of bytes left in a seekable file-like object"""
+    if not hasattr(source, "seek"):
+        raise ValueError("A length must be given when the message is not a seekable file")
+    position = source.tell()
+    end = source.seek(0, os.SEEK_END)
+    source.seek(position)
+    return end - position
+
+
+def _read_pixels(image, start, count):
+    """Returns the (count, 4) RGBA values of the pixels [start, start + count) in row-major order. Only the rows that
+    contain those pixels are cropped out and converted, so the cost depends on 'count' rather than the image size."""
+    if count <= 0:
+        return np.empty((0, 4), dtype=np.uint8)
+    first_row = start // image.width
+    last_row = (start + count - 1) // image.width + 1
+    region = image.crop((0, first_row, image.width, last_row))
+    if region.mode != "RGBA":
+        region = region.convert("RGBA")
+    offset = start - first_row * image.width
+    return np.asarray(region).reshape(-1, 4)[offset:offset + count]
+
+
+def _protect_header(header, payload_length, symbols):
+    """Returns the protected copy of 'header' that follows it when the message has error correction"""
+    content = header + payload_length.to_bytes(4, byteorder="big", signed=False) + bytes([symbols])
+    return ecc.encode(content, _PROTECTED_HEADER_SYMBOLS)
+
+
+def _parse_plain_header(header, pixel_count):
+    """Parses the header bytes alone (at least 5, or 8 for the extended header)"""
+    msg_len = int.from_bytes(header[:4], byteorder="big", signed=False)
+    flags = header[4]
+    if not flags & _EXTENDED_FLAG:
+        return Header(msg_len, (flags >> 6) != 0, pixel_count - _HEADER_PIXELS, LEGACY_CODEC, 0, _HEADER_PIXELS, 0,
+                      msg_len, 0)
+
+    version, codec_byte, features = header[_HEADER_PIXELS:_HEADER_PIXELS + _EXTENDED_HEADER_SIZE]
+    if version != FORMAT_VERSION:
+        raise ValueError("Unsupported format version " + str(version) + "; the image may not contain a message")
+    compression = features & payload.COMPRESSION_MASK
+    if features & ~payload.FEATURES or (compression and compression not in payload.COMPRESSORS):
+        raise ValueError("Unsupported features " + bin(features) + "; the image may not contain a message")
+    codec = Codec.from_byte(codec_byte)
+    data_start = _HEADER_PIXELS + _EXTENDED_HEADER_SIZE
+    if features & payload.ECC:
+        data_start += _PROTECTED_HEADER_SIZE
+    return Header(msg_len, (flags & _STRING_FLAG) != 0, codec.bytes_in(pixel_count - data_start), codec, version,
+                  data_start, features, msg_len, 0)
+
+
+def _parse_protected_header(header, pixel_count, repair=True):
+    """Repairs (if 'repair' is set) and parses the protected copy of the header; returns a Header, or None if there is
+    no intact copy"""
+    start = _HEADER_PIXELS + _EXTENDED_HEADER_SIZE
+    block = header[start:start + _PROTECTED_HEADER_SIZE]
+    if len(block) != _PROTECTED_HEADER_SIZE:
+        return None
+    try:
+        content, corrected = ecc.decode(block, start + 5, _PROTECTED_HEADER_SYMBOLS, repair)
+        parsed = _parse_plain_header(content[:start], pixel_count)
+    except ValueError:
+        return None
+    payload_length = int.from_bytes(content[start:start + 4], byteorder="big", signed=False)
+    symbols = content[start + 4]
+    if not parsed.features & payload.ECC or not 1 <= symbols <= ecc.MAX_SYMBOLS or \
+            ecc.encoded_size(payload_length, symbols) != parsed.length:
+        return None
+    if corrected or content[:start] != header[:start]:
+        logger.warning("The message header was damaged; it has been repaired from its protected copy")
+    return parsed._replace(payload_length=payload_length, ecc_symbols=symbols)
+
+
+def _parse_header(header, pixel_count):
+    """Takes the header bytes (at least 5, or 8 for the extended header, followed by the protected copy if the
+    message has error correction) and the number of pixels in the image, and returns a Header.
+    A damaged header may have lost the flag that says the protected copy is there, so the copy is repaired whenever
+    the header is invalid, and taken if it is intact when the header is a plausible extended header without error
+    correction. Plausible legacy headers, the common case, are taken as they are."""
+    try:
+        parsed = _parse_plain_header(header, pixel_count)
+    except ValueError:
+        parsed = None
+    plausible = parsed is not None and parsed.length <= parsed.capacity
+    if plausible and not parsed.version:
+        return parsed
+    protected = _parse_protected_header(header, pixel_count, not plausible or parsed.features & payload.ECC)
+    if protected is not None:
+        return protected
+    if parsed is None:
+        # raise the original error
+        return _parse_plain_header(header, pixel_count)
+    if parsed.features & payload.ECC:
+        raise ValueError("The message header is damaged beyond repair")
+    return parsed
+
+
+def read_header(image):
+    """
+    read_header(image)
+    Reads only the header pixels of a steganographic image and reports what it claims to contain, without decoding
+    the message itself. 'image' may be a PIL image or a path; for paths to 8-bit PNG files only the first rows of the
+    file are inflated, so the cost does not grow with the size of the image.
+
+    :param image:   a PIL image object, or a path to an image file
+    :return:        Header; capacity is the largest length the image can hold with the header's codec, so a length
+                    greater than capacity means the image does not contain a message
+    """
+
+    if isinstance(image, (str, os.PathLike)):
+        try:
+            width, height, header_pixels = pngio.read_pixels(image, MAX_HEADER_PIXELS)
+        except pngio.UnsupportedPNGError:
+            with Image.open(image) as opened:
+                return read_header(opened)
+    else:
+        width, height = image.width, image.height
+        header_pixels = _read_pixels(image, 0, MAX_HEADER_PIXELS)
+
+    return parse_header(header_pixels, width * height)
+
+
+def parse_header(pixels, pixel_count):
+    """
+    parse_header(pixels, pixel_count)
+    Parses the header from RGBA values that have already been read, for callers that decode the first pixels of an
+    image themselves; see read_header.
+
+    :param pixels:      an (n, 4) array of the RGBA values of the first pixels, in row-major order; the first
+                        MAX_HEADER_PIXELS of them are used
+    :param pixel_count: the number of pixels in the image
+    :return:            Header
+    """
+
+    header_pixels = pixels[:MAX_HEADER_PIXELS]
+    return _parse_header(_join_bytes(header_pixels, len(header_pixels)), pixel_count)
+
+
+def peek_header(image):
+    """
+    peek_header(image)
+    Like read_header, but returns only (length, is_string, capacity). Both raise ValueError if the image has an
+    extended header that this version cannot read, which also usually means it does not contain a message.
+
+    :param image:   a PIL image object, or a path to an image file
+    :return:        (length, is_string, capacity)
+    """
+
+    header = read_header(image)
+    return header.length, header.is_string, header.capacity
+
+
+def _header_size(codec, features=0):
+    """Returns the number of pixels taken by the header of a message in 'codec' with 'features'"""
+    size = len(_build_header(0, False, codec, features))
+    return size + _PROTECTED_HEADER_SIZE if features & payload.ECC else size
+
+
+def _image_size(image_or_size):
+    """Returns (width, height) of a PIL image, a (width, height) pair, or an image file; for files, only the file
+    header is read"""
+    if isinstance(image_or_size, (str, os.PathLike)):
+        with Image.open(image_or_size) as image:
+            return image.size
+    elif isinstance(image_or_size, Image.Image):
+        return image_or_size.size
+    return tuple(image_or_size)
+
+
+def capacity(image_or_size, codec=None, features=0):
+    """
+    capacity(image_or_size, codec, features)
+    Returns the exact number of message bytes an image can hold. Only the image dimensions are needed, so no pixels
+    are read or decoded.
+
+    :param image_or_size:   a PIL image object, a (width, height) pair, or a path to an image file
+    :param codec:           the Codec the message would be hidden with; defaults to LEGACY_CODEC
+    :param features:        the payload feature flags the message would be stored with; these may need the extended
+                            header, which takes 3 more pixels. The bytes are counted after compression and encryption.
+    :return:                int
+    """
+
+    codec = codec or LEGACY_CODEC
+    width, height = _image_size(image_or_size)
+    return codec.bytes_in(width * height - _header_size(codec, features))
+
+
+def smallest_carrier(carriers, size, codec=None, features=0):
+    """
+    smallest_carrier(carriers, size, codec, features)
+    Picks the carrier with the least capacity that can still hold 'size' bytes, so that larger carriers are left for
+    larger messages.
+
+    :param carriers:    an iterable of PIL images, (width, height) pairs or paths to image files
+    :param size:        the length of the message in bytes
+    :param codec:       the Codec the message would be hidden with; defaults to LEGACY_CODEC
+    :param features:    the payload feature flags the message would be stored with (see capacity)
+    :return:            the chosen carrier as it was given, or None if no carrier is large enough
+    """
+
+    best, best_capacity = None, None
+    for carrier in carriers:
+        carrier_capacity = capacity(carrier, codec, features)
+        if size <= carrier_capacity and (best_capacity is None or carrier_capacity < best_capacity):
+            best, best_capacity = carrier, carrier_capacity
+    return best
+
+
+def _message_reader(image, header, key):
+    """Returns a function (first, count) that returns the (count, 4) RGBA values of the message pixels
+    [first, first + count), in message order. A scattered message is gathered from the whole image, which is decoded
+    once; otherwise only the rows that hold the pixels asked for are decoded."""
+    if not header.features & payload.SCATTERED:
+        return lambda first, count: _read_pixels(image, header.data_start + first, count)
+    if key is None:
+        raise ValueError("The message is scattered; a key is needed to reveal it")
+    pixel_count = image.width * image.height
+    pixels = _read_pixels(image, 0, pixel_count)
+    targets = scatter.indexes(key, pixel_count, header.data_start, header.codec.pixels_for(header.length))
+    return lambda first, count: np.take(pixels, targets[first:first + count], axis=0)
+
+
+def _check_header(header):
+    if header.length > header.capacity:
+        raise ValueError("Header claims a message of " + str(header.length) + " bytes, but the image can only hold " +
+                         str(header.capacity) + "; the image does not contain a message")
+    if header.features & payload.ENCRYPTED and header.payload_length < payload.ENCRYPTION_OVERHEAD:
+        raise ValueError("Header claims an encrypted message of " + str(header.payload_length) + " bytes, which is too "
+                         "short to be one; the image does not contain a message")
+
+
+def _associated_data(is_string, codec, features):
+    """Returns the header bytes an encrypted message is bound to: everything but the length, which the tag covers
+    implicitly, so that flipping a flag or the codec in the header is detected too"""
+    return _build_header(0, is_string, codec, features)[4:]
+
+
+def _pack(message, is_string, codec, compression, key, ecc_symbols, scattered, metrics):
+    """Runs a message through the pre-embed stages; returns (the header, the bytes to store, feature flags)"""
+    if scattered and key is None:
+        raise ValueError("A key is needed to scatter a message")
+    with metrics.phase("compress"):
+        stored, features = payload.compress(message, compression)
+    # every flag is set before encrypting, since the header is authenticated with the message
+    if key is not None:
+        features |= payload.ENCRYPTED
+    if scattered:
+        features |= payload.SCATTERED
+    if ecc_symbols:
+        ecc.check_symbols(ecc_symbols)
+        features |= payload.ECC
+    if key is not None:
+        with metrics.phase("encrypt"):
+            stored = payload.encrypt(stored, key, _associated_data(is_string, codec, features))
+    payload_length = len(stored)
+    if ecc_symbols:
+        with metrics.phase("ecc"):
+            stored = ecc.encode(stored, ecc_symbols)
+    header = _build_header(len(stored), is_string, codec, features)
+    if ecc_symbols:
+        header += _protect_header(header, payload_length, ecc_symbols)
+    if features:
+        logger.debug("Packed %d bytes into %d; features %s", len(message), len(stored), bin(features))
+    return header, stored, features
+
+
+def _early_key_check(read, header, key, metrics):
+    """Checks 'key' against the start of an encrypted message, reading only the pixels that hold it with 'read' (from
+    _message_reader), so that a wrong key is turned away before the rest of the message is decoded. Returns the derived
+    AES key, or None if the message is not encrypted. With error correction the start of the message is spread over
+    every block and may need repairing, so the key is only checked once the whole message has been decoded."""
+    if not header.features & payload.ENCRYPTED:
+        return None
+    if key is None:
+        raise ValueError("The message is encrypted; a key is needed to reveal it")
+    if header.ecc_symbols:
+        return None
+    size = payload.KEY_CHECK_SIZE
+    with metrics.phase("decrypt"):
+        prefix = _join_bytes(read(0, header.codec.pixels_for(size)), size, header.codec)
+        return payload.check_key(prefix, key)
+
+
+def _unwrap(stored, header, key, aes_key, metrics):
+    """Undoes error correction and encryption; decompression is left to the caller, which may stream it"""
+    if header.ecc_symbols:
+        with metrics.phase("ecc"):
+            try:
+                stored, corrected = ecc.decode(stored, header.payload_length, header.ecc_symbols)
+            except ValueError as error:
+                if not header.features & payload.SCATTERED:
+                    raise
+                # a wrong key gathers the wrong pixels, which look like a message damaged everywhere
+                raise ValueError(str(error) + ", or the key is wrong")
+        metrics.count("corrected", corrected)
+        if corrected:
+            logger.warning("Corrected %d damaged bytes", corrected)
+    if header.features & payload.ENCRYPTED:
+        with metrics.phase("decrypt"):
+            stored = payload.decrypt(stored, key, _associated_data(header.is_string, header.codec, header.features),
+                                     aes_key)
+    return stored
+
+
+def _paste_span(image, start, data, codec, metrics):
+    """Writes 'data' into an RGBA image starting at pixel 'start', cropping out and pasting back only the rows that
+    hold it. Returns (the pixel after the last one written, array of the rows whose pixels changed)."""
+    with metrics.phase("split"):
+        values = _split_bytes(data, codec)
+    with metrics.phase("write"):
+        first_row = start // image.width
+        last_row = (start + len(values) - 1) // image.width + 1
+        box = (0, first_row, image.width, last_row)
+        pixels = np.array(image.crop(box), dtype=np.uint8).reshape(-1, 4)
+        offset = start - first_row * image.width
+        changed = np.zeros(len(pixels), dtype=bool)
+        changed[offset:offset + len(values)] = _write_values(pixels, offset, values, codec)
+        rows = first_row + np.flatnonzero(changed.reshape(last_row - first_row, image.width).any(axis=1))
+        if len(rows):
+            image.paste(Image.fromarray(pixels.reshape(last_row - first_row, image.width, 4), "RGBA"), box)
+    metrics.count("pixels", len(values))
+    return start + len(values), rows
+
+
+def _scatter_span(image, start, data, codec, key, metrics):
+    """Writes 'data' into an RGBA image, scattered over the pixels from 'start' on by the permutation for 'key': the
+    pixels it goes to are gathered in message order, written like a sequential span and scattered back, each pixel as
+    one 32-bit word. Returns (the pixel after the last one written in message order, array of the rows whose pixels
+    changed)."""
+    with metrics.phase("split"):
+        values = _split_bytes(data, codec)
+    with metrics.phase("scatter"):
+        targets = scatter.indexes(key, image.width * image.height, start, len(values))
+    with metrics.phase("write"):
+        pixels = np.array(image, dtype=np.uint8).reshape(-1, 4)
+        gathered = np.take(pixels, targets, axis=0)
+        changed = _write_values(gathered, 0, values, codec)
+        np.put(pixels.view(np.uint32), targets, gathered.view(np.uint32))
+        touched = np.zeros(image.height, dtype=bool)
+        touched[targets[changed] // image.width] = True
+        rows = np.flatnonzero(touched)
+        if len(rows):
+            image.paste(Image.fromarray(pixels.reshape(image.height, image.width, 4), "RGBA"))
+    metrics.count("pixels", len(values))
+    return start + len(values), rows
+
+
+def _span_pixels(codec, band_pixels):
+    """Returns the largest pixel count no greater than 'band_pixels' (but at least one unit) that holds a whole
+    number of bytes, so streamed spans never split a byte between them"""
+    unit = 8 // math.gcd(8, codec.bits_per_pixel)
+    return max(band_pixels // unit, 1) * unit
+
+
+def _encode_message(message):
+    """Returns (bytes, is_string) for a message given as a str, an int or a bytes-like object"""
+    if type(message) is str:
+        return bytes(message, 'utf-8'), True
+    elif type(message) is int:
+        return message.to_bytes(message.__sizeof__(), byteorder="big", signed=True), False
+    else:
+        return bytes(message), False
+
+
+def _check_in_place(image):
+    if image.mode != "RGBA":
+        raise ValueError("Only RGBA images can be written in place; this image is " + image.mode +
+                         " (use hide_message or hide_stream, which convert it)")
+
+
+def _writable_copy(image):
+    """Returns an RGBA copy of 'image' to write into; the conversion is the copy, so an image that is not RGBA is only
+    copied once"""
+    return image.copy() if image.mode == "RGBA" else image.convert("RGBA")
+
+
+def _check_header_fits(image, header):
+    if image.width * image.height < len(header):
+        raise ValueError("The image has " + str(image.width * image.height) + " pixels; the header alone needs " +
+                         str(len(header)))
+
+
+def _too_large(maximum, length):
+    logger.error("message is too large; maximum size is %d bytes; your message is %d bytes", maximum, length)
+
 
-def hide_message(image, message):
+def _stages(compression, key, ecc_symbols, scattered):
+    return compression is not None or key is not None or bool(ecc_symbols) or scattered
+
+
+def _read_and_pack(source, length, is_string, codec, compression, key, ecc_symbols, scattered, metrics):
+    """Reads a whole streamed message and packs it; compression, encryption and error correction work on the message
+    as a whole. Returns (header, source, length) for _embed."""
+    with metrics.phase("read"):
+        message = _ChunkReader(source).read(length)
+    if len(message) != length:
+        raise ValueError("Message ended after " + str(len(message)) + " bytes; expected " + str(length))
+    header, stored, _ = _pack(message, is_string, codec, compression, key, ecc_symbols, scattered, metrics)
+    return header, [memoryview(stored)], len(stored)
+
+
+def _embed(image, header, source, length, band_rows, codec, metrics, scatter_key=None):
+    """Writes 'header' and 'length' bytes read from 'source' into an RGBA image; see hide_stream_in_place. If
+    'scatter_key' is given, the message is scattered with it, all at once."""
+    _check_header_fits(image, header)
+    maximum = codec.bytes_in(image.width * image.height - len(header))
+    if length > maximum:
+        _too_large(maximum, length)
+        return None
+
+    reader = _ChunkReader(source)
+    position, rows = _paste_span(image, 0, header, LEGACY_CODEC, metrics)
+    changed = [rows]
+    span_bytes = length if scatter_key is not None else codec.bytes_in(_span_pixels(codec, band_rows * image.width))
+    remaining = length
+    while remaining > 0:
+        with metrics.phase("read"):
+            data = reader.read(min(span_bytes, remaining))
+        if not data:
+            raise ValueError("Message ended after " + str(length - remaining) + " bytes; expected " + str(length))
+        if scatter_key is not None:
+            position, rows = _scatter_span(image, position, data, codec, scatter_key, metrics)
+        else:
+            position, rows = _paste_span(image, position, data, codec, metrics)
+        changed.append(rows)
+        remaining -= len(data)
+        metrics.count("bytes", len(data))
+        metrics.progress("write", length - remaining, length)
+
+    # consecutive spans can share a row
+    changed = np.unique(np.concatenate(changed))
+    metrics.count("rows", len(changed))
+    logger.debug("Hid %d bytes in %d pixels; %d rows changed", length, position, len(changed))
+    return changed
+
+
+def hide_in_place(image, message, codec=None, metrics=None, band_rows=DEFAULT_BAND_ROWS, compression=None, key=None,
+                  ecc_symbols=0, scattered=False):
+    """
+    hide_in_place(image, message, codec, metrics, band_rows, compression, key, ecc_symbols, scattered)
+    Puts 'message' in an RGBA image without copying it, using the same format as hide_message. Only the rows that hold
+    the header and message are cropped out, about 'band_rows' rows at a time, and pasted back, so memory use does not
+    grow with the size of the image.
+
+    :param image:       an RGBA PIL image object; it is modified
+    :param message:     a str, an int or a bytes-like object
+    :param codec:       the Codec to use; defaults to LEGACY_CODEC
+    :param metrics:     a Metrics object to record phase timings, counters and progress in
+    :param band_rows:   the number of image rows to encode at a time
+    :param compression: 'auto', payload.ZLIB or payload.LZMA to compress the message first, or None not to
+    :param key:         a passphrase (str or bytes) to encrypt the message with, or None not to
+    :param ecc_symbols: the number of Reed-Solomon parity bytes to add to every block of up to 255 bytes, or 0 for
+                        no error correction; up to half as many damaged bytes per block can be repaired
+    :param scattered:   whether to scatter the message over the whole image with a permutation derived from 'key'
+                        (see scatter.py) instead of writing it from the top; the whole image is then written at once
+    :return:            a sorted array of the indexes of the rows whose pixels changed, or None if the message is too
+                        large for the image
+    """
+
+    metrics = metrics if metrics is not None else Metrics()
+    _check_in_place(image)
+    codec = codec or LEGACY_CODEC
+    with metrics.phase("encode"):
+        message, is_string = _encode_message(message)
+    header, stored, _ = _pack(message, is_string, codec, compression, key, ecc_symbols, scattered, metrics)
+    return _embed(image, header, [memoryview(stored)], len(stored), band_rows, codec, metrics,
+                  key if scattered else None)
+
+
+def hide_stream_in_place(image, source, length=None, is_string=False, band_rows=DEFAULT_BAND_ROWS, codec=None,
+                         metrics=None, compression=None, key=None, ecc_symbols=0, scattered=False):
+    """
+    hide_stream_in_place(image, source, length, is_string, band_rows, codec, metrics, compression, key, ecc_symbols,
+                         scattered)
+    Streams a message from 'source' into an RGBA image without copying it; see hide_stream and hide_in_place.
+
+    :return:    a sorted array of the indexes of the rows whose pixels changed, or None if the message is too large
+                for the image
+    """
+
+    metrics = metrics if metrics is not None else Metrics()
+    _check_in_place(image)
+    codec = codec or LEGACY_CODEC
+    if length is None:
+        length = _stream_length(source)
+    if _stages(compression, key, ecc_symbols, scattered):
+        header, source, length = _read_and_pack(source, length, is_string, codec, compression, key, ecc_symbols,
+                                                scattered, metrics)
+    else:
+        with metrics.phase("header"):
+            header = _build_header(length, is_string, codec)
+    return _embed(image, header, source, length, band_rows, codec, metrics, key if scattered else None)
+
+
+def hide_message(image, message, codec=None, metrics=None, compression=None, key=None, ecc_symbols=0,
+                 scattered=False):
     """Puts 'message' in an image 'image'. First, the algorithm checks to see whether the image is big enough to contain
-    the message. If not, it prints an error message and returns None; if it can, it stores the message in the 2 least
+    the message. If not, it logs an error and returns None; if it can, it stores the message in the 2 least
     significant bytes of each pixel's RGBA values.
     Message can be any format; image must be a PIL image object.
-    This function returns the modified image object.
-    The header of the file contains a 3-byte header, 4 bytes for the message length, and 1 byte for is_string"""
-
-    print("Hiding message...")
-    image = image.convert("RGBA")
-
-    # Message size must be smaller than (number of pixels - 5); we need 4 for the length and 1 for bool is_string
-    print("Checking to see if image can store message of size", message.__sizeof__())
-    if message.__sizeof__() * 4 > (image.width * image.height) - 5:
+    This function returns the modified image object; the original is copied (or converted to RGBA) once and is not
+    modified. Use hide_in_place to write into an RGBA image without copying it.
+    The header of the file contains a 3-byte header, 4 bytes for the message length, and 1 byte for is_string
+    'codec' selects the bits per channel and channels to use (see Codec); the default is the legacy 2-bit RGBA layout,
+    and any other codec is recorded in an extended header so that reveal_message can detect it.
+    'compression' ('auto', payload.ZLIB or payload.LZMA) compresses the message before it is hidden, if that makes it
+    smaller, and 'key' encrypts and authenticates it with a passphrase (see payload.py). 'ecc_symbols' adds that many
+    Reed-Solomon parity bytes to every block of the message, and protects the header too, so that a damaged image can
+    still be read (see ecc.py). 'scattered' spreads the message pixels over the whole image with a permutation derived
+    from 'key', instead of filling the image from the top (see scatter.py). All of them are recorded in the extended
+    header, and the capacity check applies to the message as stored. An image with fewer pixels than the header
+    needs raises ValueError.
+    If a Metrics object is given, the time spent in each phase and the bytes and pixels written are recorded in it."""
+
+    metrics = metrics if metrics is not None else Metrics()
+    logger.debug("Hiding message...")
+
+    # First, we must encode our message as a series of immutable bytes, so that we know exactly how many bytes need
+    # to fit in the image; whether we encode will depend on whether the message type is "str" or not
+    with metrics.phase("encode"):
+        message, is_string = _encode_message(message)
+
+    codec = codec or LEGACY_CODEC
+    header, message, features = _pack(message, is_string, codec, compression, key, ecc_symbols, scattered, metrics)
+    _check_header_fits(image, header)
+    maximum = capacity(image, codec, features)
+    if len(message) > maximum:
         # Message is too large for the image
-        print("error: message is too large\n"
-              "maximum size is", image.width*image.height - 5, "bytes; your message is", message.__sizeof__(), "bytes")
+        _too_large(maximum, len(message))
         return None
+
+    with metrics.phase("convert"):
+        image = _writable_copy(image)
+    _embed(image, header, [memoryview(message)], len(message), DEFAULT_BAND_ROWS, codec, metrics,
+           key if scattered else None)
+    return image
+
+
+def hide_stream(image, source, length=None, is_string=False, band_rows=DEFAULT_BAND_ROWS, codec=None, metrics=None,
+                compression=None, key=None, ecc_symbols=0, scattered=False):
+    """
+    hide_stream(image, source, length, is_string, band_rows, codec, metrics, compression, key, ecc_symbols, scattered)
+    Puts a message read from 'source' in an image 'image', using the same format as hide_message. The image is
+    processed about 'band_rows' rows at a time and the message is read as each band needs it, so memory use is bounded
+    by the band size rather than by the size of the message.
+
+    :param image:       a PIL image object; the original is not modified
+    :param source:      a binary file-like object, or an iterator of bytes-like chunks
+    :param length:      the number of bytes to hide; if None, everything left in 'source' (which must be seekable)
+    :param is_string:   whether the message should be revealed as a str
+    :param band_rows:   the number of image rows to encode at a time
+    :param codec:       the Codec to use; defaults to LEGACY_CODEC
+    :param metrics:     a Metrics object to record phase timings, counters and progress in
+    :param compression: as for hide_message; compressing, encrypting or adding error correction reads the whole
+                        message into memory first
+    :param key:         as for hide_message
+    :param ecc_symbols: as for hide_message
+    :param scattered:   as for hide_message; this too reads the whole message into memory first
+    :return:            the modified image, or None if the message is too large for the image
+    """
+
+    metrics = metrics if metrics is not None else Metrics()
+    codec = codec or LEGACY_CODEC
+    if length is None:
+        length = _stream_length(source)
+    if _stages(compression, key, ecc_symbols, scattered):
+        header, source, length = _read_and_pack(source, length, is_string, codec, compression, key, ecc_symbols,
+                                                scattered, metrics)
     else:
-        print("Image can store message")
-
-        # First, we must encode our message as a series of immutable bytes
-        # Whether we encode will depend on whether the message type is "str" or not
-        print("Checking message format...")
-        print("Encoding message...")
-        if type(message) is str:
-            message = bytes(message, 'utf-8')
-            is_string = True
-        elif type(message) is int:
-            message = message.to_bytes(message.__sizeof__(), byteorder="big", signed=True)
-            is_string = False
-        else:
-            message = bytearray(message)
-            is_string = False
-
-        # Next, we store the length of our original message as big-endian, unsigned bytes
-        # Since it is a byte array, we can use __len__()
-        org_msg_len = message.__len__().to_bytes(4, byteorder="big", signed=False)
-
-        # Next, declare our length array; this will store our length data in 16 binary numbers (len is 4 bytes)
-        len_array = []
-
-        # Next, initialize our position counters; these will tell us where in the message we are
-        len_array_position = 0
-        msg_byte_position = 0
-
-        # Next, we will populate our len_array with the properly formatted org_msg_len (only last 2 bits will contain
-        # information; all other bits are not used because we are only using the last two bits in a pixel's bytes)
-        print("Creating steganographic length data...")
-        for byte_num in range(0, 4):   # Message is four bytes long
-            len_array.append(org_msg_len[byte_num] & 0b11000000)   # catch only two bits from the byte,
-            len_array.append(org_msg_len[byte_num] & 0b00110000)   # storing them in their own byte in len_array
-            len_array.append(org_msg_len[byte_num] & 0b00001100)
-            len_array.append(org_msg_len[byte_num] & 0b00000011)
-
-            # Now, we must properly shift the bits we just wrote
-            for j in range(0, 4):
-                shift_amount = 6 - (2 * j)
-                # Don't shift the first four bytes in the array every time; shift the correct byte as byte_num increases
-                len_array[byte_num*4 + j] = len_array[byte_num*4 + j] >> shift_amount
-
-        # Next, create our steg message byte array; this will contain the message two bits at a time
-        steg_msg_bytes = []
-        temp_bytes = []   # used to temporarily hold our bytes until we put them in the steg_msg_bytes bytearray
-
-        print("Creating steganographic message data...")
-        for byte_num in range(0, message.__len__()):
-            temp_bytes.clear()  # clear for the next byte we are reading in from the message
-
-            temp_bytes.append(message[byte_num] & 0b11000000)   # catch only two bits from the byte,
-            temp_bytes.append(message[byte_num] & 0b00110000)   # storing them in their own byte in the array
-            temp_bytes.append(message[byte_num] & 0b00001100)
-            temp_bytes.append(message[byte_num] & 0b00000011)
-
-            for i in range(0, 4):
-                shift_amount = 6 - (2 * i)  # each bit must shift a different amount
-                temp_bytes[i] = temp_bytes[i] >> shift_amount   # shift so that each byte's 2 lsbs are the bits we want
-                steg_msg_bytes.append(temp_bytes[i])
-
-        #
-        # Now, write the data to the image's pixels
-        #
-        count = 0
-
-        print("Writing data to image...")
-
-        for row in range(0, image.height):
-            for col in range(0, image.width):
-                # We need to get the pixel data in every loop, so do it at the top
-                # We will store our pixel values in a list so we only need to access it once
-                pixel_data = image.getpixel((col, row))
-
-                # Create an identical pixel, but drop last two bits
-                new_red = pixel_data[0] & 0b11111100
-                new_green = pixel_data[1] & 0b11111100
-                new_blue = pixel_data[2] & 0b11111100
-                new_alpha = pixel_data[3] & 0b11111100
-
-                # Write our length data to the first four bytes
-                if row == 0 and col < 4:
-                    # Set the new pixel values to be the old pixel values plus the values in our length array
-                    # Since the old values were xxxxxx00, and the new values are 000000xx,
-                    # we will get the correct information when we add them
-                    new_red = new_red + len_array[len_array_position]
-                    new_green = new_green + len_array[len_array_position + 1]
-                    new_blue = new_blue + len_array[len_array_position + 2]
-                    new_alpha = new_alpha + len_array[len_array_position + 3]
-
-                    # put our pixel data
-                    image.putpixel((col, row), (new_red, new_green, new_blue, new_alpha))
-
-                    # increment our position by four, as we used four bytes from len_array
-                    len_array_position += 4
-
-                # our is_string bool will be stored in the red value of the fifth pixel
-                elif row == 0 and col == 4:
-
-                    if is_string:
-                        new_red = new_red + 1
-                    else:
-                        pass
-
-                    image.putpixel((col, row), (new_red, new_green, new_blue, new_alpha))
-
-                # Do for every other pixel
-                else:
-                    if msg_byte_position <= ((message.__len__() * 4) - 4):  # because it takes 4 pixels per byte
-                        new_red = new_red + steg_msg_bytes[msg_byte_position]
-                        new_green = new_green + steg_msg_bytes[msg_byte_position + 1]
-                        new_blue = new_blue + steg_msg_bytes[msg_byte_position + 2]
-                        new_alpha = new_alpha + steg_msg_bytes[msg_byte_position + 3]
-
-                        # store the modified pixel back where it came from
-                        image.putpixel((col, row), (new_red, new_green, new_blue, new_alpha))
-
-                        # increment our msg_byte_position so the next byte from steg_msg_bytes is the proper one
-                        msg_byte_position += 4
-                        count += 1
-    print("Done.")
+        with metrics.phase("header"):
+            header = _build_header(length, is_string, codec)
+    _check_header_fits(image, header)
+    maximum = codec.bytes_in(image.width * image.height - len(header))
+    if length > maximum:
+        _too_large(maximum, length)
+        return None
+
+    with metrics.phase("convert"):
+        image = _writable_copy(image)
+    _embed(image, header, source, length, band_rows, codec, metrics, key if scattered else None)
     return image
 
 
-def reveal_message(image):
-    """Takes an image object as parameter and returns the steganographic message within."""
-    len_array = []
-    msg_len = 0
-    byte_ptr = 0
-    is_string = False
-    msg_byte_array = bytearray()
-
-    print("Fetching message...")
-
-    for row in range(0, image.height):
-        for col in range(0, image.width):
-            pixel_data = image.getpixel((col, row))
-
-            if row == 0 and col < 4:
-                for byte in range(0, 4):    # length is 4 bytes
-                    len_array.append(pixel_data[byte] & 0b00000011)
-            elif row == 0 and col == 4:
-                for i in range(0, 16):  # 16 bit-pairs
-                    shift_amount = 30 - (2 * i)
-                    msg_len += len_array[i] << shift_amount
-                if pixel_data[0] & 0b00000011 is not 0:
-                    is_string = True
-                else:
-                    is_string = False
-            else:
-                if byte_ptr < msg_len:
-                    red_steg_bits = (pixel_data[0] & 0b00000011) << 6
-                    green_steg_bits = (pixel_data[1] & 0b00000011) << 4
-                    blue_steg_bits = (pixel_data[2] & 0b00000011) << 2
-                    alpha_steg_bits = (pixel_data[3] & 0b00000011) << 0
-
-                    msg_byte_array.append(red_steg_bits + green_steg_bits + blue_steg_bits + alpha_steg_bits)
-
-                    byte_ptr += 1
-    if is_string:
+def _iter_stored(image, header, read, band_rows, metrics):
+    """Yields the bytes stored in an image as they are, 'band_rows' rows of pixels at a time, reading them with 'read'
+    (from _message_reader)"""
+    codec = header.codec
+    span_bytes = codec.bytes_in(_span_pixels(codec, band_rows * image.width))
+    position = 0
+    remaining = header.length
+    while remaining > 0:
+        size = min(span_bytes, remaining)
+        count = codec.pixels_for(size)
+        with metrics.phase("read"):
+            pixels = read(position, count)
+        with metrics.phase("join"):
+            chunk = _join_bytes(pixels, size, codec)
+        position += count
+        remaining -= size
+        metrics.count("pixels", count)
+        metrics.count("bytes", size)
+        metrics.progress("read", header.length - remaining, header.length)
+        yield chunk
+
+
+def iter_message(image, band_rows=DEFAULT_BAND_ROWS, metrics=None, key=None):
+    """
+    iter_message(image, band_rows, metrics, key)
+    Yields the message in an image as a series of bytes objects, decoding about 'band_rows' rows of pixels at a time.
+    Compressed messages are decompressed as they are decoded. Encrypted messages are authenticated as a whole, so
+    they are read completely before anything is yielded; a wrong key is turned away before that. Scattered messages
+    are gathered from the whole image, which is decoded at once.
+
+    :param image:       a PIL image object containing a message
+    :param band_rows:   the number of image rows to decode at a time
+    :param metrics:     a Metrics object to record phase timings, counters and progress in
+    :param key:         the passphrase an encrypted message was hidden with
+    :return:            generator of bytes
+    """
+
+    metrics = metrics if metrics is not None else Metrics()
+    with metrics.phase("header"):
+        header = read_header(image)
+    _check_header(header)
+
+    with metrics.phase("read"):
+        read = _message_reader(image, header, key)
+    chunks = _iter_stored(image, header, read, band_rows, metrics)
+    if header.features & (payload.ENCRYPTED | payload.ECC):
+        aes_key = _early_key_check(read, header, key, metrics)
+        chunks = [_unwrap(b"".join(chunks), header, key, aes_key, metrics)]
+    decompressor = payload.decompressor(header.features)
+    for chunk in chunks:
+        if decompressor is not None:
+            with metrics.phase("decompress"):
+                chunk = decompressor.decompress(chunk)
+        yield chunk
+    if decompressor is not None:
+        decompressor.finish()
+
+
+def reveal_stream(image, sink, band_rows=DEFAULT_BAND_ROWS, metrics=None, key=None):
+    """
+    reveal_stream(image, sink, band_rows, metrics, key)
+    Writes the message in an image to 'sink' as it is decoded, without holding the whole message in memory (unless it
+    is encrypted; see iter_message).
+
+    :param image:       a PIL image object containing a message
+    :param sink:        a writable binary file-like object
+    :param band_rows:   the number of image rows to decode at a time
+    :param metrics:     a Metrics object to record phase timings, counters and progress in
+    :param key:         the passphrase an encrypted message was hidden with
+    :return:            (length, is_string) of the message that was written
+    """
+
+    metrics = metrics if metrics is not None else Metrics()
+    header = read_header(image)
+    length = 0
+    for chunk in iter_message(image, band_rows, metrics, key):
+        with metrics.phase("output"):
+            sink.write(chunk)
+        length += len(chunk)
+    return length, header.is_string
+
+
+def reveal_message(image, metrics=None, key=None):
+    """Takes an image object as parameter and returns the steganographic message within. The codec the message was
+    hidden with, and whether it was compressed, encrypted or scattered, are read from the header; 'key' is the
+    passphrase of an encrypted or scattered message. ValueError is raised if the key is wrong or the message fails
+    authentication. If a Metrics object is given, phase timings and counters are recorded in it."""
+    metrics = metrics if metrics is not None else Metrics()
+    logger.debug("Fetching message...")
+
+    with metrics.phase("header"):
+        header = read_header(image)
+    _check_header(header)
+    with metrics.phase("read"):
+        read = _message_reader(image, header, key)
+    aes_key = _early_key_check(read, header, key, metrics)
+
+    # Decode only the pixels that hold the message
+    count = header.codec.pixels_for(header.length)
+    with metrics.phase("read"):
+        pixels = read(0, count)
+    with metrics.phase("join"):
+        msg_byte_array = _join_bytes(pixels, header.length, header.codec)
+    metrics.count("pixels", count)
+    metrics.count("bytes", header.length)
+    metrics.progress("read", header.length, header.length)
+
+    msg_byte_array = _unwrap(msg_byte_array, header, key, aes_key, metrics)
+    if header.features & payload.COMPRESSION_MASK:
+        with metrics.phase("decompress"):
+            msg_byte_array = payload.decompress(msg_byte_array, header.features)
+
+    if header.is_string:
         return str(msg_byte_array, encoding='utf-8')
     else:
         return bytearray(msg_byte_array)
@@ -1,122 +1,429 @@
 """Creates a small command-line tool to do stegranography using the algorithms in this program"""
 
+import os
 import sys
 import argparse
+import glob
+import logging
 import re
 import LSB
+import batch
+import cache
+import ecc
 import jpeg
+import jsteg
+import payload
+import pngio
+import scan
+import service
+import shard
+from metrics import Metrics, get_logger
 from PIL import Image
 
-mode_help = "Required; 'hide' or 'show'; choose whether to hide or show a message in a file"
+logger = get_logger("cli")
+
+mode_help = "Required; 'hide' or 'show'; choose whether to hide or show a message in a file, 'serve' to answer \
+requests over a local socket (see service.py), or 'scan' to look for hidden messages in the images given by -i (a file \
+or directory) or --glob, writing one JSON line per image to -o or stdout (see scan.py)"
 i_help = "Required; specify path to source image"
 msg_s_help = "The message you wish to hide; can be text or a number"
 msg_f_help = "The file you wish to hide"
 o_help = "Path to which to save the steganographic image; if not specified, the input file will be overwritten"
+manifest_help = "Batch mode; a CSV (with a header row) or JSON lines file of input, message and output paths"
+glob_help = "Batch mode; a glob pattern of input images; outputs are written to the directory given by -o"
+shard_help = "With --glob, split one message across all of the matching images (hide) or reassemble it from them \
+(show); -o is the output directory for hide and the message file for show"
+dry_run_help = "Report capacity and whether the message fits (hide) or the header of each image (show) without \
+reading any pixel data; with --glob and hide, picks the smallest carrier that fits the message"
+jobs_help = "The number of worker processes to use in batch, serve and scan modes; defaults to the number of CPUs"
+bits_help = "LSB only; the number of least significant bits (1-4) to use in each channel; defaults to 2"
+channels_help = "LSB only; the channels to hide the message in, any of R, G, B and A; defaults to RGBA"
+compress_level_help = "PNG output only; the zlib compression level, 0 (fastest) to 9 (smallest); defaults to " + \
+    str(pngio.DEFAULT_COMPRESS_LEVEL)
+png_filter_help = "PNG output only; the row filter to use: none, sub, up, average, paeth or adaptive. By default, when \
+a PNG carrier is written back as a PNG, only the rows that changed are filtered again, with their original filters; \
+giving a filter re-encodes every row"
+socket_help = "Serve mode; listen on this UNIX socket instead of a TCP port"
+port_help = "Serve mode; the TCP port to listen on, on localhost; defaults to " + str(service.DEFAULT_PORT)
+max_pending_help = "Serve mode; the number of requests that may wait for a worker before new ones are refused"
+cache_help = "Show mode; a directory in which to cache headers and messages by file content, so that images that \
+have been read before are not decoded again"
+compress_help = "LSB hide only; compress the message before hiding it: auto (whichever of zlib and lzma is smaller), \
+zlib, lzma or none; it is stored uncompressed if compressing does not make it smaller. Defaults to none"
+key_file_help = "LSB only; a file holding a passphrase with which to encrypt and authenticate the message (hide) or \
+to decrypt it (show); a trailing newline is ignored. Needs the 'cryptography' package"
+ecc_help = "LSB hide only; add this many Reed-Solomon parity bytes to every block of up to 255 bytes of the \
+message, so that up to half as many damaged bytes per block can be repaired when it is shown; the header is \
+protected too. 32 is a reasonable choice; defaults to 0, no error correction"
+scan_rows_help = "Scan mode; the number of rows to sample from the top of each image, where most tools start \
+writing; defaults to " + str(scan.DEFAULT_SAMPLING.rows)
+scan_stride_help = "Scan mode; sample only every n-th of those rows; defaults to 1, all of them"
+scan_tiles_help = "Scan mode; also sample this many tiles spread over each image, for messages that are not written \
+from the top; this decodes every pixel. Defaults to 0"
+tile_size_help = "Scan mode; the width and height of each tile in pixels; defaults to " + \
+    str(scan.DEFAULT_SAMPLING.tile_size)
+scatter_help = "LSB hide only; spread the message over the whole image in an order derived from the passphrase in \
+--key-file, instead of writing it from the top of the image; show finds it with the same --key-file. Needs --key-file"
+verbose_help = "Report progress on stderr"
+metrics_help = "Write the phase timings and byte and pixel counts of the operation to stderr as JSON"
 algorithm_help = "Required; the algorithm you want to use; currently supported algorithms are:\n\t- LSB (least \
-significant bit steganography)"
+significant bit steganography) for .png and .bmp files\n\t- JSteg (DCT coefficient steganography) for .jpg files"
 
 parser = argparse.ArgumentParser()
 parser.add_argument("-mode", "--mode", help=mode_help, required=True)
-parser.add_argument("-i", "--input-file", help=i_help, required=True)
+parser.add_argument("-i", "--input-file", help=i_help, required=False)
 parser.add_argument("-msg", "--message", help=msg_s_help, required=False)
 parser.add_argument("-mf", "--message-file", help=msg_f_help, required=False)
 parser.add_argument("-o", "--output-file", help=o_help, required=False)
 parser.add_argument("-a", "--algorithm", help=algorithm_help, required=False)
+parser.add_argument("--bits", help=bits_help, type=int, default=2)
+parser.add_argument("--channels", help=channels_help, default="RGBA")
+parser.add_argument("--manifest", help=manifest_help, required=False)
+parser.add_argument("--glob", help=glob_help, required=False)
+parser.add_argument("--shard", help=shard_help, action="store_true")
+parser.add_argument("--dry-run", help=dry_run_help, action="store_true")
+parser.add_argument("-j", "--jobs", help=jobs_help, type=int, required=False)
+parser.add_argument("--compress-level", help=compress_level_help, type=int, choices=range(10),
+                    default=pngio.DEFAULT_COMPRESS_LEVEL, metavar="{0-9}")
+parser.add_argument("--png-filter", help=png_filter_help, choices=sorted(pngio.FILTERS), required=False)
+parser.add_argument("--socket", help=socket_help, required=False)
+parser.add_argument("--port", help=port_help, type=int, default=service.DEFAULT_PORT)
+parser.add_argument("--max-pending", help=max_pending_help, type=int, default=64)
+parser.add_argument("--cache", help=cache_help, required=False)
+parser.add_argument("--compress", help=compress_help, choices=["auto", "zlib", "lzma", "none"], default="none")
+parser.add_argument("--key-file", help=key_file_help, required=False)
+parser.add_argument("--ecc", help=ecc_help, type=int, default=0, metavar="{0-254}")
+parser.add_argument("--scatter", help=scatter_help, action="store_true")
+parser.add_argument("--scan-rows", help=scan_rows_help, type=int, default=scan.DEFAULT_SAMPLING.rows)
+parser.add_argument("--scan-stride", help=scan_stride_help, type=int, default=scan.DEFAULT_SAMPLING.stride)
+parser.add_argument("--scan-tiles", help=scan_tiles_help, type=int, default=scan.DEFAULT_SAMPLING.tiles)
+parser.add_argument("--tile-size", help=tile_size_help, type=int, default=scan.DEFAULT_SAMPLING.tile_size)
+parser.add_argument("-v", "--verbose", help=verbose_help, action="store_true")
+parser.add_argument("--metrics", help=metrics_help, action="store_true")
 
-args = parser.parse_args()
 
-if not args.algorithm:
-    print("No algorithm specified; assuming least-significant-bit method")
-    algorithm = "LSB"   # assume LSB if no algorithm is specified
-else:
-    algorithm = str(args.algorithm)
+def write_message(message):
+    """Writes a revealed message to stdout; only the message itself goes to stdout, so that it can be piped"""
+    if type(message) is str:
+        print(message)
+    else:
+        sys.stdout.flush()
+        sys.stdout.buffer.write(message)
+        sys.stdout.buffer.flush()
 
-# use a regex to see if the file is a bmp or png; this will allow us to catch incorrect file errors before PIL
-if re.search(r"((.bmp)|(.png))$", str(args.input_file)):
-    try:
-        i_file = Image.open(str(args.input_file)).convert("RGBA")
-        i_file.load()
-    except FileNotFoundError:
-        parser.error("System could not find the file specified")
-        sys.exit(2)
 
-    # Make sure we have a valid message
+def run_jsteg(args):
+    """Hides or shows a message in the DCT coefficients of a JPEG file"""
     if str(args.mode) == "hide":
         if args.message_file and args.message:
             parser.error("You cannot use both a message and a message file")
-        elif not args.message_file and not args.message:
+        elif args.message:
+            message = str(args.message)
+        elif args.message_file:
+            with open(str(args.message_file), "rb") as file:
+                message = file.read()
+        else:
             parser.error("You must specify a message or message file")
 
+        try:
+            data = jsteg.hide_message(str(args.input_file), message)
+        except (ValueError, jpeg.InvalidFormatError) as error:
+            logger.error("**** %s", error)
+            return 1
+        if data is None:
+            return 1
+        with open(str(args.output_file or args.input_file), "wb") as file:
+            file.write(data)
+
+    elif str(args.mode) == "show":
+        try:
+            message = jsteg.reveal_message(str(args.input_file))
+        except (ValueError, jpeg.InvalidFormatError) as error:
+            logger.error("**** %s", error)
+            return 1
+        if args.output_file is not None:
+            with open(str(args.output_file), "wb") as file:
+                file.write(bytes(message, "utf-8") if type(message) is str else message)
+        else:
+            write_message(message)
+    return 0
+
+
+def read_key(args):
+    """Returns the passphrase in --key-file, or None"""
+    if args.key_file is None:
+        return None
+    with open(str(args.key_file), "rb") as file:
+        return file.read().rstrip(b"\r\n")
+
+
+def run_cached_show(args):
+    """Shows the message in an image through the cache, which only decodes the image if its contents are new"""
+    try:
+        message = cache.Cache(args.cache).reveal(str(args.input_file), read_key(args))
+    except ValueError as error:
+        logger.error("**** %s", error)
+        return 1
     if args.output_file is not None:
-        print("o_file specified")
-        print("all output going to file")
-        print()
+        with open(str(args.output_file), "wb") as file:
+            file.write(bytes(message, "utf-8") if type(message) is str else message)
+    else:
+        write_message(message)
+    return 0
+
+
+def run_dry_run(args, codec):
+    """Sizes a hide job, or reports what a show job would find, from image headers only"""
+    paths = sorted(glob.glob(str(args.glob), recursive=True)) if args.glob else [str(args.input_file)]
+
+    if str(args.mode) == "hide":
+        if args.message_file:
+            size = os.path.getsize(str(args.message_file))
+        elif args.message:
+            size = len(bytes(str(args.message), "utf-8"))
+        else:
+            parser.error("You must specify a message or message file")
+        # the sizes are those before any compression, which cannot be known without compressing
+        features = 0
+        if args.key_file:
+            size += payload.ENCRYPTION_OVERHEAD
+            features |= payload.ENCRYPTED
+        if args.ecc:
+            size = ecc.encoded_size(size, args.ecc)
+            features |= payload.ECC
+        if args.scatter:
+            features |= payload.SCATTERED
+
+        if args.glob:
+            carrier = LSB.smallest_carrier(paths, size, codec, features)
+            if carrier is None:
+                print("No carrier can hold a message of", size, "bytes")
+                return 1
+            print("Smallest carrier for a message of", size, "bytes:", carrier, "(capacity",
+                  LSB.capacity(carrier, codec, features), "bytes)")
+            return 0
+
+        capacity = LSB.capacity(paths[0], codec, features)
+        print("Capacity:", capacity, "bytes; message:", size, "bytes;", "fits" if size <= capacity else "does not fit")
+        return 0 if size <= capacity else 1
+
+    elif str(args.mode) == "show":
+        for path in paths:
+            try:
+                header = cache.Cache(args.cache).header(path) if args.cache else LSB.read_header(path)
+            except ValueError as error:
+                print(path + ":", error)
+                continue
+            if header.length > header.capacity:
+                print(path + ": no message")
+            else:
+                print(path + ":", header.length, "byte", "string" if header.is_string else "binary", "message;",
+                      "codec", str(header.codec.bits) + "-bit", header.codec.channels,
+                      "(features " + bin(header.features) + ")" if header.features else "")
+        return 0
+    parser.error("--dry-run mode must be 'hide' or 'show'")
+
+
+def run_sharded(args):
+    """Splits one message across, or reassembles it from, every image matching the glob given on the command line"""
+    if not args.glob:
+        parser.error("--shard requires a --glob of carrier images")
+    if not args.output_file:
+        parser.error("--shard requires an output (-o)")
+    paths = sorted(glob.glob(str(args.glob), recursive=True))
+
+    if str(args.mode) == "hide":
+        if not args.message_file:
+            parser.error("--shard requires a message file (-mf)")
+        os.makedirs(str(args.output_file), exist_ok=True)
+        output_paths = [os.path.join(str(args.output_file), os.path.basename(path)) for path in paths]
+        try:
+            plan = shard.hide_sharded_files(paths, str(args.message_file), output_paths, args.jobs)
+        except ValueError as error:     # shard.ShardError, or an image that cannot be read
+            logger.error("**** %s", error)
+            return 1
+        print("Split", sum(length for _, length in plan), "bytes across", len(plan), "images")
+    elif str(args.mode) == "show":
+        try:
+            length = shard.reveal_sharded_files(paths, str(args.output_file), args.jobs)
+        except ValueError as error:
+            logger.error("**** %s", error)
+            return 1
+        print("Reassembled", length, "bytes from", len(paths), "images")
+    else:
+        parser.error("--shard mode must be 'hide' or 'show'")
+    return 0
+
+
+def run_batch(args):
+    """Runs every job in the manifest or glob given on the command line through a process pool"""
+    mode = str(args.mode)
+    if mode not in ("hide", "show"):
+        parser.error("Batch mode must be 'hide' or 'show'")
+    if args.manifest and args.glob:
+        parser.error("You cannot use both a manifest and a glob")
+
+    if args.manifest:
+        jobs = batch.read_manifest(str(args.manifest))
+    else:
+        if not args.output_file:
+            parser.error("Batch mode with --glob requires an output directory (-o)")
+        if mode == "hide" and not args.message_file:
+            parser.error("Batch hide with --glob requires a message file (-mf)")
+        os.makedirs(str(args.output_file), exist_ok=True)
+        jobs = batch.glob_jobs(str(args.glob), str(args.output_file), args.message_file,
+                               None if mode == "hide" else ".bin")
+
+    summary = batch.run_batch(jobs, mode, args.jobs, batch.print_result, args.cache)
+    batch.print_summary(summary)
+    return 0 if summary["failed"] == 0 else 1
+
+
+def run_scan(args):
+    """Scans the images given by -i or --glob and writes the results as JSON lines to -o or stdout"""
+    if args.input_file:
+        paths = [str(args.input_file)]
+    elif args.glob:
+        paths = sorted(glob.glob(str(args.glob), recursive=True))
+    else:
+        parser.error("Scan mode requires an input file or directory (-i) or a --glob")
+    if min(args.scan_rows, args.scan_stride, args.tile_size) < 1 or args.scan_tiles < 0:
+        parser.error("--scan-rows, --scan-stride and --tile-size must be positive and --scan-tiles not negative")
+    sampling = scan.Sampling(args.scan_rows, args.scan_stride, args.scan_tiles, args.tile_size)
+
+    results = scan.scan(paths, sampling, args.jobs)
+    if args.output_file:
+        with open(str(args.output_file), "w") as file:
+            totals = scan.write_jsonl(results, file)
+    else:
+        totals = scan.write_jsonl(results, sys.stdout)
+    print("Scanned %d images in %.2f s: %d suspicious, %d unreadable" %
+          (totals["images"], totals["seconds"], totals["suspicious"], totals["errors"]), file=sys.stderr)
+    return 0
+
+
+def main():
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING, format="%(message)s")
+    metrics = Metrics(str(args.mode))
+
+    try:
+        codec = LSB.Codec(args.bits, args.channels)
+        if args.ecc:
+            ecc.check_symbols(args.ecc)
+    except ValueError as error:
+        parser.error(str(error))
+    if args.scatter and not args.key_file:
+        parser.error("--scatter needs a --key-file")
+
+    if str(args.mode) == "serve":
+        service.serve(args.socket, port=args.port, workers=args.jobs, max_pending=args.max_pending,
+                      cache_dir=args.cache)
+        return 0
+    elif str(args.mode) == "scan":
+        return run_scan(args)
+    elif args.dry_run and (args.input_file or args.glob):
+        return run_dry_run(args, codec)
+    elif args.shard:
+        return run_sharded(args)
+    elif args.manifest or args.glob:
+        return run_batch(args)
+    elif not args.input_file:
+        parser.error("You must specify an input file (-i), or a --manifest or --glob for batch mode")
+
+    is_jpeg = re.search(r"\.jpe?g$", str(args.input_file), re.IGNORECASE) is not None
+    if not args.algorithm:
+        if is_jpeg:
+            logger.info("No algorithm specified; assuming JSteg for a JPEG file")
+            algorithm = "JSteg"
+        else:
+            logger.info("No algorithm specified; assuming least-significant-bit method")
+            algorithm = "LSB"   # assume LSB if no algorithm is specified
+    else:
+        algorithm = str(args.algorithm)
+
+    if algorithm == "JSteg":
+        if not is_jpeg:
+            parser.error("JSteg can only be used with .jpg files")
+        return run_jsteg(args)
+
+    if algorithm != "LSB":
+        parser.error("Invalid algorithm!")
+
+    # use a regex to see if the file is a bmp or png; this will allow us to catch incorrect file errors before PIL
+    if re.search(r"((.bmp)|(.png))$", str(args.input_file)):
+        if str(args.mode) == "show" and args.cache:
+            return run_cached_show(args)
+        try:
+            i_file = Image.open(str(args.input_file))
+            i_file.load()
+        except FileNotFoundError:
+            parser.error("System could not find the file specified")
+            sys.exit(2)
+
+        # Make sure we have a valid message
+        if str(args.mode) == "hide":
+            if args.message_file and args.message:
+                parser.error("You cannot use both a message and a message file")
+            elif not args.message_file and not args.message:
+                parser.error("You must specify a message or message file")
 
         if str(args.mode) == "hide":
+            # the message is written into the opened image in place; an image that is not already RGBA is converted
+            # once, and no other copy of it is made. If no output file is given, the input file is overwritten.
+            # An RGBA PNG that is saved with its original filters only needs the changed rows encoded again.
+            source = str(args.input_file) if i_file.mode == "RGBA" and args.png_filter is None else None
+            if i_file.mode != "RGBA":
+                with metrics.phase("convert"):
+                    i_file = i_file.convert("RGBA")
+            o_path = str(args.output_file or args.input_file)
+            compression = payload.compression_method(args.compress)
+            key = read_key(args)
             try:
-                o_file = Image.open(str(args.output_file)).convert("RGBA")
-            except FileNotFoundError:
-                print("System could not find the file specified; creating...")
-                o_file = Image.new("RGBA", (i_file.width, i_file.height))
-
-            if args.message and not args.message_file:
-                print("Algorithm:", algorithm)
-                if algorithm == "LSB":
-                    o_file = LSB.hide_message(i_file, str(args.message))
-                    o_file.save(str(args.output_file))
+                if args.message:
+                    rows = LSB.hide_in_place(i_file, str(args.message), codec, metrics, compression=compression,
+                                             key=key, ecc_symbols=args.ecc, scattered=args.scatter)
                 else:
-                    print("Invalid algorithm!")
-            elif args.message_file and not args.message:
-                try:
-                    file = open(str(args.message_file), "rb")
-                    content = file.read()
-                    if algorithm == "LSB":
-                        o_file = LSB.hide_message(i_file, content)
-                        o_file.save(str(args.output_file))
-                except FileNotFoundError:
-                    print("**** System could not find the message file specified")
+                    # stream the message file into the image rather than reading it into memory (unless it is to be
+                    # compressed or encrypted, which needs all of it)
+                    with open(str(args.message_file), "rb") as file:
+                        rows = LSB.hide_stream_in_place(i_file, file, codec=codec, metrics=metrics,
+                                                        compression=compression, key=key, ecc_symbols=args.ecc,
+                                                        scattered=args.scatter)
+            except FileNotFoundError:
+                logger.error("**** System could not find the message file specified")
+                return 1
+            except ValueError as error:
+                logger.error("**** %s", error)
+                return 1
+            if rows is None:
+                return 1
+            logger.info("Writing %s (%d rows changed)...", o_path, len(rows))
+            with metrics.phase("save"):
+                pngio.save_image(i_file, o_path, args.compress_level, pngio.FILTERS[args.png_filter or "adaptive"],
+                                 source=source, rows=rows)
 
         elif str(args.mode) == "show":
-            o_file = open(str(args.output_file), "wb")
-
-            if algorithm == "LSB":
-                message = LSB.reveal_message(i_file)
-                if type(message) is str:
-                    print("Steganographic data is not a bytearray; converting string to utf-8-encoded bytearray...")
-                    print("Writing data to file...")
-                    o_file.write(bytearray(message, "utf-8"))
+            key = read_key(args)
+            try:
+                if args.output_file is not None:
+                    # strings are stored as utf-8, so the decoded bytes can be written out as they are
+                    logger.info("Writing data to %s...", args.output_file)
+                    with open(str(args.output_file), "wb") as o_file:
+                        LSB.reveal_stream(i_file, o_file, metrics=metrics, key=key)
                 else:
-                    print("Writing data to file...")
-                    o_file.write(message)
-                o_file.close()
+                    write_message(LSB.reveal_message(i_file, metrics, key))
+            except ValueError as error:
+                logger.error("**** %s", error)
+                return 1
 
+        if args.metrics:
+            print(metrics.to_json(), file=sys.stderr)
+        return 0
     else:
-        # Overwrite i_file
-        print("no o_file specified;")
-        print("printing output")
-        print()
+        logger.error("file is not a bitmap image; must be of type .png or .bmp (or .jpg with the JSteg algorithm)")
+        return 1
 
-        if str(args.mode) == "hide":
-            if args.message and not args.message_file:
-                if algorithm == "LSB":
-                    i_file = LSB.hide_message(i_file, str(args.message))
-                    print("Updating input file...")
-                    i_file.save(str(args.input_file))
-            elif args.message_file and not args.message:
-                try:
-                    file = open(str(args.message_file), "rb")
-                    content = file.read()
-                    if algorithm == "LSB":
-                        i_file = LSB.hide_message(i_file, content)
-                        i_file.save(str(args.input_file))
-                except FileNotFoundError:
-                    print("**** System could not find the message file specified")
-
-        elif str(args.mode) == "show":
-            print("Message:")
 
-            if algorithm == "LSB":
-                message = LSB.reveal_message(i_file)
-                print(message)
-else:
-    print("file is not a bitmap image; must be of type .png or .bmp")
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,173 @@
+"""
+batch.py
+
+Runs many hide/show jobs in one process pool, so that interpreter startup and library imports are paid once per
+worker rather than once per image.
+"""
+
+import concurrent.futures
+import csv
+import glob
+import json
+import os
+import sys
+import time
+from collections import namedtuple
+
+from PIL import Image
+
+import LSB
+import cache
+import pngio
+
+Job = namedtuple("Job", ["input", "message", "output"])
+JobResult = namedtuple("JobResult", ["job", "ok", "error", "pixels", "bytes", "seconds"])
+
+# The cache used by show jobs in this worker process, if run_batch was given a cache directory
+_cache = None
+
+
+def read_manifest(path):
+    """
+    read_manifest(path)
+    Reads a list of jobs from a manifest file. A .csv manifest needs a header row naming the 'input', 'message' and
+    'output' columns; any other manifest is read as JSON lines, one object with those keys per line. 'message' is the
+    path to the message file and is ignored for show jobs.
+
+    :param path:    path to the manifest
+    :return:        list:Job
+    """
+
+    with open(path, newline="") as file:
+        if path.lower().endswith(".csv"):
+            rows = list(csv.DictReader(file))
+        else:
+            rows = [json.loads(line) for line in file if line.strip()]
+    return [Job(row["input"], row.get("message") or None, row["output"]) for row in rows]
+
+
+def glob_jobs(pattern, output_dir, message=None, suffix=None):
+    """
+    glob_jobs(pattern, output_dir, message, suffix)
+    Creates one job per file matching 'pattern'; each output has the input's name and is placed in 'output_dir'.
+
+    :param pattern:     a glob pattern matching the input images
+    :param output_dir:  the directory outputs are written to
+    :param message:     the message file to hide in every image; None for show jobs
+    :param suffix:      replaces the extension of each output file name if given (e.g. ".bin" for show jobs)
+    :return:            list:Job
+    """
+
+    jobs = []
+    for path in sorted(glob.glob(pattern, recursive=True)):
+        name = os.path.basename(path)
+        if suffix is not None:
+            name = os.path.splitext(name)[0] + suffix
+        jobs.append(Job(path, message, os.path.join(output_dir, name)))
+    return jobs
+
+
+def run_hide_job(job):
+    """Hides the contents of job.message in job.input and saves the result to job.output. The message is written into
+    the carrier in place, and an RGBA PNG carrier only has its changed rows encoded again."""
+    start = time.perf_counter()
+    try:
+        with Image.open(job.input) as carrier, open(job.message, "rb") as message:
+            size = os.fstat(message.fileno()).st_size
+            pixels = carrier.width * carrier.height
+            carrier.load()
+            source = job.input if carrier.mode == "RGBA" else None
+            image = carrier if carrier.mode == "RGBA" else carrier.convert("RGBA")
+            rows = LSB.hide_stream_in_place(image, message)
+            if rows is None:
+                raise ValueError("message of " + str(size) + " bytes is too large for the image")
+            # the jobs already run in parallel, so each save is compressed on one thread
+            pngio.save_image(image, job.output, workers=1, source=source, rows=rows)
+    except Exception as error:
+        return JobResult(job, False, type(error).__name__ + ": " + str(error), 0, 0, time.perf_counter() - start)
+    return JobResult(job, True, None, pixels, size, time.perf_counter() - start)
+
+
+def run_show_job(job):
+    """Reveals the message in job.input and writes it to job.output; with a cache, a file whose contents have been
+    seen before is not decoded again. If the job fails, no partial output file is left behind."""
+    start = time.perf_counter()
+    sink = None
+    try:
+        with Image.open(job.input) as image:
+            pixels = image.width * image.height
+            if _cache is not None:
+                message = _cache.reveal(job.input)
+                with open(job.output, "wb") as sink:
+                    size = sink.write(bytes(message, "utf-8") if type(message) is str else message)
+            else:
+                # the message is streamed straight into the output file, which is removed again if reading fails
+                with open(job.output, "wb") as sink:
+                    size, _ = LSB.reveal_stream(image, sink)
+    except Exception as error:
+        if sink is not None:
+            try:
+                os.remove(job.output)
+            except OSError:
+                pass
+        return JobResult(job, False, type(error).__name__ + ": " + str(error), 0, 0, time.perf_counter() - start)
+    return JobResult(job, True, None, pixels, size, time.perf_counter() - start)
+
+
+def _init_worker(cache_dir):
+    global _cache
+    _cache = cache.Cache(cache_dir) if cache_dir is not None else None
+
+
+def run_batch(jobs, mode, workers=None, on_result=None, cache_dir=None):
+    """
+    run_batch(jobs, mode, workers, on_result, cache_dir)
+    Runs jobs across a process pool and returns a summary of the run. A failing job never stops the others; its
+    error is recorded in its JobResult.
+
+    :param jobs:        an iterable of Job
+    :param mode:        'hide' or 'show'
+    :param workers:     the number of worker processes; defaults to the number of CPUs
+    :param on_result:   called with each JobResult as it completes
+    :param cache_dir:   a cache.Cache directory for show jobs to share
+    :return:            dict with the job results and throughput figures
+    """
+
+    run_job = {"hide": run_hide_job, "show": run_show_job}[mode]
+    results = []
+    start = time.perf_counter()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                                initargs=(cache_dir,)) as executor:
+        futures = [executor.submit(run_job, job) for job in jobs]
+        for future in concurrent.futures.as_completed(futures):
+            result = future.result()
+            results.append(result)
+            if on_result is not None:
+                on_result(result)
+    elapsed = time.perf_counter() - start
+
+    succeeded = [result for result in results if result.ok]
+    payload_bytes = sum(result.bytes for result in succeeded)
+    return {
+        "results": results,
+        "jobs": len(results),
+        "succeeded": len(succeeded),
+        "failed": len(results) - len(succeeded),
+        "seconds": elapsed,
+        "pixels": sum(result.pixels for result in succeeded),
+        "bytes": payload_bytes,
+        "images_per_second": len(succeeded) / elapsed if elapsed else 0.0,
+        "mb_per_second": payload_bytes / 1e6 / elapsed if elapsed else 0.0,
+    }
+
+
+def print_result(result):
+    """Reports failed jobs on stderr as they complete"""
+    if not result.ok:
+        print("**** " + result.job.input + ": " + result.error, file=sys.stderr)
+
+
+def print_summary(summary):
+    print("Processed", summary["jobs"], "images:", summary["succeeded"], "succeeded,", summary["failed"], "failed")
+    print("Time: %.2f s; %.2f images/s; %.2f MB/s of message data" %
+          (summary["seconds"], summary["images_per_second"], summary["mb_per_second"]))
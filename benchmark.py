@@ -0,0 +1,211 @@
+"""
+benchmark.py
+
+Times LSB.hide_message, LSB.reveal_message and the JPEG parser on synthetic carriers from small images up to 50
+megapixels, with payloads from a few bytes up to the full capacity of the image. Every case runs in a fresh worker
+process so that its peak RSS is its own, and the results are written as JSON so that runs can be compared.
+
+    python benchmark.py -o before.json
+    python benchmark.py -o after.json --compare before.json
+"""
+
+import argparse
+import concurrent.futures
+import json
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+
+import numpy as np
+import PIL
+from PIL import Image
+
+import LSB
+import jpeg
+import pngio
+
+DEFAULT_SIZES = [0.1, 1, 12, 24, 50]
+DEFAULT_PAYLOADS = ["16", "1%", "50%", "100%"]
+
+
+def _peak_rss_mb():
+    """Returns the peak resident set size of this process in MB; ru_maxrss is in KB on Linux and bytes on macOS"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1 << 20) if sys.platform == "darwin" else peak / (1 << 10)
+
+
+def make_carrier(megapixels, seed=0):
+    """Returns a 4:3 RGBA image of about 'megapixels' megapixels. Smooth, upscaled noise is used rather than white
+    noise so that the JPEG cases have a realistic number of non-zero coefficients."""
+    width = max(int((megapixels * 1e6 * 4 / 3) ** 0.5), 8)
+    height = max(int(megapixels * 1e6 / width), 8)
+    rng = np.random.default_rng(seed)
+    small = rng.integers(0, 256, (max(height // 16, 1), max(width // 16, 1), 4), dtype=np.uint8)
+    image = Image.fromarray(small, "RGBA").resize((width, height), Image.BICUBIC)
+    pixels = np.asarray(image).astype(np.int16) + rng.integers(-8, 8, (height, width, 4), dtype=np.int16)
+    return Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8), "RGBA")
+
+
+def payload_size(spec, capacity):
+    """Turns a payload spec ('16' bytes or '50%' of capacity) into a byte count"""
+    if spec.endswith("%"):
+        return int(capacity * float(spec[:-1]) / 100)
+    return min(int(spec), capacity)
+
+
+def _time(function, repeat):
+    """Returns (best time in seconds, last result) of 'repeat' calls to 'function'"""
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def run_case(case):
+    """Runs one benchmark case in the current (fresh) process and returns its result record"""
+    operation, megapixels, spec, repeat = case["operation"], case["megapixels"], case["payload"], case["repeat"]
+    carrier = make_carrier(megapixels)
+    pixels = carrier.width * carrier.height
+    record = dict(case, width=carrier.width, height=carrier.height, pixels=pixels)
+
+    if operation in ("hide", "reveal"):
+        size = payload_size(spec, LSB.capacity(carrier))
+        message = np.random.default_rng(1).integers(0, 256, size, dtype=np.uint8).tobytes()
+        if operation == "hide":
+            rss_before = _peak_rss_mb()
+            seconds, _ = _time(lambda: LSB.hide_message(carrier, message), repeat)
+        else:
+            stego = LSB.hide_message(carrier, message)
+            rss_before = _peak_rss_mb()
+            seconds, _ = _time(lambda: LSB.reveal_message(stego), repeat)
+    elif operation in ("save", "save_pillow"):
+        # the "payload" of a save is the size of the file written
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "carrier.png")
+            rss_before = _peak_rss_mb()
+            if operation == "save":
+                seconds, _ = _time(lambda: pngio.write_png(path, carrier), repeat)
+            else:
+                seconds, _ = _time(lambda: carrier.save(path), repeat)
+            size = os.path.getsize(path)
+    else:
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "carrier.jpg")
+            carrier.convert("RGB").save(path, quality=90)
+            size = os.path.getsize(path)
+            rss_before = _peak_rss_mb()
+            if operation == "jpeg_index":
+                seconds, _ = _time(lambda: jpeg.JPEG(path).close(), repeat)
+            else:
+                def decode():
+                    with jpeg.JPEG(path) as image:
+                        image.decode_coefficients()
+                seconds, _ = _time(decode, repeat)
+
+    record.update(
+        payload_bytes=size,
+        seconds=seconds,
+        pixels_per_second=pixels / seconds if seconds else None,
+        mb_per_second=size / 1e6 / seconds if seconds else None,
+        rss_before_mb=rss_before,
+        peak_rss_mb=_peak_rss_mb(),
+    )
+    return record
+
+
+def build_cases(sizes, payloads, operations, repeat):
+    cases = []
+    for megapixels in sizes:
+        for operation in operations:
+            # the JPEG parser does not take a payload; its "payload" is the size of the file
+            for spec in (payloads if operation in ("hide", "reveal") else ["file"]):
+                cases.append({"operation": operation, "megapixels": megapixels, "payload": spec, "repeat": repeat})
+    return cases
+
+
+def run_benchmarks(cases, on_result=None):
+    """Runs every case in its own worker process, one at a time so that cases do not compete for CPU or memory"""
+    results = []
+    for case in cases:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=1) as executor:
+            try:
+                result = executor.submit(run_case, case).result()
+            except Exception as error:
+                result = dict(case, error=type(error).__name__ + ": " + str(error))
+        results.append(result)
+        if on_result is not None:
+            on_result(result)
+    return results
+
+
+def _key(result):
+    return result["operation"], result["megapixels"], result["payload"]
+
+
+def compare(results, baseline):
+    """Prints the speedup of each case over the matching case in a previous run"""
+    previous = {_key(result): result for result in baseline["results"] if "seconds" in result}
+    for result in results:
+        old = previous.get(_key(result))
+        if old is None or "seconds" not in result:
+            continue
+        print("%-11s %6s MP %6s: %8.4f s -> %8.4f s (%.2fx)" % (result["operation"], result["megapixels"],
+                                                               result["payload"], old["seconds"], result["seconds"],
+                                                               old["seconds"] / result["seconds"]))
+
+
+def print_result(result):
+    if "error" in result:
+        print("%-11s %6s MP %6s: %s" % (result["operation"], result["megapixels"], result["payload"], result["error"]))
+    else:
+        print("%-11s %6s MP %6s: %8.4f s, %8.1f Mpixel/s, %8.2f MB/s, peak RSS %.0f MB" %
+              (result["operation"], result["megapixels"], result["payload"], result["seconds"],
+               result["pixels_per_second"] / 1e6, result["mb_per_second"], result["peak_rss_mb"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks encoding and decoding throughput")
+    parser.add_argument("--sizes", type=float, nargs="+", default=DEFAULT_SIZES,
+                        help="carrier sizes in megapixels; defaults to " + str(DEFAULT_SIZES))
+    parser.add_argument("--payloads", nargs="+", default=DEFAULT_PAYLOADS,
+                        help="payload sizes, in bytes or as a percentage of capacity; defaults to " +
+                             str(DEFAULT_PAYLOADS))
+    parser.add_argument("--operations", nargs="+", default=["hide", "reveal", "save", "jpeg_index", "jpeg_decode"],
+                        choices=["hide", "reveal", "save", "save_pillow", "jpeg_index", "jpeg_decode"],
+                        help="which operations to time; save is pngio.write_png and save_pillow is Image.save")
+    parser.add_argument("--repeat", type=int, default=3, help="time each case this many times and keep the best")
+    parser.add_argument("-o", "--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="a JSON file from a previous run to compare against")
+    args = parser.parse_args()
+
+    cases = build_cases(args.sizes, args.payloads, args.operations, args.repeat)
+    results = run_benchmarks(cases, print_result)
+    report = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "pillow": PIL.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+    if args.compare:
+        with open(args.compare) as file:
+            compare(results, json.load(file))
+    return 1 if any("error" in result for result in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
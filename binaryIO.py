@@ -5,6 +5,10 @@ Copyright 2019 Riley Lannon
 A small module for handling binary values with file IO in Python
 """
 
+import mmap
+import os
+import struct
+
 def readU8(file):
     """Reads a single byte from a file"""
     return int.from_bytes(file.read(1), "little")
@@ -20,9 +24,7 @@ def readU16(file, end=False):
     :return:        int
     """
 
-    byte_array = []
-    byte_array.append(readU8(file))
-    byte_array.append(readU8(file))
+    byte_array = file.read(2)
 
     if (end):
         # little-endian
@@ -42,10 +44,8 @@ def read_bytes(file, num):
     :return:        list:int
     """
 
-    arr = []
-    for i in range(num):
-        arr.append(file.read(1))
-    return arr
+    data = file.read(num)
+    return [data[i:i + 1] for i in range(len(data))]
 
 
 def readU32(file, end=False):
@@ -58,12 +58,126 @@ def readU32(file, end=False):
     :return:        int
     """
 
-    byte_array = []
-    for i in range(4):
-        byte_array.append(readU8(file))
+    byte_array = file.read(4)
 
     if (end):
         # little-endian
         return int.from_bytes(byte_array, "little")
     else:
         return int.from_bytes(byte_array, "big")
+
+
+class BinaryReader:
+    """
+    Reads binary values from a buffer held entirely in memory: a memory-mapped file, or a bytes-like object.
+    Every read is a struct.unpack_from or a memoryview slice of that buffer, so no system calls are made after the
+    file is mapped, and reading a whole segment does not copy it.
+    """
+
+    def __init__(self, source, end=False):
+        """
+        :param source:  a path to a file to map, a binary file object, or a bytes-like object
+        :param end:     the endianness of the values; False = big, True = little
+        """
+
+        self._mmap = None
+        if isinstance(source, (str, os.PathLike)):
+            with open(source, "rb") as file:    # the mapping stays valid after the file is closed
+                source = self._map(file)
+        elif hasattr(source, "fileno"):
+            source = self._map(source)
+        self.buffer = memoryview(source).cast("B")
+        self.position = 0
+        self.prefix = "<" if end else ">"
+
+    def _map(self, file):
+        # empty files cannot be mapped
+        if os.fstat(file.fileno()).st_size == 0:
+            return b""
+        self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._mmap
+
+    def __len__(self):
+        return len(self.buffer)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Releases the buffer and unmaps the file. Slices returned by read_bytes must not be used afterwards."""
+        self.buffer.release()
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                # a caller still holds a slice of the mapping; it will be unmapped when that slice is released
+                pass
+            self._mmap = None
+
+    @property
+    def remaining(self):
+        return len(self.buffer) - self.position
+
+    def tell(self):
+        return self.position
+
+    def seek(self, position):
+        if not 0 <= position <= len(self.buffer):
+            raise EOFError("Cannot seek to " + str(position) + "; buffer is " + str(len(self.buffer)) + " bytes")
+        self.position = position
+
+    def skip(self, num):
+        self.seek(self.position + num)
+
+    def read_struct(self, fmt, offset=None):
+        """
+        read_struct(fmt, offset)
+        Unpacks several typed fields at once with a struct format string (without a byte-order character; the
+        reader's endianness is used).
+
+        :param fmt:     a struct format string, e.g. "HBB"
+        :param offset:  read at this offset without moving the position; if None, read at and advance the position
+        :return:        tuple
+        """
+
+        layout = struct.Struct(self.prefix + fmt)
+        start = self.position if offset is None else offset
+        if start + layout.size > len(self.buffer):
+            raise EOFError("Unexpected end of data reading " + str(layout.size) + " bytes at " + str(start))
+        values = layout.unpack_from(self.buffer, start)
+        if offset is None:
+            self.position += layout.size
+        return values
+
+    def readU8(self):
+        return self.read_struct("B")[0]
+
+    def readU16(self):
+        return self.read_struct("H")[0]
+
+    def readU32(self):
+        return self.read_struct("I")[0]
+
+    def read_bytes(self, num):
+        """
+        read_bytes(num)
+        Returns the next num bytes as a zero-copy memoryview slice; use bytes() on it to keep a copy.
+
+        :param num:     the number of bytes to read
+        :return:        memoryview
+        """
+
+        if self.position + num > len(self.buffer):
+            raise EOFError("Unexpected end of data reading " + str(num) + " bytes at " + str(self.position))
+        data = self.buffer[self.position:self.position + num]
+        self.position += num
+        return data
+
+    def slice(self, offset, num):
+        """Returns a zero-copy memoryview of num bytes at offset without moving the position"""
+        if offset < 0 or offset + num > len(self.buffer):
+            raise EOFError("Slice of " + str(num) + " bytes at " + str(offset) + " is out of range")
+        return self.buffer[offset:offset + num]
@@ -0,0 +1,290 @@
+"""
+cache.py
+
+A content-addressed cache of what has been learned about carrier images, so that scanning the same files again does
+not decode them again.
+
+Entries are keyed by a hash of the file's contents, so renamed and copied files share an entry, and they hold the
+parsed header and, optionally, the extracted message; encrypted messages are never stored once decrypted. The hash
+of each path is remembered together with the file's mtime and size and is only computed again when either changes.
+Entries live in an in-memory LRU and, if a directory is given, on disk, where the least recently used are evicted
+once the cache grows past its size limit. Decoded RGBA carriers can be kept in memory too, for long-running
+processes that hide in the same carriers again and again.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+from collections import OrderedDict
+
+from PIL import Image
+
+import LSB
+import payload
+from metrics import get_logger
+
+logger = get_logger("cache")
+
+# Bumped whenever the meaning of a stored entry changes, so that old entries are simply never found
+CACHE_VERSION = 4
+
+DEFAULT_MAX_BYTES = 1 << 30
+DEFAULT_MEMORY_BYTES = 256 << 20
+
+_HASH_BLOCK_SIZE = 1 << 20
+
+
+def file_digest(path):
+    """Returns the hex BLAKE2b digest of a file's contents"""
+    digest = hashlib.blake2b(digest_size=20)
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(_HASH_BLOCK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _header_to_dict(header):
+    fields = header._asdict()
+    fields["codec"] = [header.codec.bits, header.codec.channels]
+    return fields
+
+
+def _header_from_dict(fields):
+    fields = dict(fields, codec=LSB.Codec(*fields["codec"]))
+    return LSB.Header(**fields)
+
+
+def _write_atomic(path, data):
+    """Writes a file through a temporary file and a rename, so that other processes never see half of it"""
+    handle, temporary = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        with os.fdopen(handle, "wb") as file:
+            file.write(data)
+        os.replace(temporary, path)
+    except BaseException:
+        os.unlink(temporary)
+        raise
+
+
+class Cache:
+    """
+    Cache(directory, max_bytes, memory_bytes, store_payloads)
+    Caches headers and messages by file content.
+
+    :param directory:       where entries are kept on disk; None keeps them in memory only
+    :param max_bytes:       the size the on-disk cache is trimmed back to when it grows past it
+    :param memory_bytes:    the size of the in-memory LRU, which also holds decoded carriers
+    :param store_payloads:  whether revealed messages are cached as well as headers
+    """
+
+    def __init__(self, directory=None, max_bytes=DEFAULT_MAX_BYTES, memory_bytes=DEFAULT_MEMORY_BYTES,
+                 store_payloads=True):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.memory_bytes = memory_bytes
+        self.store_payloads = store_payloads
+        self.hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+        self._memory_used = 0
+        self._paths = {}
+        self._disk_used = None
+        if directory is not None:
+            os.makedirs(os.path.join(directory, "paths"), exist_ok=True)
+            os.makedirs(self._objects, exist_ok=True)
+
+    @property
+    def _objects(self):
+        return os.path.join(self.directory, "objects", "v" + str(CACHE_VERSION))
+
+    def _path_record(self, path):
+        return os.path.join(self.directory, "paths", hashlib.blake2b(path.encode(), digest_size=16).hexdigest())
+
+    def digest(self, path):
+        """Returns the content hash of the file at 'path', hashing it only if it is new or its mtime or size has
+        changed since it was last hashed"""
+        path = os.path.abspath(path)
+        status = os.stat(path)
+        stamp = [status.st_mtime_ns, status.st_size]
+        known = self._paths.get(path)
+        if known is None and self.directory is not None:
+            try:
+                with open(self._path_record(path)) as file:
+                    record = json.load(file)
+                if record["path"] == path:
+                    known = record["stamp"], record["digest"]
+            except (OSError, ValueError, KeyError):
+                pass
+        if known is not None and list(known[0]) == stamp:
+            digest = known[1]
+        else:
+            digest = file_digest(path)
+            if self.directory is not None:
+                record = {"path": path, "stamp": stamp, "digest": digest}
+                _write_atomic(self._path_record(path), json.dumps(record).encode())
+        self._paths[path] = stamp, digest
+        return digest
+
+    def _remember(self, key, value, size):
+        """Puts a value in the in-memory LRU, evicting the least recently used values to stay within memory_bytes"""
+        if key in self._memory:
+            self._memory_used -= self._memory.pop(key)[1]
+        if size > self.memory_bytes:
+            return
+        self._memory[key] = value, size
+        self._memory_used += size
+        while self._memory_used > self.memory_bytes:
+            _, (_, evicted) = self._memory.popitem(last=False)
+            self._memory_used -= evicted
+
+    def _recall(self, key):
+        entry = self._memory.get(key)
+        if entry is None:
+            return None
+        self._memory.move_to_end(key)
+        return entry[0]
+
+    def _load(self, name):
+        """Returns the bytes of a stored object, or None; a hit marks the object as recently used"""
+        if self.directory is None:
+            return None
+        path = os.path.join(self._objects, name)
+        try:
+            with open(path, "rb") as file:
+                data = file.read()
+        except OSError:
+            return None
+        os.utime(path)
+        return data
+
+    def _store(self, name, data):
+        if self.directory is None:
+            return
+        _write_atomic(os.path.join(self._objects, name), data)
+        if self._disk_used is not None:
+            self._disk_used += len(data)
+        if self._disk_used is None or self._disk_used > self.max_bytes:
+            self.trim()
+
+    def trim(self):
+        """Evicts the least recently used objects on disk until the cache is back under max_bytes; other processes
+        may share the directory, so its size is measured again rather than trusted"""
+        if self.directory is None:
+            return
+        entries = []
+        for entry in os.scandir(self._objects):
+            try:
+                status = entry.stat()
+            except OSError:
+                continue
+            entries.append((status.st_mtime_ns, status.st_size, entry.path))
+        used = sum(size for _, size, _ in entries)
+        evicted = 0
+        for _, size, path in sorted(entries):
+            if used <= self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+            used -= size
+            evicted += 1
+        if evicted:
+            logger.debug("Evicted %d cache entries; %d bytes remain", evicted, used)
+        self._disk_used = used
+
+    def clear(self):
+        """Empties the cache, in memory and on disk"""
+        self._memory.clear()
+        self._memory_used = 0
+        self._paths.clear()
+        if self.directory is not None:
+            for name in ("paths", os.path.join("objects", "v" + str(CACHE_VERSION))):
+                for entry in os.scandir(os.path.join(self.directory, name)):
+                    os.unlink(entry.path)
+            self._disk_used = 0
+
+    def header(self, path):
+        """
+        header(path)
+        Returns LSB.read_header(path), from the cache if the file's contents have been seen before. A file that does
+        not contain a readable header raises the same ValueError every time without being read again.
+
+        :param path:    path to an image file
+        :return:        LSB.Header
+        """
+
+        digest = self.digest(path)
+        key = ("header", digest)
+        fields = self._recall(key)
+        if fields is None:
+            data = self._load(digest + ".header")
+            fields = json.loads(data) if data is not None else None
+        if fields is None:
+            self.misses += 1
+            try:
+                fields = _header_to_dict(LSB.read_header(path))
+            except ValueError as error:
+                fields = {"error": str(error)}
+            self._store(digest + ".header", json.dumps(fields).encode())
+        else:
+            self.hits += 1
+        self._remember(key, fields, 256)
+        if "error" in fields:
+            raise ValueError(fields["error"])
+        return _header_from_dict(fields)
+
+    def reveal(self, path, key=None):
+        """
+        reveal(path, key)
+        Returns LSB.reveal_message(path, key=key), from the cache if the file's contents have been seen before and
+        store_payloads is set. Encrypted messages are decrypted every time, so that the cache never holds them in
+        the clear.
+
+        :param path:    path to an image file
+        :param key:     the passphrase of an encrypted message
+        :return:        str or bytearray, depending on what was hidden
+        """
+
+        header = self.header(path)
+        digest = self.digest(path)
+        store = self.store_payloads and not header.features & payload.ENCRYPTED
+        entry = ("payload", digest)
+        data = self._recall(entry) if store else None
+        if data is None and store:
+            data = self._load(digest + ".payload")
+        if data is None:
+            self.misses += 1
+            with Image.open(path) as image:
+                message = LSB.reveal_message(image, key=key)
+            data = bytes(message, "utf-8") if header.is_string else bytes(message)
+            if store:
+                self._store(digest + ".payload", data)
+        else:
+            self.hits += 1
+        if store:
+            self._remember(entry, data, len(data))
+        return str(data, encoding="utf-8") if header.is_string else bytearray(data)
+
+    def carrier(self, path):
+        """
+        carrier(path)
+        Returns a decoded RGBA copy of the image at 'path', keeping the decoded image in memory so that the next hide
+        in the same carrier only pays for the copy. The copy may be written into (e.g. with LSB.hide_in_place).
+
+        :param path:    path to an image file
+        :return:        an RGBA PIL image
+        """
+
+        digest = self.digest(path)
+        key = ("carrier", digest)
+        image = self._recall(key)
+        if image is None:
+            self.misses += 1
+            with Image.open(path) as opened:
+                image = opened.convert("RGBA") if opened.mode != "RGBA" else opened.copy()
+            self._remember(key, image, image.width * image.height * 4)
+        else:
+            self.hits += 1
+        return image.copy()
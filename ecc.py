@@ -0,0 +1,244 @@
+"""
+ecc.py
+
+Reed-Solomon error correction over GF(2^8), so that a message survives a carrier that has been slightly damaged.
+
+A message is cut into blocks of at most 255 - n bytes and each block gets n parity bytes, which let it be repaired
+as long as no more than n / 2 of its bytes are wrong. The blocks are interleaved before they are hidden (the first
+byte of every block, then the second byte of every block, and so on), so that a run of damaged pixels, such as a
+scratched band of rows, is spread thinly over many blocks instead of destroying a few.
+
+Every block is encoded and checked at once with NumPy. Only the blocks whose parity does not match go through the
+syndrome, Berlekamp-Massey, Chien and Forney steps, which are also vectorized across those blocks, so an intact
+carrier pays little more than one pass over the message.
+"""
+
+from functools import lru_cache
+
+import numpy as np
+
+_PRIMITIVE = 0x11d
+FIELD_SIZE = 255
+
+# the maximum number of parity bytes per block; at least one byte of each block must be data
+MAX_SYMBOLS = FIELD_SIZE - 1
+
+
+def _tables():
+    exp = np.zeros(2 * FIELD_SIZE, dtype=np.uint8)
+    log = np.zeros(256, dtype=np.int64)
+    value = 1
+    for power in range(FIELD_SIZE):
+        exp[power] = value
+        log[value] = power
+        value <<= 1
+        if value & 0x100:
+            value ^= _PRIMITIVE
+    exp[FIELD_SIZE:] = exp[:FIELD_SIZE]
+    # the product of every pair of field elements, so that multiplying arrays is a single lookup
+    mul = exp[(log[:, None] + log[None, :]) % FIELD_SIZE]
+    mul[0, :] = 0
+    mul[:, 0] = 0
+    inverse = exp[(FIELD_SIZE - log) % FIELD_SIZE]
+    inverse[0] = 0
+    return exp, log, mul, inverse
+
+
+EXP, LOG, MUL, INVERSE = _tables()
+
+
+def check_symbols(symbols):
+    if not 1 <= symbols <= MAX_SYMBOLS:
+        raise ValueError("The number of parity bytes per block must be between 1 and " + str(MAX_SYMBOLS) +
+                         "; got " + str(symbols))
+
+
+@lru_cache(maxsize=None)
+def _generator(symbols):
+    """Returns the generator polynomial (x - a^0)(x - a^1)...(x - a^(symbols - 1)), highest degree first"""
+    generator = np.ones(1, dtype=np.uint8)
+    for power in range(symbols):
+        shifted = np.append(generator, 0)
+        shifted[1:] ^= MUL[generator, EXP[power]]
+        generator = shifted
+    return generator
+
+
+def layout(length, symbols):
+    """Returns (blocks, data bytes per block) for a message of 'length' bytes. The data is spread evenly over the
+    fewest blocks that hold it, so at most blocks - 1 bytes of padding are added."""
+    blocks = max(-(-length // (FIELD_SIZE - symbols)), 1)
+    return blocks, -(-length // blocks)
+
+
+def encoded_size(length, symbols):
+    """Returns the number of bytes a message of 'length' bytes takes once encoded"""
+    blocks, data_bytes = layout(length, symbols)
+    return blocks * (data_bytes + symbols)
+
+
+def max_length(size, symbols):
+    """Returns the longest message that takes no more than 'size' bytes once encoded, or -1 if there is none"""
+    low, high = -1, size
+    while low < high:
+        middle = (low + high + 1) // 2
+        if encoded_size(middle, symbols) <= size:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+def _encode_blocks(data, symbols):
+    """Appends parity to each row of the (blocks, k) array 'data'; the division by the generator runs down the
+    columns, so it takes k steps however many blocks there are"""
+    feedback_table = MUL[:, _generator(symbols)[1:]]
+    parity = np.zeros((len(data), symbols), dtype=np.uint8)
+    for column in data.T:
+        feedback = column ^ parity[:, 0]
+        parity = np.concatenate([parity[:, 1:], np.zeros((len(data), 1), dtype=np.uint8)], axis=1)
+        parity ^= feedback_table[feedback]
+    return np.concatenate([data, parity], axis=1)
+
+
+def _syndromes(codewords, symbols):
+    """Evaluates each codeword (one per row, highest degree first) at a^0 ... a^(symbols - 1); all zero means the
+    codeword is intact"""
+    powers = MUL[:, EXP[:symbols]]
+    columns = np.arange(symbols)
+    syndromes = np.zeros((len(codewords), symbols), dtype=np.uint8)
+    for column in codewords.T:
+        syndromes = powers[syndromes, columns] ^ column[:, None]
+    return syndromes
+
+
+def _locators(syndromes):
+    """Berlekamp-Massey, run on every row of syndromes at once. Returns (error locator polynomials, lowest degree
+    first, and their degrees)"""
+    count, symbols = syndromes.shape
+    rows = np.arange(count)[:, None]
+    degrees = np.arange(symbols + 1)[None, :]
+    locator = np.zeros((count, symbols + 1), dtype=np.uint8)
+    locator[:, 0] = 1
+    previous = locator.copy()
+    length = np.zeros(count, dtype=np.int64)
+    shift = np.ones(count, dtype=np.int64)
+    last = np.ones(count, dtype=np.uint8)
+    for step in range(symbols):
+        discrepancy = syndromes[:, step].copy()
+        if step:
+            terms = MUL[locator[:, 1:step + 1], syndromes[:, step - 1::-1]]
+            discrepancy ^= np.bitwise_xor.reduce(terms, axis=1)
+        scale = MUL[discrepancy, INVERSE[last]]
+        source = degrees - shift[:, None]
+        shifted = np.where(source >= 0, previous[rows, np.maximum(source, 0)], 0).astype(np.uint8)
+        updated = locator ^ MUL[scale[:, None], shifted]
+        changed = discrepancy != 0
+        grow = changed & (2 * length <= step)
+        previous = np.where(grow[:, None], locator, previous)
+        last = np.where(grow, discrepancy, last)
+        length = np.where(grow, step + 1 - length, length)
+        shift = np.where(grow, 1, shift + 1)
+        locator = np.where(changed[:, None], updated, locator)
+    return locator, length
+
+
+def _evaluate(polynomials, points):
+    """Evaluates polynomials (lowest degree first, one per row) at the given points, broadcasting rows against
+    points"""
+    values = np.zeros(np.broadcast_shapes(polynomials.shape[:-1] + (1,), points.shape), dtype=np.uint8)
+    for degree in range(polynomials.shape[-1] - 1, -1, -1):
+        values = MUL[values, points] ^ polynomials[..., degree:degree + 1]
+    return values
+
+
+def _correct(codewords, syndromes):
+    """Repairs damaged codewords in place. Returns (number of bytes corrected, boolean array of codewords that could
+    not be repaired)"""
+    count, size = codewords.shape
+    symbols = syndromes.shape[1]
+    locator, length = _locators(syndromes)
+
+    # Chien search: the byte at index i has degree size - 1 - i and is wrong if the locator has a root at its inverse
+    inverse_points = EXP[(FIELD_SIZE - (size - 1 - np.arange(size))) % FIELD_SIZE]
+    errors = _evaluate(locator, inverse_points[None, :]) == 0
+    failed = (errors.sum(axis=1) != length) | (2 * length > symbols)
+    errors &= ~failed[:, None]
+
+    # Forney: the error magnitude is X * omega(1 / X) / locator'(1 / X), where omega = syndromes * locator mod x^n
+    omega = np.zeros((count, symbols), dtype=np.uint8)
+    for degree in range(symbols):
+        omega[:, degree:] ^= MUL[locator[:, degree:degree + 1], syndromes[:, :symbols - degree]]
+    # in characteristic 2 the formal derivative keeps only the odd powers, each moved down one degree
+    derivative = np.zeros((count, symbols), dtype=np.uint8)
+    derivative[:, 0::2] = locator[:, 1::2]
+
+    blocks, positions = np.nonzero(errors)
+    points = inverse_points[positions]
+    numerators = _evaluate(omega[blocks], points[:, None])[:, 0]
+    denominators = _evaluate(derivative[blocks], points[:, None])[:, 0]
+    failed[blocks[denominators == 0]] = True
+    magnitudes = MUL[MUL[INVERSE[points], numerators], INVERSE[denominators]]
+    keep = ~failed[blocks]
+    codewords[blocks[keep], positions[keep]] ^= magnitudes[keep]
+
+    # a correction can land on another codeword when there were too many errors; check again
+    repaired = np.flatnonzero(~failed)
+    if len(repaired):
+        failed[repaired] = _syndromes(codewords[repaired], symbols).any(axis=1)
+    return int(keep.sum()), failed
+
+
+def encode(data, symbols):
+    """
+    encode(data, symbols)
+    Adds 'symbols' parity bytes to every block of a message and interleaves the blocks.
+
+    :param data:    a bytes-like object
+    :param symbols: parity bytes per block (1-254); up to symbols / 2 wrong bytes per block can be corrected
+    :return:        bytes, encoded_size(len(data), symbols) long
+    """
+
+    check_symbols(symbols)
+    data = np.frombuffer(data, dtype=np.uint8)
+    blocks, data_bytes = layout(len(data), symbols)
+    padded = np.zeros(blocks * data_bytes, dtype=np.uint8)
+    padded[:len(data)] = data
+    codewords = _encode_blocks(padded.reshape(blocks, data_bytes), symbols)
+    return codewords.T.tobytes()
+
+
+def decode(data, length, symbols, repair=True):
+    """
+    decode(data, length, symbols, repair)
+    Undoes encode(), repairing the blocks that have been damaged.
+
+    :param data:    the encoded message, as a bytes-like object
+    :param length:  the length of the message before it was encoded
+    :param symbols: parity bytes per block
+    :param repair:  if False, damaged blocks are not repaired and raise ValueError; this only checks the parity
+    :return:        (the message as bytes, number of bytes corrected); raises ValueError if some block is damaged
+                    beyond repair
+    """
+
+    check_symbols(symbols)
+    blocks, data_bytes = layout(length, symbols)
+    if len(data) != blocks * (data_bytes + symbols):
+        raise ValueError("The encoded message is " + str(len(data)) + " bytes; expected " +
+                         str(blocks * (data_bytes + symbols)))
+    codewords = np.frombuffer(data, dtype=np.uint8).reshape(data_bytes + symbols, blocks).T.copy()
+    # the code is systematic, so a block is intact exactly when encoding its data again gives the same parity, and
+    # that is cheaper than computing the syndromes of every block
+    parity = _encode_blocks(codewords[:, :data_bytes], symbols)[:, data_bytes:]
+    damaged = np.flatnonzero((parity != codewords[:, data_bytes:]).any(axis=1))
+    corrected = 0
+    if len(damaged) and not repair:
+        raise ValueError(str(len(damaged)) + " of " + str(blocks) + " error correction blocks are damaged")
+    if len(damaged):
+        repaired = codewords[damaged]
+        corrected, failed = _correct(repaired, _syndromes(repaired, symbols))
+        if failed.any():
+            raise ValueError(str(int(failed.sum())) + " of " + str(blocks) + " error correction blocks are damaged "
+                             "beyond repair")
+        codewords[damaged] = repaired
+    return codewords[:, :data_bytes].reshape(-1)[:length].tobytes(), corrected
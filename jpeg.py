@@ -1,4 +1,49 @@
+import array
+import re
+import struct
+from collections import namedtuple
+
+import numpy as np
+
 import binaryIO
+from metrics import get_logger
+
+logger = get_logger("jpeg")
+
+# Marker codes (the byte following 0xFF)
+SOI = 0xD8
+EOI = 0xD9
+SOS = 0xDA
+DQT = 0xDB
+DRI = 0xDD
+DHT = 0xC4
+COM = 0xFE
+APP0 = 0xE0
+RST0 = 0xD0
+TEM = 0x01
+# 0xFF00 is byte stuffing and never a marker, so 0x00 marks the entropy-coded data that follows each SOS segment
+ECS = 0x00
+
+# Frame types whose scans are baseline or extended sequential Huffman coding, which is what decode_coefficients reads
+SEQUENTIAL_HUFFMAN_FRAMES = (0xC0, 0xC1)
+
+# Markers that stand alone, without a length field
+_STANDALONE_MARKERS = {SOI, EOI, TEM} | set(range(RST0, RST0 + 8))
+
+# The end of entropy-coded data is the first 0xFF that is not stuffing (0xFF00) or a restart marker
+_SCAN_END = re.compile(rb"\xFF[^\x00\xD0-\xD7]")
+
+# offset and length describe the segment's data, after the marker and length field
+Segment = namedtuple("Segment", ["marker", "offset", "length"])
+
+Component = namedtuple("Component", ["id", "h", "v", "tq"])
+Frame = namedtuple("Frame", ["marker", "precision", "height", "width", "components"])
+
+# An entropy-coded segment with its byte stuffing removed: 'data' holds the restart intervals back to back, each
+# starting on a byte boundary; 'interval_ends' are the byte offsets where each interval ends in 'data', and 'markers'
+# are the restart markers that followed each interval except the last in the original file
+Scan = namedtuple("Scan", ["segment", "data", "interval_ends", "markers"])
+
 
 class InvalidFormatError(Exception):
     def __init__(self, message):
@@ -6,8 +51,294 @@ class InvalidFormatError(Exception):
         self.message = message
 
 
+def marker_name(marker):
+    """Returns the conventional name of a marker code, e.g. 'SOF0', 'APP1' or 'DHT'"""
+    if marker == ECS:
+        return "ECS"
+    elif APP0 <= marker <= APP0 + 15:
+        return "APP" + str(marker - APP0)
+    elif RST0 <= marker <= RST0 + 7:
+        return "RST" + str(marker - RST0)
+    elif 0xC0 <= marker <= 0xCF and marker not in (DHT, 0xC8, 0xCC):
+        return "SOF" + str(marker - 0xC0)
+    names = {SOI: "SOI", EOI: "EOI", SOS: "SOS", DQT: "DQT", DRI: "DRI", DHT: "DHT", COM: "COM", TEM: "TEM",
+             0xC8: "JPG", 0xCC: "DAC", 0xDC: "DNL", 0xDE: "DHP", 0xDF: "EXP"}
+    return names.get(marker, "0x%02X" % marker)
+
+
+def index_segments(buffer):
+    """
+    index_segments(buffer)
+    Walks every marker in a JPEG file once, from SOI to EOI, and records where each segment is without copying any
+    of it. Each SOS segment is followed by an ECS entry covering its entropy-coded data (including any restart
+    markers).
+
+    :param buffer:  a bytes-like object holding the whole file, e.g. a BinaryReader's buffer
+    :return:        list:Segment
+    """
+
+    if bytes(buffer[:2]) != b"\xFF\xD8":
+        raise InvalidFormatError("Invalid bytes for SOI")
+    segments = [Segment(SOI, 2, 0)]
+    position = 2
+    size = len(buffer)
+    while True:
+        if position >= size or buffer[position] != 0xFF:
+            raise InvalidFormatError("Expected a marker at offset " + str(position))
+        # any number of 0xFF fill bytes may precede a marker
+        while position < size and buffer[position] == 0xFF:
+            position += 1
+        if position >= size:
+            raise InvalidFormatError("File ends inside a marker")
+        marker = buffer[position]
+        position += 1
+
+        if marker in _STANDALONE_MARKERS:
+            segments.append(Segment(marker, position, 0))
+            if marker == EOI:
+                return segments
+            continue
+
+        if position + 2 > size:
+            raise InvalidFormatError("File ends inside the " + marker_name(marker) + " length field")
+        length = (buffer[position] << 8 | buffer[position + 1]) - 2
+        if length < 0 or position + 2 + length > size:
+            raise InvalidFormatError("Invalid length for " + marker_name(marker) + " segment at " + str(position))
+        segments.append(Segment(marker, position + 2, length))
+        position += 2 + length
+
+        if marker == SOS:
+            end = _SCAN_END.search(buffer, position)
+            if end is None:
+                raise InvalidFormatError("Entropy-coded data does not end with a marker")
+            segments.append(Segment(ECS, position, end.start() - position))
+            position = end.start()
+
+
+def parse_frame(data, marker):
+    """Parses the data of an SOFn segment into a Frame"""
+    precision, height, width, count = struct.unpack_from(">BHHB", data, 0)
+    components = []
+    for index in range(count):
+        component_id, sampling, tq = struct.unpack_from(">BBB", data, 6 + 3 * index)
+        components.append(Component(component_id, sampling >> 4, sampling & 0x0F, tq))
+    if height == 0:
+        raise InvalidFormatError("Images that define their height in a DNL segment are not supported")
+    return Frame(marker, precision, height, width, components)
+
+
+def build_huffman_lookup(counts, symbols):
+    """
+    build_huffman_lookup(counts, symbols)
+    Builds a decoding table for a Huffman table from a DHT segment. The table is indexed by the next 16 bits of the
+    stream and each entry holds (code length << 8 | symbol), so a symbol is decoded with a single lookup. An entry of
+    0 means the bits do not start with a valid code.
+
+    :param counts:  the number of codes of each length from 1 to 16
+    :param symbols: the symbols, in order of increasing code length
+    :return:        array of 65536 unsigned shorts
+    """
+
+    lookup = np.zeros(1 << 16, dtype=np.uint16)
+    code = 0
+    position = 0
+    for length in range(1, 17):
+        for _ in range(counts[length - 1]):
+            shift = 16 - length
+            lookup[code << shift:(code + 1) << shift] = length << 8 | symbols[position]
+            code += 1
+            position += 1
+        code <<= 1
+    return array.array("H", lookup.tobytes())
+
+
+def parse_huffman_tables(data):
+    """Parses the data of a DHT segment into a dict of {(table class, table id): lookup}"""
+    tables = {}
+    position = 0
+    while position < len(data):
+        table_class, table_id = data[position] >> 4, data[position] & 0x0F
+        counts = bytes(data[position + 1:position + 17])
+        symbols = bytes(data[position + 17:position + 17 + sum(counts)])
+        tables[(table_class, table_id)] = build_huffman_lookup(counts, symbols)
+        position += 17 + sum(counts)
+    return tables
+
+
+def destuff(data):
+    """
+    destuff(data)
+    Removes byte stuffing (0xFF00 -> 0xFF) from entropy-coded data and splits it at its restart markers.
+
+    :param data:    the bytes of an ECS segment
+    :return:        (ndarray of the destuffed intervals back to back, list of interval end offsets, list of markers)
+    """
+
+    raw = np.frombuffer(data, dtype=np.uint8)
+    marker_at = np.flatnonzero(raw[:-1] == 0xFF)
+    following = raw[marker_at + 1]
+    keep = np.ones(len(raw), dtype=bool)
+    keep[marker_at[following == 0x00] + 1] = False     # the stuffed zeros
+    restarts = marker_at[(following >= RST0) & (following <= RST0 + 7)]
+    keep[restarts] = False
+    keep[restarts + 1] = False
+
+    # the end of each interval, in destuffed bytes, is the number of kept bytes before its restart marker
+    kept_before = np.cumsum(keep)
+    interval_ends = [int(kept_before[index - 1]) if index else 0 for index in restarts] + [int(kept_before[-1])] \
+        if len(raw) else [0]
+    markers = [bytes(raw[index:index + 2]) for index in restarts]
+    return raw[keep], interval_ends, markers
+
+
+def stuff(data):
+    """The inverse of destuff for a single interval: inserts a 0x00 after every 0xFF"""
+    return np.insert(data, np.flatnonzero(data == 0xFF) + 1, 0).tobytes()
+
+
+def _bit_windows(data):
+    """Returns an array holding, for every byte offset, the 32 bits starting at that byte; the bit reader peeks at
+    the stream with one lookup into it"""
+    padded = np.concatenate([data, np.zeros(8, dtype=np.uint8)]).astype(np.uint32)
+    windows = padded[:-3] << 24 | padded[1:-2] << 16 | padded[2:-1] << 8 | padded[3:]
+    return array.array("I", windows.astype(np.uint32).tobytes())
+
+
+class CoefficientData:
+    """
+    The quantized DCT coefficients of a sequential Huffman-coded JPEG, as produced by JPEG.decode_coefficients.
+
+    coefficients maps each component id to an int16 array of shape (block rows, block columns, 64) in zigzag order.
+    The AC coefficients whose magnitude is at least 2 are also listed in decoding order in ac_values, together with
+    ac_positions, the position of each one's last bit in the destuffed scan data: flipping that bit flips the least
+    significant bit of the coefficient's magnitude without changing its Huffman code, so such coefficients can be
+    changed without re-encoding the scan.
+    """
+
+    def __init__(self, frame, coefficients, ac_positions, ac_values, scans):
+        self.frame = frame
+        self.coefficients = coefficients
+        self.ac_positions = ac_positions
+        self.ac_values = ac_values
+        self.scans = scans
+
+
+def _decode_scan(header, scan, bit_base, frame, shapes, component_base, tables, restart_interval, geometry,
+                 blocks, ac, max_ac):
+    """Decodes one scan, appending every non-zero coefficient to 'blocks' and every AC coefficient of magnitude 2 or
+    more to 'ac'. Returns True if decoding stopped early because max_ac was reached."""
+    mcus_x, mcus_y, h_max, v_max = geometry
+    record = blocks is not None
+    block_ids, indexes, values = blocks if record else (None, None, None)
+    ac_positions, ac_values = ac
+    components = {component.id: component for component in frame.components}
+
+    count = header[0]
+    scan_components = []
+    for index in range(count):
+        component = components[header[1 + 2 * index]]
+        selectors = header[2 + 2 * index]
+        try:
+            dc_table, ac_table = tables[(0, selectors >> 4)], tables[(1, selectors & 0x0F)]
+        except KeyError:
+            raise InvalidFormatError("Scan uses a Huffman table that has not been defined")
+        scan_components.append((component, dc_table, ac_table))
+    if tuple(header[1 + 2 * count:4 + 2 * count]) != (0, 63, 0):
+        raise InvalidFormatError("Only sequential scans can be decoded")
+
+    # the blocks of each MCU: (component index, dc table, ac table, first block id, row offset, column offset, rows,
+    # columns), where rows and columns are the dimensions of the component's block grid
+    if count == 1:
+        # a non-interleaved scan codes each block of the component on its own, covering only the blocks that hold
+        # part of the image rather than the whole MCU grid
+        component, dc_table, ac_table = scan_components[0]
+        columns = -(-(-(-frame.width * component.h // h_max)) // 8)
+        rows = -(-(-(-frame.height * component.v // v_max)) // 8)
+        layout = [(0, dc_table, ac_table, component_base[component.id], 0, 0)]
+        mcu_positions = [(row, column) for row in range(rows) for column in range(columns)]
+    else:
+        layout = []
+        for index, (component, dc_table, ac_table) in enumerate(scan_components):
+            for dy in range(component.v):
+                for dx in range(component.h):
+                    layout.append((index, dc_table, ac_table, component_base[component.id], dy, dx))
+        mcu_positions = [(row, column) for row in range(mcus_y) for column in range(mcus_x)]
+    strides = []
+    scale = []
+    for component, _, _ in scan_components:
+        strides.append(shapes[component.id][1])
+        scale.append((component.v, component.h) if count > 1 else (1, 1))
+
+    windows = _bit_windows(scan.data)
+    interval_length = restart_interval or len(mcu_positions)
+    interval_start = 0
+    for interval, first_mcu in enumerate(range(0, len(mcu_positions), interval_length)):
+        if interval >= len(scan.interval_ends):
+            raise InvalidFormatError("Scan has fewer restart intervals than expected")
+        predictions = [0] * count
+        p = interval_start * 8
+        for mcu_row, mcu_column in mcu_positions[first_mcu:first_mcu + interval_length]:
+            for index, dc_table, ac_table, block_base, dy, dx in layout:
+                v_scale, h_scale = scale[index]
+                block = block_base + (mcu_row * v_scale + dy) * strides[index] + mcu_column * h_scale + dx
+
+                entry = dc_table[(windows[p >> 3] >> (16 - (p & 7))) & 0xFFFF]
+                if not entry:
+                    raise InvalidFormatError("Invalid Huffman code in scan")
+                p += entry >> 8
+                size = entry & 0xFF
+                if size:
+                    value = (windows[p >> 3] >> (32 - size - (p & 7))) & ((1 << size) - 1)
+                    p += size
+                    if value < 1 << (size - 1):
+                        value -= (1 << size) - 1
+                    predictions[index] += value
+                if record and predictions[index]:
+                    block_ids.append(block)
+                    indexes.append(0)
+                    values.append(predictions[index])
+
+                k = 1
+                while k < 64:
+                    entry = ac_table[(windows[p >> 3] >> (16 - (p & 7))) & 0xFFFF]
+                    if not entry:
+                        raise InvalidFormatError("Invalid Huffman code in scan")
+                    p += entry >> 8
+                    size = entry & 0x0F
+                    if not size:
+                        if entry & 0xF0 == 0xF0:    # ZRL, a run of 16 zeros
+                            k += 16
+                            continue
+                        break                       # EOB
+                    k += (entry >> 4) & 0x0F
+                    if k > 63:
+                        raise InvalidFormatError("Coefficient index out of range in scan")
+                    value = (windows[p >> 3] >> (32 - size - (p & 7))) & ((1 << size) - 1)
+                    p += size
+                    if value < 1 << (size - 1):
+                        value -= (1 << size) - 1
+                    if record:
+                        block_ids.append(block)
+                        indexes.append(k)
+                        values.append(value)
+                    if value >= 2 or value <= -2:
+                        ac_positions.append(bit_base + p - 1)
+                        ac_values.append(value)
+                    k += 1
+            if max_ac is not None and len(ac_values) >= max_ac:
+                return True
+        if p > scan.interval_ends[interval] * 8:
+            raise InvalidFormatError("Restart interval is shorter than its data")
+        interval_start = scan.interval_ends[interval]
+    return False
+
+
 class JPEG:
-    """Contains information for a JPEG file in JFIF format"""
+    """
+    Contains information for a JPEG file in JFIF format.
+    The file is memory-mapped and indexed once; segments are only read when asked for, as slices of the mapping.
+    Use it as a context manager (or call close()) to release the file.
+    """
 
     def __init__(self, filepath):
         # JPEG class data
@@ -25,21 +356,139 @@ class JPEG:
         self.y_thumb = 0    # vert. thumbnail pixel count
         self.thumbnail_RGB = []     # uncompressed RGB thumbnail
 
-        # initialization routine
-        self.img = open(filepath, "rb")
-        self.read_jpeg()
+        self.segments = []  # every segment in the file, in order
+
+        # initialization routine; the whole file is mapped into memory and parsed from there
+        self.img = binaryIO.BinaryReader(filepath)
+        try:
+            self.read_jpeg()
+        except Exception:
+            self.close()
+            raise
 
         return
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Unmaps the file; segment data returned earlier must not be used afterwards"""
+        self.img.close()
+
+    def find(self, marker):
+        """Returns every indexed segment with the given marker code"""
+        return [segment for segment in self.segments if segment.marker == marker]
+
+    def segment_data(self, segment):
+        """Returns the data of a segment as a zero-copy slice of the mapped file"""
+        return self.img.slice(segment.offset, segment.length)
+
+    def frame(self):
+        """Returns the Frame described by the file's SOFn segment"""
+        for segment in self.segments:
+            if 0xC0 <= segment.marker <= 0xCF and segment.marker not in (DHT, 0xC8, 0xCC):
+                return parse_frame(self.segment_data(segment), segment.marker)
+        raise InvalidFormatError("No SOF segment found")
+
+    def decode_coefficients(self, max_ac=None, blocks=True):
+        """
+        decode_coefficients(self, max_ac, blocks)
+        Huffman-decodes every scan into quantized DCT coefficients, without dequantizing or transforming them. Only
+        baseline and extended sequential Huffman-coded files are supported.
+
+        :param max_ac:  stop decoding once this many AC coefficients of magnitude 2 or more have been found; the
+                        coefficient arrays are then only partly filled
+        :param blocks:  if False, only the AC coefficient lists are collected and the coefficient arrays are left
+                        empty, which is faster when the blocks themselves are not needed
+        :return:        CoefficientData
+        """
+
+        frame = self.frame()
+        if frame.marker not in SEQUENTIAL_HUFFMAN_FRAMES:
+            raise InvalidFormatError(marker_name(frame.marker) + " images are not supported; only baseline and "
+                                     "extended sequential Huffman coding can be decoded")
+        h_max = max(component.h for component in frame.components)
+        v_max = max(component.v for component in frame.components)
+        mcus_x = -(-frame.width // (8 * h_max))
+        mcus_y = -(-frame.height // (8 * v_max))
+        shapes = {component.id: (mcus_y * component.v, mcus_x * component.h) for component in frame.components}
+
+        tables = {}
+        restart_interval = 0
+        scans = []
+        block_ids, indexes, values = [], [], []
+        ac_positions, ac_values = [], []
+        component_base = {}
+        base = 0
+        for component in frame.components:
+            component_base[component.id] = base
+            base += shapes[component.id][0] * shapes[component.id][1]
+
+        segments = iter(self.segments)
+        for segment in segments:
+            if segment.marker == DHT:
+                tables.update(parse_huffman_tables(self.segment_data(segment)))
+            elif segment.marker == DRI:
+                restart_interval = struct.unpack_from(">H", self.segment_data(segment), 0)[0]
+            elif segment.marker == SOS:
+                header = bytes(self.segment_data(segment))
+                ecs = next(segments)
+                data, interval_ends, markers = destuff(self.segment_data(ecs))
+                scan = Scan(ecs, data, interval_ends, markers)
+                bit_base = sum(len(previous.data) for previous in scans) * 8
+                scans.append(scan)
+                done = _decode_scan(header, scan, bit_base, frame, shapes, component_base, tables, restart_interval,
+                                    (mcus_x, mcus_y, h_max, v_max), (block_ids, indexes, values) if blocks else None,
+                                    (ac_positions, ac_values), max_ac)
+                if done:
+                    break
+
+        flat = np.zeros((base, 64), dtype=np.int16)
+        flat[np.array(block_ids, dtype=np.int64), np.array(indexes, dtype=np.int64)] = values
+        coefficients = {}
+        for component in frame.components:
+            rows, columns = shapes[component.id]
+            start = component_base[component.id]
+            coefficients[component.id] = flat[start:start + rows * columns].reshape(rows, columns, 64)
+        return CoefficientData(frame, coefficients, np.array(ac_positions, dtype=np.int64),
+                               np.array(ac_values, dtype=np.int16), scans)
+
+    def rebuild(self, scans):
+        """
+        rebuild(self, scans)
+        Returns the bytes of a new file identical to this one except for the entropy-coded data of the given scans,
+        whose destuffed data may have been modified in place (keeping its length). Every other segment is copied
+        through unchanged.
+
+        :param scans:   list of Scan, as found in CoefficientData.scans
+        :return:        bytes
+        """
+
+        parts = []
+        position = 0
+        for scan in scans:
+            parts.append(self.img.slice(position, scan.segment.offset - position))
+            start = 0
+            for index, end in enumerate(scan.interval_ends):
+                parts.append(stuff(scan.data[start:end]))
+                if index < len(scan.markers):
+                    parts.append(scan.markers[index])
+                start = end
+            position = scan.segment.offset + scan.segment.length
+        parts.append(self.img.slice(position, len(self.img) - position))
+        return b"".join(parts)
+
     def read_jpeg(self):
-        """Opens a jpeg file and reads it into the jpeg obect"""
-        soi = binaryIO.read_bytes(self.img, 2)
-        print(soi)
-        if soi == [b'\xFF', b'\xD8']:
-            print("valid SOI")
+        """Indexes the segments of the jpeg file and reads the APP0 segment, if there is one, into the jpeg object"""
+        self.segments = index_segments(self.img.buffer)
+        logger.debug("valid SOI")
+        if self.segments[1].marker == APP0:
+            # read_APP0 expects to start at the APP0 marker
+            self.img.seek(self.segments[1].offset - 4)
             self.read_APP0()
-        else:
-            raise InvalidFormatError("Invalid bytes for SOI")
         return
 
     def read_APP0(self):
@@ -51,49 +500,34 @@ class JPEG:
         """
 
         # get the APP0 marker "FF E0"
-        APP0_marker = binaryIO.read_bytes(self.img, 2)
-        if APP0_marker == [b'\xFF', b'\xE0']:
+        APP0_marker = self.img.read_bytes(2)
+        if APP0_marker == b'\xFF\xE0':
             # valid APP0; begin reading APP0
-            APP0_length = binaryIO.readU16(self.img)    # length excluding marker bytes
-            identifier = binaryIO.read_bytes(self.img, 5)
+            APP0_length = self.img.readU16()    # length excluding marker bytes
+            identifier = self.img.read_bytes(5)
             length_counter = 7  # track our length
             # check to ensure identifier was valid
-            if identifier == [b'J', b'F', b'I', b'F', b'\00']:
-                #   todo: continue reading APP0 section
-                version = binaryIO.read_bytes(self.img, 2)
-                length_counter += 2
-                self.jfif_version[0] = int.from_bytes(version[0], "big")    # get the version
-                self.jfif_version[1] = int.from_bytes(version[1], "big")
-
-                self.density_units = binaryIO.readU8(self.img)
-                length_counter += 1
+            if identifier == b'JFIF\00':
+                # version, density units, x and y density, and thumbnail size are read in one go
+                major, minor, self.density_units, self.x_density, self.y_density, self.x_thumb, self.y_thumb = \
+                    self.img.read_struct("BBBHHBB")
+                self.jfif_version[0] = major    # get the version
+                self.jfif_version[1] = minor
+                length_counter += 9
 
                 if self.density_units == 0:
-                    print("no units")
+                    logger.debug("no units")
                 elif self.density_units == 1:
-                    print("pixels per inch")
+                    logger.debug("pixels per inch")
                 elif self.density_units == 2:
-                    print("pixels per centimeter")
+                    logger.debug("pixels per centimeter")
                 else:
                     raise ValueError("Invalid density unit specifier in APP0")
 
-                self.x_density = binaryIO.readU16(self.img)
-                self.y_density = binaryIO.readU16(self.img)
-                length_counter += 4
-
-                self.x_thumb = binaryIO.readU8(self.img)
-                self.y_thumb = binaryIO.readU8(self.img)
-                length_counter += 2
-
-                self.thumbnail_RGB = []
-                for i in range(length_counter, APP0_length, 3):
-                    red = binaryIO.readU8(self.img)
-                    green = binaryIO.readU8(self.img)
-                    blue = binaryIO.readU8(self.img)
-                    self.thumbnail_RGB.append((red, green, blue))
-
-                # note the length won't increment the last time, even though it reads three bytes
-                length_counter += 3 if (self.thumbnail_RGB.__len__() > 0) else 0
+                # the thumbnail is read as a single slice and split into RGB triples
+                thumbnail = bytes(self.img.read_bytes(max(APP0_length - length_counter, 0)))
+                self.thumbnail_RGB = list(zip(thumbnail[0::3], thumbnail[1::3], thumbnail[2::3]))
+                length_counter += len(thumbnail)
 
                 # make sure the thumbnail_RGB is as long as we expect
                 # it should be (3 * x_thumb * y_thumb) bytes, or x_thumb * y_thumb RGB pixels
@@ -102,14 +536,14 @@ class JPEG:
 
                 # if things went smoothly
                 if success:
-                    print("successfully read APP0 segment")
+                    logger.debug("successfully read APP0 segment")
                 else:
                     if (length_counter != APP0_length):
                         raise Exception("Section longer than indicated by APP0_length")
                     else:
-                        print("Expected size:", self.x_thumb * self.y_thumb, "pixels")
-                        print("Actual size:", self.thumbnail_RGB.__len__(), "pixels")
-                        raise Exception("RGB image data was not the expected size")
+                        raise Exception("RGB image data was not the expected size; expected " +
+                                        str(self.x_thumb * self.y_thumb) + " pixels, got " +
+                                        str(self.thumbnail_RGB.__len__()))
             else:
                 raise InvalidFormatError("Invalid format identifier in APP0; expected null-terminated 'J','F','I','F'")
         else:
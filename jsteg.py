@@ -0,0 +1,151 @@
+"""
+
+jsteg.py
+
+The algorithm for JPEG steganography in the quantized DCT coefficients (JSteg)
+
+Message bits replace the least significant bit of the magnitude of every AC coefficient whose magnitude is at least 2,
+in the order the coefficients appear in the scans. Those coefficients never become 0 or +/-1, so the Huffman codes
+of the scan stay the same and only the last bit of each coefficient's appended bits changes: the file is rewritten
+by flipping bits in the entropy-coded data, with no decompression or recompression of the image.
+
+The message is preceded by the same 5 header bytes as LSB: 4 bytes of big-endian length and a flags byte holding
+is_string.
+
+"""
+
+import numpy as np
+
+import jpeg
+from metrics import get_logger
+
+logger = get_logger("jsteg")
+
+_HEADER_SIZE = 5
+_STRING_FLAG = 0b01000000
+
+
+def _open(jpeg_file):
+    """Returns (JPEG object, whether we opened it and must close it)"""
+    if isinstance(jpeg_file, jpeg.JPEG):
+        return jpeg_file, False
+    return jpeg.JPEG(jpeg_file), True
+
+
+def capacity(jpeg_file):
+    """
+    capacity(jpeg_file)
+    Returns the number of message bytes a JPEG file can hold. The whole scan has to be decoded to count the usable
+    coefficients.
+
+    :param jpeg_file:   a jpeg.JPEG object or a path to a JPEG file
+    :return:            int
+    """
+
+    image, opened = _open(jpeg_file)
+    try:
+        return max(len(image.decode_coefficients(blocks=False).ac_values) // 8 - _HEADER_SIZE, 0)
+    finally:
+        if opened:
+            image.close()
+
+
+def hide_message(jpeg_file, message):
+    """
+    hide_message(jpeg_file, message)
+    Puts 'message' in a JPEG file. If the file does not have enough usable coefficients, logs an error and returns
+    None. Only the coefficients that hold message bits are decoded.
+
+    :param jpeg_file:   a jpeg.JPEG object or a path to a JPEG file; the file is not modified
+    :param message:     a str, an int or a bytes-like object
+    :return:            the bytes of the new JPEG file, or None if the message is too large
+    """
+
+    if type(message) is str:
+        message = bytes(message, 'utf-8')
+        is_string = True
+    elif type(message) is int:
+        message = message.to_bytes(message.__sizeof__(), byteorder="big", signed=True)
+        is_string = False
+    else:
+        message = bytes(message)
+        is_string = False
+
+    header = len(message).to_bytes(4, byteorder="big", signed=False) + bytes([_STRING_FLAG if is_string else 0])
+    bits = np.unpackbits(np.frombuffer(header + message, dtype=np.uint8))
+
+    image, opened = _open(jpeg_file)
+    try:
+        coefficients = image.decode_coefficients(max_ac=len(bits), blocks=False)
+        if len(coefficients.ac_values) < len(bits):
+            logger.error("message is too large; maximum size is %d bytes; your message is %d bytes",
+                         max(len(coefficients.ac_values) // 8 - _HEADER_SIZE, 0), len(message))
+            return None
+
+        # only coefficients whose magnitude has the wrong parity need their last bit flipped
+        current = np.abs(coefficients.ac_values[:len(bits)]).astype(np.uint8) & 1
+        positions = coefficients.ac_positions[:len(bits)][current != bits]
+
+        scan_start = 0
+        for scan in coefficients.scans:
+            scan_end = scan_start + len(scan.data) * 8
+            local = positions[(positions >= scan_start) & (positions < scan_end)] - scan_start
+            np.bitwise_xor.at(scan.data, local >> 3, (0x80 >> (local & 7)).astype(np.uint8))
+            scan_start = scan_end
+        return image.rebuild(coefficients.scans)
+    finally:
+        if opened:
+            image.close()
+
+
+def _read_bits(image, count):
+    """Returns the least significant bits of the magnitudes of the first 'count' usable AC coefficients, packed into
+    bytes"""
+    values = image.decode_coefficients(max_ac=count, blocks=False).ac_values[:count]
+    if len(values) < count:
+        raise ValueError("Header claims more data than the image holds; the image does not contain a message")
+    return np.packbits(np.abs(values).astype(np.uint8) & 1).tobytes()
+
+
+def read_header(jpeg_file):
+    """
+    read_header(jpeg_file)
+    Reads only the coefficients that hold the header; the length is not checked against the capacity, which would
+    need the whole scan to be decoded.
+
+    :param jpeg_file:   a jpeg.JPEG object or a path to a JPEG file
+    :return:            (length, is_string)
+    """
+
+    image, opened = _open(jpeg_file)
+    try:
+        header = _read_bits(image, _HEADER_SIZE * 8)
+    finally:
+        if opened:
+            image.close()
+    return int.from_bytes(header[:4], byteorder="big", signed=False), (header[4] & _STRING_FLAG) != 0
+
+
+def reveal_message(jpeg_file):
+    """
+    reveal_message(jpeg_file)
+    Returns the message in a JPEG file. Decoding stops as soon as the coefficients holding the message have been
+    read.
+
+    :param jpeg_file:   a jpeg.JPEG object or a path to a JPEG file
+    :return:            str or bytearray, depending on what was hidden
+    """
+
+    image, opened = _open(jpeg_file)
+    try:
+        header = _read_bits(image, _HEADER_SIZE * 8)
+        msg_len = int.from_bytes(header[:4], byteorder="big", signed=False)
+        message = _read_bits(image, (_HEADER_SIZE + msg_len) * 8)[_HEADER_SIZE:]
+    finally:
+        if opened:
+            image.close()
+
+    if header[4] & _STRING_FLAG:
+        return str(message, encoding='utf-8')
+    else:
+        return bytearray(message)
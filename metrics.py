@@ -0,0 +1,67 @@
+"""
+metrics.py
+
+Per-call instrumentation for the steganography functions: phase timers, byte and pixel counters, and an optional
+progress callback. Pass a Metrics object to a function to have it filled in; functions that are not given one record
+nothing anywhere, and the library only ever logs through the "stegosaurus" logger, which is silent unless the
+application configures logging.
+"""
+
+import json
+import logging
+import time
+from contextlib import contextmanager
+
+# Library code logs under "stegosaurus"; a NullHandler keeps Python from printing warnings to stderr on its behalf
+logging.getLogger("stegosaurus").addHandler(logging.NullHandler())
+
+
+def get_logger(module):
+    """Returns the logger for a module of this package, e.g. get_logger("LSB") -> "stegosaurus.LSB" """
+    return logging.getLogger("stegosaurus." + module)
+
+
+class Metrics:
+    """
+    Collects timings and counts for a single call.
+
+    timers accumulate the seconds spent in each named phase (a phase entered several times, e.g. once per band of a
+    streamed image, is summed); counters accumulate named totals such as "bytes" and "pixels". If 'progress' is given
+    it is called as progress(phase, done, total) as long-running phases advance.
+    """
+
+    def __init__(self, operation=None, progress=None):
+        self.operation = operation
+        self.progress_callback = progress
+        self.timers = {}
+        self.counters = {}
+        self._start = time.perf_counter()
+
+    @contextmanager
+    def phase(self, name):
+        """Times the body of a with block as the phase 'name'"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timers[name] = self.timers.get(name, 0.0) + time.perf_counter() - start
+
+    def count(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def progress(self, phase, done, total):
+        if self.progress_callback is not None:
+            self.progress_callback(phase, done, total)
+
+    def as_dict(self):
+        """Returns the metrics as a dict of plain values"""
+        return {
+            "operation": self.operation,
+            "elapsed": time.perf_counter() - self._start,
+            "timers": dict(self.timers),
+            "counters": dict(self.counters),
+        }
+
+    def to_json(self, **kwargs):
+        """Returns the metrics as a JSON string; keyword arguments are passed to json.dumps"""
+        return json.dumps(self.as_dict(), **kwargs)
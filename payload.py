@@ -0,0 +1,194 @@
+"""
+payload.py
+
+The optional stages a message goes through before it is embedded: compression, then authenticated encryption. Which
+stages were applied is recorded in the feature flags of the extended LSB header, so that revealing undoes them without
+being told.
+
+Compression is chosen automatically: every registered compressor is tried and the smallest result is kept, unless
+none of them makes the message smaller, in which case it is stored as it is. Compressors are registered in
+COMPRESSORS under the number recorded in the header.
+
+Encryption is AES-256-GCM with a key derived from a passphrase with scrypt. The stored message is
+
+    salt (16 bytes), nonce (12 bytes), key check (4 bytes), ciphertext, tag (16 bytes)
+
+The key check is derived along with the key, so a wrong passphrase is turned away after reading 32 bytes instead of
+the whole message; the tag authenticates the ciphertext and the header bytes passed as associated data, so a
+corrupted or tampered carrier is rejected rather than returning garbage. Encryption needs the 'cryptography' package.
+"""
+
+import hashlib
+import lzma
+import os
+import zlib
+
+try:
+    from cryptography.exceptions import InvalidTag
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+except ImportError:
+    AESGCM = None
+
+# Feature flags; the low two bits hold the compressor number. ECC marks Reed-Solomon error correction, which is
+# applied last, after encryption (see ecc.py). SCATTERED is not a stage but records that the message pixels were
+# placed by a keyed permutation rather than in order (see scatter.py).
+COMPRESSION_MASK = 0b00000011
+ENCRYPTED = 0b00000100
+ECC = 0b00001000
+SCATTERED = 0b00010000
+FEATURES = COMPRESSION_MASK | ENCRYPTED | ECC | SCATTERED
+
+ZLIB = 1
+LZMA = 2
+
+# number: (name, compress, decompressor factory); decompressors are incremental so that messages can be streamed
+COMPRESSORS = {
+    ZLIB: ("zlib", lambda data: zlib.compress(data, 9), zlib.decompressobj),
+    LZMA: ("lzma", lzma.compress, lzma.LZMADecompressor),
+}
+
+_SALT_SIZE = 16
+_NONCE_SIZE = 12
+_CHECK_SIZE = 4
+_TAG_SIZE = 16
+# the part of an encrypted message needed to check the key
+KEY_CHECK_SIZE = _SALT_SIZE + _NONCE_SIZE + _CHECK_SIZE
+ENCRYPTION_OVERHEAD = KEY_CHECK_SIZE + _TAG_SIZE
+
+# scrypt cost parameters; about 50 ms and 16 MB per key derivation
+_SCRYPT_N = 1 << 14
+_SCRYPT_R = 8
+_SCRYPT_P = 1
+
+
+def compression_method(name):
+    """Returns the compressor number for a name ('zlib' or 'lzma'), 'auto' for all of them, or None for 'none'"""
+    if name in (None, "none"):
+        return None
+    if name == "auto":
+        return "auto"
+    for number, (compressor_name, _, _) in COMPRESSORS.items():
+        if compressor_name == name:
+            return number
+    raise ValueError("Unknown compression method " + str(name))
+
+
+def compress(data, method="auto"):
+    """
+    compress(data, method)
+    Compresses a message with the given compressor, or with whichever is best if 'method' is 'auto'. The message is
+    returned as it is if compressing does not make it smaller.
+
+    :param data:    a bytes-like object
+    :param method:  a key of COMPRESSORS, 'auto', or None not to compress
+    :return:        (bytes, compressor number or 0)
+    """
+
+    data = bytes(data)
+    if method is None:
+        return data, 0
+    methods = COMPRESSORS if method == "auto" else [method]
+    best, best_method = data, 0
+    for number in methods:
+        compressed = COMPRESSORS[number][1](data)
+        if len(compressed) < len(best):
+            best, best_method = compressed, number
+    return best, best_method
+
+
+class Decompressor:
+    """
+    Decompressor(number)
+    Decompresses a message incrementally with compressor 'number'. Corrupt data raises ValueError, like every other
+    problem with a message, rather than the compressor's own exception.
+    """
+
+    def __init__(self, number):
+        if number not in COMPRESSORS:
+            raise ValueError("Unknown compression method " + str(number))
+        self._decompressor = COMPRESSORS[number][2]()
+
+    def decompress(self, data):
+        try:
+            return self._decompressor.decompress(data)
+        except (zlib.error, lzma.LZMAError, EOFError) as error:
+            raise ValueError("The compressed message is corrupt: " + str(error))
+
+    def finish(self):
+        """Raises ValueError if the compressed message ended early"""
+        if not self._decompressor.eof:
+            raise ValueError("The compressed message is truncated")
+
+
+def decompressor(features):
+    """Returns a Decompressor for a message's features, or None if the message is not compressed"""
+    number = features & COMPRESSION_MASK
+    return Decompressor(number) if number else None
+
+
+def decompress(data, features):
+    """Undoes compress() for a message with the given features"""
+    inflater = decompressor(features)
+    if inflater is None:
+        return bytes(data)
+    data = inflater.decompress(data)
+    inflater.finish()
+    return data
+
+
+def _require_aead():
+    if AESGCM is None:
+        raise ImportError("Encryption requires the 'cryptography' package")
+
+
+def _derive(key, salt):
+    """Returns (AES key, key check) for a passphrase (str or bytes) and salt"""
+    if isinstance(key, str):
+        key = key.encode("utf-8")
+    derived = hashlib.scrypt(bytes(key), salt=salt, n=_SCRYPT_N, r=_SCRYPT_R, p=_SCRYPT_P, dklen=32 + _CHECK_SIZE)
+    return derived[:32], derived[32:]
+
+
+def encrypt(data, key, associated_data=b""):
+    """
+    encrypt(data, key, associated_data)
+    Encrypts and authenticates a message; 'associated_data' is authenticated but not stored.
+
+    :param data:            a bytes-like object
+    :param key:             a passphrase, as str or bytes
+    :param associated_data: bytes that must be given again to decrypt
+    :return:                bytes, ENCRYPTION_OVERHEAD longer than 'data'
+    """
+
+    _require_aead()
+    salt, nonce = os.urandom(_SALT_SIZE), os.urandom(_NONCE_SIZE)
+    aes_key, check = _derive(key, salt)
+    return salt + nonce + check + AESGCM(aes_key).encrypt(nonce, bytes(data), associated_data)
+
+
+def check_key(prefix, key):
+    """Returns the AES key for an encrypted message if 'key' is the passphrase it was encrypted with, judging from
+    its first KEY_CHECK_SIZE bytes; raises ValueError otherwise"""
+    if len(prefix) < KEY_CHECK_SIZE:
+        raise ValueError("The encrypted message is too short")
+    aes_key, check = _derive(key, bytes(prefix[:_SALT_SIZE]))
+    if check != bytes(prefix[_SALT_SIZE + _NONCE_SIZE:KEY_CHECK_SIZE]):
+        raise ValueError("The key is wrong")
+    return aes_key
+
+
+def decrypt(data, key, associated_data=b"", aes_key=None):
+    """
+    decrypt(data, key, associated_data, aes_key)
+    Undoes encrypt(); raises ValueError if the key is wrong or the message or associated data have been changed.
+    'aes_key' may be given as returned by check_key, to save deriving it again.
+    """
+
+    _require_aead()
+    if aes_key is None:
+        aes_key = check_key(data, key)
+    nonce = bytes(data[_SALT_SIZE:_SALT_SIZE + _NONCE_SIZE])
+    try:
+        return AESGCM(aes_key).decrypt(nonce, bytes(data[KEY_CHECK_SIZE:]), associated_data)
+    except InvalidTag:
+        raise ValueError("The message could not be authenticated; the image has been modified or corrupted")
@@ -0,0 +1,521 @@
+"""
+pngio.py
+
+Direct access to PNG files for the parts of the pipeline that do not need a fully decoded image.
+
+Pillow always inflates and unfilters every row of a PNG before handing back pixels; when we only need the first few
+rows (the LSB header lives in the first five pixels), this module reads them straight from the IDAT stream and stops.
+
+On the way out, Pillow filters and compresses the whole image on one thread with fixed settings. write_png filters
+rows in bulk with NumPy and deflates bands of rows on a thread pool, and rewrite_png re-filters only the rows that
+changed since the image was read, copying every other chunk of the original file through unchanged.
+"""
+
+import collections
+import concurrent.futures
+import os
+import struct
+import tempfile
+import zlib
+
+import numpy as np
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+# Bytes per pixel for the 8-bit, non-palette colour types we can expand to RGBA
+_COLOR_TYPE_CHANNELS = {
+    0: 1,   # greyscale
+    2: 3,   # RGB
+    4: 2,   # greyscale + alpha
+    6: 4,   # RGBA
+}
+
+
+# Filter types; ADAPTIVE picks, for each row, the filter whose output has the smallest sum of absolute values
+FILTER_NONE = 0
+FILTER_SUB = 1
+FILTER_UP = 2
+FILTER_AVERAGE = 3
+FILTER_PAETH = 4
+ADAPTIVE = None
+FILTERS = {"none": FILTER_NONE, "sub": FILTER_SUB, "up": FILTER_UP, "average": FILTER_AVERAGE, "paeth": FILTER_PAETH,
+           "adaptive": ADAPTIVE}
+
+DEFAULT_COMPRESS_LEVEL = 6
+
+# The number of rows filtered and deflated as one piece of the IDAT stream
+_BAND_ROWS = 64
+
+# Deflate looks back at most 32 KB, so each piece is primed with the last 32 KB of the one before it
+_WINDOW = 1 << 15
+
+_MODE_COLOR_TYPES = {"L": 0, "RGB": 2, "LA": 4, "RGBA": 6}
+
+# The umask can only be read by setting it, which affects every thread, so it is read once, at import time, before
+# any of the threads that save images exist
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+class UnsupportedPNGError(ValueError):
+    def __init__(self, message):
+        super(UnsupportedPNGError, self).__init__(message)
+        self.message = message
+
+
+def iter_chunks(file):
+    """
+    iter_chunks(file)
+    Yields (chunk_type, offset, length) for each chunk in a PNG file; offset is the position of the chunk data.
+    The file must be open in binary mode and positioned at the start of the file.
+
+    :param file:    a file object, open in binary mode
+    :return:        generator of (bytes, int, int)
+    """
+
+    if file.read(8) != PNG_SIGNATURE:
+        raise UnsupportedPNGError("File is not a PNG")
+    while True:
+        head = file.read(8)
+        if len(head) < 8:
+            return
+        length, chunk_type = struct.unpack(">I4s", head)
+        offset = file.tell()
+        yield chunk_type, offset, length
+        if chunk_type == b"IEND":
+            return
+        file.seek(offset + length + 4)  # skip the data and the CRC
+
+
+def _unfilter_row(filter_type, row, prev, bpp):
+    """Reverses the PNG filter on a single scanline; 'row' and 'prev' are uint8 arrays of equal length"""
+    if filter_type == 0:
+        return row
+    elif filter_type == 1:
+        # Sub is a running sum over each channel, which can be done in bulk
+        return np.cumsum(row.reshape(-1, bpp), axis=0, dtype=np.uint8).reshape(-1)
+    elif filter_type == 2:
+        return row + prev
+    elif filter_type == 3:
+        out = row.astype(np.int32)
+        above = prev.astype(np.int32)
+        for i in range(len(out)):
+            left = out[i - bpp] if i >= bpp else 0
+            out[i] = (out[i] + ((left + above[i]) >> 1)) & 0xFF
+        return out.astype(np.uint8)
+    elif filter_type == 4:
+        out = row.astype(np.int32)
+        above = prev.astype(np.int32)
+        for i in range(len(out)):
+            left = out[i - bpp] if i >= bpp else 0
+            upper_left = above[i - bpp] if i >= bpp else 0
+            estimate = left + above[i] - upper_left
+            pa, pb, pc = abs(estimate - left), abs(estimate - above[i]), abs(estimate - upper_left)
+            if pa <= pb and pa <= pc:
+                predictor = left
+            elif pb <= pc:
+                predictor = above[i]
+            else:
+                predictor = upper_left
+            out[i] = (out[i] + predictor) & 0xFF
+        return out.astype(np.uint8)
+    else:
+        raise UnsupportedPNGError("Invalid PNG filter type " + str(filter_type))
+
+
+def _to_rgba(rows, channels):
+    """Expands an (h, w, channels) array of 8-bit samples to RGBA the same way Pillow's convert("RGBA") does"""
+    if channels == 4:
+        return rows
+    height, width = rows.shape[:2]
+    rgba = np.empty((height, width, 4), dtype=np.uint8)
+    if channels in (1, 2):
+        rgba[..., :3] = rows[..., :1]
+    else:
+        rgba[..., :3] = rows
+    rgba[..., 3] = rows[..., 1] if channels == 2 else 255
+    return rgba
+
+
+def read_pixels(path, pixel_count):
+    """
+    read_pixels(path, pixel_count)
+    Reads only the first 'pixel_count' pixels of a PNG file in row-major order, inflating just enough of the IDAT
+    stream to reconstruct the rows that contain them.
+    Only 8-bit, non-interlaced greyscale and truecolour images (with or without alpha) are supported; anything else
+    raises UnsupportedPNGError so that callers can fall back to Pillow.
+
+    :param path:        path to the PNG file
+    :param pixel_count: the number of pixels to read; clamped to the image size
+    :return:            (width, height, ndarray) where the array is (pixel_count, 4) RGBA
+    """
+
+    with open(path, "rb") as file:
+        chunks = iter_chunks(file)
+        chunk_type, offset, length = next(chunks, (None, 0, 0))
+        if chunk_type != b"IHDR":
+            raise UnsupportedPNGError("PNG is missing its IHDR chunk")
+        file.seek(offset)
+        width, height, bit_depth, color_type, _, _, interlace = struct.unpack(">IIBBBBB", file.read(13))
+        if bit_depth != 8 or color_type not in _COLOR_TYPE_CHANNELS or interlace != 0:
+            raise UnsupportedPNGError("Only 8-bit, non-interlaced, non-palette PNGs can be read directly")
+
+        channels = _COLOR_TYPE_CHANNELS[color_type]
+        stride = width * channels
+        pixel_count = min(pixel_count, width * height)
+        row_count = -(-pixel_count // width)
+        needed = row_count * (stride + 1)   # each scanline is prefixed by its filter type
+
+        inflater = zlib.decompressobj()
+        raw = bytearray()
+        for chunk_type, offset, length in chunks:
+            if chunk_type != b"IDAT":
+                continue
+            file.seek(offset)
+            raw += inflater.decompress(file.read(length), needed - len(raw))
+            while inflater.unconsumed_tail and len(raw) < needed:
+                raw += inflater.decompress(inflater.unconsumed_tail, needed - len(raw))
+            if len(raw) >= needed:
+                break
+        if len(raw) < needed:
+            raise UnsupportedPNGError("PNG image data is truncated")
+
+    scanlines = np.frombuffer(bytes(raw[:needed]), dtype=np.uint8).reshape(row_count, stride + 1)
+    rows = np.empty((row_count, stride), dtype=np.uint8)
+    prev = np.zeros(stride, dtype=np.uint8)
+    for index in range(row_count):
+        prev = rows[index] = _unfilter_row(int(scanlines[index, 0]), scanlines[index, 1:], prev, channels)
+    rgba = _to_rgba(rows.reshape(row_count, width, channels), channels)
+    return width, height, rgba.reshape(-1, 4)[:pixel_count]
+
+
+def _filter_rows(rows, prev, bpp, filter_type):
+    """Applies one PNG filter to every row of an (n, stride) uint8 array at once; 'prev' is the row above the first
+    row (zeros for the first row of the image). Returns an (n, stride) uint8 array."""
+    if filter_type == FILTER_NONE:
+        return rows
+    above = np.concatenate([prev[None, :], rows[:-1]])
+    if filter_type == FILTER_UP:
+        return rows - above
+    left = np.zeros_like(rows)
+    left[:, bpp:] = rows[:, :-bpp]
+    if filter_type == FILTER_SUB:
+        return rows - left
+    if filter_type == FILTER_AVERAGE:
+        return rows - ((left.astype(np.uint16) + above) >> 1).astype(np.uint8)
+    if filter_type == FILTER_PAETH:
+        upper_left = np.zeros_like(rows)
+        upper_left[:, bpp:] = above[:, :-bpp]
+        a, b, c = left.astype(np.int16), above.astype(np.int16), upper_left.astype(np.int16)
+        pa, pb, pc = np.abs(b - c), np.abs(a - c), np.abs(a + b - 2 * c)
+        predictor = np.where((pa <= pb) & (pa <= pc), left, np.where(pb <= pc, above, upper_left))
+        return rows - predictor
+    raise UnsupportedPNGError("Invalid PNG filter type " + str(filter_type))
+
+
+def filter_scanlines(rows, prev, bpp, filter_types=ADAPTIVE):
+    """
+    filter_scanlines(rows, prev, bpp, filter_types)
+    Filters a band of rows into PNG scanlines, each prefixed by its filter type.
+
+    :param rows:            an (n, stride) uint8 array of raw samples
+    :param prev:            the row above the first row, or zeros for the first row of the image
+    :param bpp:             bytes per pixel
+    :param filter_types:    a filter type for every row, one filter type for all of them, or ADAPTIVE
+    :return:                an (n, stride + 1) uint8 array
+    """
+
+    out = np.empty((rows.shape[0], rows.shape[1] + 1), dtype=np.uint8)
+    if filter_types is ADAPTIVE:
+        candidates = [_filter_rows(rows, prev, bpp, filter_type) for filter_type in range(5)]
+        # the usual heuristic: the smallest sum of the filtered bytes taken as signed values
+        costs = np.stack([np.abs(candidate.view(np.int8).astype(np.int32)).sum(axis=1) for candidate in candidates])
+        filter_types = np.argmin(costs, axis=0).astype(np.uint8)
+        out[:, 0] = filter_types
+        for filter_type in range(5):
+            selected = filter_types == filter_type
+            out[selected, 1:] = candidates[filter_type][selected]
+    elif np.isscalar(filter_types):
+        out[:, 0] = filter_types
+        out[:, 1:] = _filter_rows(rows, prev, bpp, filter_types)
+    else:
+        filter_types = np.asarray(filter_types, dtype=np.uint8)
+        out[:, 0] = filter_types
+        for filter_type in np.unique(filter_types):
+            selected = filter_types == filter_type
+            out[selected, 1:] = _filter_rows(rows, prev, bpp, int(filter_type))[selected]
+    return out
+
+
+def _chunk(chunk_type, data):
+    """Returns a complete chunk: length, type, data and CRC"""
+    return struct.pack(">I", len(data)) + chunk_type + data + \
+        struct.pack(">I", zlib.crc32(data, zlib.crc32(chunk_type)) & 0xFFFFFFFF)
+
+
+def _deflate_piece(data, window, level, strategy, last):
+    """Thread pool job; deflates one piece of the IDAT stream as raw deflate data. Every piece but the last ends on a
+    byte boundary (Z_SYNC_FLUSH), so the pieces can simply be concatenated."""
+    if window:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15, zlib.DEF_MEM_LEVEL, strategy, zdict=window)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15, zlib.DEF_MEM_LEVEL, strategy)
+    return compressor.compress(data) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+def _zlib_header(level):
+    """Returns the two-byte zlib header for a 32 KB window and the given compression level"""
+    flevel = 0 if level in (0, 1) else 1 if level < 6 else 2 if level in (6, -1) else 3
+    header = 0x7800 | flevel << 6
+    return struct.pack(">H", header + 31 - header % 31)
+
+
+def _write_idat(file, pieces, level, workers, strategy=zlib.Z_FILTERED):
+    """
+    Deflates an iterator of bytes (the filtered scanlines, a band at a time) on a thread pool and writes the result to
+    'file' as IDAT chunks, one per piece. The pieces are primed with the data before them, as pigz does, so the output
+    is a single zlib stream that compresses about as well as deflating the whole image in one go. Like libpng, the
+    default strategy is Z_FILTERED, which suits filtered scanlines much better than zlib's default.
+    """
+
+    workers = workers or os.cpu_count() or 1
+    adler = 1
+    window = b""
+    pending = collections.deque()
+    prefix = _zlib_header(level)
+
+    def write_next(final):
+        nonlocal prefix
+        data = prefix + pending.popleft().result()
+        prefix = b""
+        if final:
+            data += struct.pack(">I", adler & 0xFFFFFFFF)
+        file.write(_chunk(b"IDAT", data))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        data = next(pieces, b"")
+        while data is not None:
+            following = next(pieces, None)
+            adler = zlib.adler32(data, adler)
+            pending.append(executor.submit(_deflate_piece, data, window, level, strategy, following is None))
+            window = data[-_WINDOW:] if len(data) >= _WINDOW else (window + data)[-_WINDOW:]
+            data = following
+            # keep a bounded number of pieces in flight so memory does not grow with the image
+            if len(pending) > 2 * workers:
+                write_next(False)
+        while pending:
+            write_next(len(pending) == 1)
+
+
+def _mode_color_type(image):
+    if image.mode not in _MODE_COLOR_TYPES:
+        raise UnsupportedPNGError("Only L, LA, RGB and RGBA images can be written directly; this image is " +
+                                  image.mode)
+    return _MODE_COLOR_TYPES[image.mode]
+
+
+def _image_rows(image, first_row, last_row):
+    """Returns rows [first_row, last_row) of a PIL image as an (n, stride) uint8 array; only those rows are copied"""
+    region = image.crop((0, first_row, image.width, last_row))
+    return np.asarray(region, dtype=np.uint8).reshape(last_row - first_row, -1)
+
+
+def _file_mode(path):
+    """Returns the permissions a file written to 'path' should have: those of the file it replaces, or for a new file
+    the default, 0666 less the umask, as if it had been opened normally"""
+    try:
+        return os.stat(path).st_mode & 0o7777
+    except FileNotFoundError:
+        return 0o666 & ~_UMASK
+
+
+def _replace(path, write):
+    """Calls write(file) on a temporary file next to 'path' and then moves it over 'path', so that 'path' can also be
+    the file being read and a failed write never leaves a truncated image behind. mkstemp makes the temporary file
+    owner-only, so it is given the permissions of _file_mode first."""
+    handle, temporary = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".png")
+    try:
+        with os.fdopen(handle, "wb") as file:
+            write(file)
+        os.chmod(temporary, _file_mode(path))
+        os.replace(temporary, path)
+    except BaseException:
+        os.unlink(temporary)
+        raise
+
+
+def write_png(path, image, compress_level=DEFAULT_COMPRESS_LEVEL, filter_type=ADAPTIVE, workers=None, chunks=()):
+    """
+    write_png(path, image, compress_level, filter_type, workers, chunks)
+    Writes a PIL image as an 8-bit, non-interlaced PNG. Rows are filtered a band at a time, so only one band of the
+    image is copied at once, and the bands are deflated on a thread pool.
+
+    :param path:            the file to write
+    :param image:           an L, LA, RGB or RGBA PIL image; anything else raises UnsupportedPNGError
+    :param compress_level:  the zlib compression level, 0-9
+    :param filter_type:     one of the FILTER_ constants, or ADAPTIVE to choose a filter for each row
+    :param workers:         the number of compression threads; defaults to the number of CPUs
+    :param chunks:          (type, data) pairs of extra chunks to write before the image data
+    :return:                None
+    """
+
+    color_type = _mode_color_type(image)
+    bpp = len(image.mode)
+    image.load()
+
+    def pieces():
+        prev = np.zeros(image.width * bpp, dtype=np.uint8)
+        for first_row in range(0, image.height, _BAND_ROWS):
+            rows = _image_rows(image, first_row, min(first_row + _BAND_ROWS, image.height))
+            yield filter_scanlines(rows, prev, bpp, filter_type).tobytes()
+            prev = rows[-1]
+
+    def write(file):
+        file.write(PNG_SIGNATURE)
+        file.write(_chunk(b"IHDR", struct.pack(">IIBBBBB", image.width, image.height, 8, color_type, 0, 0, 0)))
+        for chunk_type, data in chunks:
+            file.write(_chunk(chunk_type, data))
+        strategy = zlib.Z_DEFAULT_STRATEGY if filter_type == FILTER_NONE else zlib.Z_FILTERED
+        _write_idat(file, pieces(), compress_level, workers, strategy)
+        file.write(_chunk(b"IEND", b""))
+
+    _replace(path, write)
+
+
+def _inflate_bands(file, idat, row_bytes, band_rows):
+    """Yields the filtered scanlines of a PNG as (n, row_bytes) uint8 arrays of up to 'band_rows' rows, inflating the
+    IDAT chunks (a list of (offset, length)) only as far as each band needs"""
+    inflater = zlib.decompressobj()
+    band_bytes = row_bytes * band_rows
+    raw = bytearray()
+    for offset, length in idat:
+        file.seek(offset)
+        data = file.read(length)
+        while data:
+            raw += inflater.decompress(data, band_bytes)
+            data = inflater.unconsumed_tail
+            while len(raw) >= band_bytes:
+                yield np.frombuffer(bytes(raw[:band_bytes]), dtype=np.uint8).reshape(band_rows, row_bytes)
+                del raw[:band_bytes]
+    raw += inflater.flush()
+    whole = len(raw) // row_bytes * row_bytes
+    if whole:
+        yield np.frombuffer(bytes(raw[:whole]), dtype=np.uint8).reshape(-1, row_bytes)
+
+
+def rewrite_png(source, path, image, rows, compress_level=DEFAULT_COMPRESS_LEVEL, workers=None):
+    """
+    rewrite_png(source, path, image, rows, compress_level, workers)
+    Writes 'image', which was read from the PNG file 'source' and has since changed only in 'rows', to 'path'. The
+    filtered scanlines of the original are reused for every row that did not change; a changed row, and a row below
+    one whose filter depends on the row above it, is filtered again with the filter type it already had. Every chunk
+    but IDAT is copied through byte for byte. Deflate has to see the whole stream, so the image data is compressed
+    again, on a thread pool; 'source' and 'path' may be the same file.
+    The source must be an 8-bit, non-interlaced PNG of the same size and colour type as the image; otherwise this
+    raises UnsupportedPNGError so that the caller can fall back to write_png.
+
+    :param source:          path to the PNG file the image was read from
+    :param path:            the file to write
+    :param image:           a PIL image
+    :param rows:            the indexes of the rows that changed, e.g. from LSB.hide_in_place
+    :param compress_level:  the zlib compression level, 0-9
+    :param workers:         the number of compression threads; defaults to the number of CPUs
+    :return:                None
+    """
+
+    color_type = _mode_color_type(image)
+    bpp = len(image.mode)
+    row_bytes = image.width * bpp + 1
+    # a row has to be filtered again if it changed, or if the row above it changed and its filter looks upwards
+    changed = np.zeros(image.height, dtype=bool)
+    changed[np.asarray(rows, dtype=np.int64)] = True
+
+    with open(source, "rb") as file:
+        chunks = list(iter_chunks(file))
+        if not chunks or chunks[0][0] != b"IHDR":
+            raise UnsupportedPNGError("PNG is missing its IHDR chunk")
+        file.seek(chunks[0][1])
+        header = struct.unpack(">IIBBBBB", file.read(13))
+        if header != (image.width, image.height, 8, color_type, 0, 0, 0):
+            raise UnsupportedPNGError("The source PNG does not have the same layout as the image")
+        idat = [(offset, length) for chunk_type, offset, length in chunks if chunk_type == b"IDAT"]
+        if not idat:
+            raise UnsupportedPNGError("PNG has no image data")
+
+        def pieces():
+            first_row = 0
+            for band in _inflate_bands(file, idat, row_bytes, _BAND_ROWS):
+                last_row = first_row + len(band)
+                filter_types = band[:, 0]
+                above_changed = changed[first_row - 1:last_row - 1] if first_row else \
+                    np.concatenate([[False], changed[:last_row - 1]])
+                redo = changed[first_row:last_row] | (above_changed & (filter_types >= FILTER_UP))
+                if redo.any():
+                    band = band.copy()
+                    new_rows = _image_rows(image, max(first_row - 1, 0), last_row)
+                    prev = new_rows[0] if first_row else np.zeros(row_bytes - 1, dtype=np.uint8)
+                    new_rows = new_rows[1:] if first_row else new_rows
+                    band[redo] = filter_scanlines(new_rows, prev, bpp, filter_types)[redo]
+                yield band.tobytes()
+                first_row = last_row
+            if first_row != image.height:
+                raise UnsupportedPNGError("PNG image data is truncated")
+
+        def copy_chunk(out, offset, length):
+            file.seek(offset - 8)
+            out.write(file.read(length + 12))
+
+        def write(out):
+            out.write(PNG_SIGNATURE)
+            written = False
+            for chunk_type, offset, length in chunks:
+                if chunk_type != b"IDAT":
+                    copy_chunk(out, offset, length)
+                elif not written:
+                    _write_idat(out, pieces(), compress_level, workers)
+                    written = True
+
+        _replace(path, write)
+
+
+def save_image(image, path, compress_level=DEFAULT_COMPRESS_LEVEL, filter_type=ADAPTIVE, workers=None, source=None,
+               rows=None):
+    """
+    save_image(image, path, compress_level, filter_type, workers, source, rows)
+    Saves an image, taking the fastest route that applies: if 'source' (the PNG the image was read from) and 'rows'
+    (the rows that have changed since) are given, only those rows are filtered again; other PNGs go through write_png;
+    anything write_png cannot handle, and every other format, is saved by Pillow.
+
+    :return:    'path'
+    """
+
+    if os.path.splitext(str(path))[1].lower() == ".png":
+        try:
+            if source is not None and rows is not None:
+                rewrite_png(source, path, image, rows, compress_level, workers)
+            else:
+                write_png(path, image, compress_level, filter_type, workers)
+            return path
+        except UnsupportedPNGError:
+            if source is not None and rows is not None:
+                return save_image(image, path, compress_level, filter_type, workers)
+            image.save(path, compress_level=compress_level)
+            return path
+    image.save(path)
+    return path
+
+
+def save_images(items, compress_level=DEFAULT_COMPRESS_LEVEL, filter_type=ADAPTIVE, workers=None):
+    """
+    save_images(items, compress_level, filter_type, workers)
+    Saves several images at once on a thread pool; filtering and deflating release the GIL, so the saves run in
+    parallel. Each image is compressed on a single thread.
+
+    :param items:   an iterable of (image, path)
+    :param workers: the number of threads; defaults to the executor's default
+    :return:        list of the paths, in the same order as 'items'
+    """
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(save_image, image, path, compress_level, filter_type, 1) for image, path in items]
+        return [future.result() for future in futures]
@@ -0,0 +1,421 @@
+"""
+scan.py
+
+Steganalysis for sweeping large collections of stored images: cheap statistical tests that flag the images which
+probably carry a message in their least significant bits, written out one JSON line per image.
+
+Three detectors are run on each image:
+
+    chi_square  the chi-square attack of Westfeld and Pfitzmann. Replacing least significant bits with message bits
+                evens out the counts of each pair of values 2k and 2k + 1; the result is the probability that the
+                pairs are as even as they are because of embedding, so values near 1 are suspicious. For JPEG files
+                it is run on the AC coefficients JSteg writes into.
+    rs          the RS analysis of Fridrich, Goljan and Du, which estimates the fraction of pixels whose least
+                significant bits have been replaced, from how flipping them changes the noise of small pixel groups.
+                Pixel images only.
+    header      whether the image starts with a plausible Stegosaurus header (LSB for pixel images, JSteg for JPEG
+                files): a length that fits the image, which the header of a random image rarely has.
+
+Images are sampled rather than analysed whole. Stegosaurus, like most LSB tools, fills an image from the top, so the
+first rows are always sampled, and a stride keeps only every n-th of them; rows are skipped rather than scaled down,
+since resampling would destroy the least significant bits being tested. Tiles spread over the whole image can be
+added for tools that scatter their message. JPEG files are sampled in coefficients rather than rows, and only those
+coefficients are decoded. The per-channel detectors report the highest score of any channel, since a message may use
+only some of them. Files are scanned on a process pool in batches, and results come back in the order the files were
+found.
+"""
+
+import concurrent.futures
+import json
+import math
+import os
+import time
+from collections import deque, namedtuple
+
+import numpy as np
+from PIL import Image
+
+import jpeg
+import jsteg
+import LSB
+from metrics import get_logger
+
+logger = get_logger("scan")
+
+IMAGE_EXTENSIONS = (".png", ".bmp", ".jpg", ".jpeg")
+_JPEG_EXTENSIONS = (".jpg", ".jpeg")
+
+# 'rows' rows from the top of the image, keeping every 'stride'-th one, and 'tiles' tiles of 'tile_size' pixels
+# square spread over the image
+Sampling = namedtuple("Sampling", ["rows", "stride", "tiles", "tile_size"])
+DEFAULT_SAMPLING = Sampling(rows=128, stride=1, tiles=0, tile_size=64)
+
+# Scores at or above these mark an image as suspicious
+CHI_SQUARE_THRESHOLD = 0.99
+RS_THRESHOLD = 0.2
+
+# Pairs of values with fewer samples than this between them are left out of the chi-square statistic
+_MIN_PAIR_COUNT = 10
+# The chi-square attack is also run on the first half, quarter and so on of the sampled values
+_CHI_SQUARE_PREFIXES = 4
+
+# RS analysis uses groups of this many horizontally adjacent pixels and reports every bit replaced once R_M - S_M
+# has fallen to this fraction of R_-M - S_-M
+_RS_GROUP_SIZE = 4
+_RS_SATURATION = 0.05
+
+_BATCH_SIZE = 32
+
+
+def _chi_square_survival(statistic, dof):
+    """Returns P(X >= statistic) for X chi-square distributed with 'dof' degrees of freedom, i.e. the regularized
+    upper incomplete gamma function Q(dof / 2, statistic / 2)"""
+    a, x = dof / 2.0, statistic / 2.0
+    if x <= 0:
+        return 1.0
+    scale = math.exp(a * math.log(x) - x - math.lgamma(a))
+    if x < a + 1:
+        # the series for the lower function converges quickly here
+        term = total = 1.0 / a
+        denominator = a
+        while abs(term) > abs(total) * 1e-12:
+            denominator += 1
+            term *= x / denominator
+            total += term
+        return max(0.0, 1.0 - total * scale)
+    # and the continued fraction for the upper function here (modified Lentz)
+    tiny = 1e-300
+    b = x + 1 - a
+    c = 1 / tiny
+    d = 1 / b
+    result = d
+    for i in range(1, 1000):
+        term = -i * (i - a)
+        b += 2
+        d = term * d + b
+        d = d if abs(d) > tiny else tiny
+        c = b + term / c
+        c = c if abs(c) > tiny else tiny
+        d = 1 / d
+        result *= d * c
+        if abs(d * c - 1) < 1e-12:
+            break
+    return min(1.0, result * scale)
+
+
+def _pair_probability(even, odd):
+    """Returns the chi-square probability of embedding for the counts of the even and odd member of each pair of
+    values, or None if too few pairs have enough samples"""
+    total = even + odd
+    used = total >= _MIN_PAIR_COUNT
+    if used.sum() < 2:
+        return None
+    # Westfeld's statistic: the even member of each pair against the mean of the pair, which embedding tends to
+    # equalise. It is half the Pearson statistic over both members, which CHI_SQUARE_THRESHOLD was chosen for.
+    expected = total[used] / 2.0
+    statistic = float((((even[used] - expected) ** 2) / expected).sum())
+    return _chi_square_survival(statistic, int(used.sum()) - 1)
+
+
+def chi_square(values):
+    """
+    chi_square(values)
+    Runs the chi-square attack on the 8-bit values of one channel.
+
+    :param values:  an array of uint8 values
+    :return:        the probability of embedding, between 0 and 1, or None if there are too few values
+    """
+
+    counts = np.bincount(np.asarray(values, dtype=np.uint8).reshape(-1), minlength=256)
+    return _pair_probability(counts[0::2], counts[1::2])
+
+
+def chi_square_coefficients(values):
+    """
+    chi_square_coefficients(values)
+    Runs the chi-square attack on the quantized DCT coefficients JSteg embeds in (magnitude at least 2), pairing
+    magnitudes 2k and 2k + 1 of the same sign.
+
+    :param values:  an array of such coefficients, e.g. jpeg.CoefficientData.ac_values
+    :return:        the probability of embedding, between 0 and 1, or None if there are too few coefficients
+    """
+
+    values = np.asarray(values, dtype=np.int64)
+    magnitudes = np.abs(values)
+    # negative coefficients get their own pairs, after the positive ones
+    pairs = (magnitudes >> 1) + np.where(values < 0, int(magnitudes.max(initial=0) >> 1) + 1, 0)
+    odd = (magnitudes & 1).astype(bool)
+    size = int(pairs.max(initial=0)) + 1
+    return _pair_probability(np.bincount(pairs[~odd], minlength=size), np.bincount(pairs[odd], minlength=size))
+
+
+def _best_prefix(detector, values):
+    """Returns the highest score of a chi-square detector over the first 1/2^n of 'values' for each n below
+    _CHI_SQUARE_PREFIXES: a message fills the image from the start, so a short one is clearest in a short prefix"""
+    scores = [detector(values[:len(values) >> shift]) for shift in range(_CHI_SQUARE_PREFIXES)]
+    return max([score for score in scores if score is not None], default=None)
+
+
+def _noise(groups):
+    """Returns the variation of each group: the sum of the absolute differences of neighbouring pixels"""
+    noise = np.abs(groups[1] - groups[0])
+    for index in range(2, len(groups)):
+        noise += np.abs(groups[index] - groups[index - 1])
+    return noise
+
+
+def _rs_counts(groups):
+    """Returns (R_M - S_M, R_-M - S_-M): the fractions of regular minus singular groups under the flipping
+    function F1 (2k <-> 2k + 1) and its shifted twin F-1 (2k - 1 <-> 2k), applied to every pixel of a group but the
+    first and last"""
+    original = _noise(groups)
+    differences = []
+    for flip in (lambda values: values ^ 1, lambda values: ((values + 1) ^ 1) - 1):
+        flipped = groups.copy()
+        flipped[1:-1] = flip(flipped[1:-1])
+        changed = _noise(flipped)
+        differences.append((np.count_nonzero(changed > original) - np.count_nonzero(changed < original)) /
+                           len(original))
+    return differences
+
+
+def _rs_groups(channel, group_size):
+    """Cuts each row of a 2-D channel into groups of 'group_size' adjacent pixels; returns a (group_size, n) array,
+    so that each pixel position of the groups is contiguous"""
+    channel = np.asarray(channel)
+    width = channel.shape[1] - channel.shape[1] % group_size
+    return np.ascontiguousarray(channel[:, :width].reshape(-1, group_size).T, dtype=np.int16)
+
+
+def _rs_estimate(groups):
+    """Returns the RS estimate for a (group size, n) array of pixel groups, or None if there are none"""
+    if not groups.shape[1]:
+        return None
+    d0, n0 = _rs_counts(groups)
+    d1, n1 = _rs_counts(groups ^ 1)
+    if d0 <= _RS_SATURATION * n0:
+        # R_M and S_M meet once every least significant bit is random; the estimate below is degenerate there
+        return 1.0
+
+    # the differences are quadratic in the message length; solve for the root nearer zero
+    a = 2 * (d1 + d0)
+    b = n0 - n1 - d1 - 3 * d0
+    c = d0 - n0
+    if abs(a) < 1e-12:
+        if abs(b) < 1e-12:
+            return None
+        x = -c / b
+    else:
+        discriminant = b * b - 4 * a * c
+        if discriminant < 0:
+            return 0.0
+        roots = ((-b + math.sqrt(discriminant)) / (2 * a), (-b - math.sqrt(discriminant)) / (2 * a))
+        x = min(roots, key=abs)
+    if abs(x - 0.5) < 1e-12:
+        return 1.0
+    return float(min(max(x / (x - 0.5), 0.0), 1.0))
+
+
+def rs_analysis(channel, group_size=_RS_GROUP_SIZE):
+    """
+    rs_analysis(channel, group_size)
+    Estimates the fraction of pixels of one channel whose least significant bits have been replaced, by RS
+    analysis on groups of 'group_size' horizontally adjacent pixels.
+
+    :param channel:     a 2-D array of uint8 values
+    :param group_size:  the number of pixels per group
+    :return:            the estimated fraction, between 0 and 1, or None if the channel is too small
+    """
+
+    return _rs_estimate(_rs_groups(channel, group_size))
+
+
+def _tiles(image, sampling):
+    """Yields the tiles of 'sampling' from a PIL image, on an even grid"""
+    size = min(sampling.tile_size, image.width, image.height)
+    across = max(int(math.ceil(math.sqrt(sampling.tiles))), 1)
+    down = max(int(math.ceil(sampling.tiles / across)), 1)
+    lefts = np.linspace(0, image.width - size, across).astype(int)
+    tops = np.linspace(0, image.height - size, down).astype(int)
+    for index in range(sampling.tiles):
+        left, top = lefts[index % across], tops[index // across]
+        yield np.asarray(image.crop((left, top, left + size, top + size)).convert("RGBA"))
+
+
+def sample_pixels(path, sampling=DEFAULT_SAMPLING):
+    """
+    sample_pixels(path, sampling)
+    Decodes the parts of a pixel image that the detectors look at.
+
+    :param path:        path to a PNG or BMP file
+    :param sampling:    a Sampling
+    :return:            (width, height, the (n, 4) RGBA values of the first pixels, list of (rows, columns, 4) RGBA
+                        regions)
+    """
+
+    with Image.open(path) as image:
+        width, height = image.size
+        rows = min(max(sampling.rows, -(-LSB.MAX_HEADER_PIXELS // width)), height)
+        top = np.asarray(image.crop((0, 0, width, rows)).convert("RGBA")).reshape(-1, 4)
+        regions = [top.reshape(rows, width, 4)[::max(sampling.stride, 1)]]
+        if sampling.tiles:
+            regions.extend(_tiles(image, sampling))
+    return width, height, top, regions
+
+
+def _pixel_detectors(regions):
+    """Runs chi_square and rs_analysis on every channel that varies and returns the highest score of each"""
+    chi_scores, rs_scores = [], []
+    for channel in range(4):
+        planes = [region[:, :, channel] for region in regions]
+        values = np.concatenate([plane.reshape(-1) for plane in planes])
+        if values.min() == values.max():
+            # e.g. an opaque alpha channel, which says nothing either way
+            continue
+        chi_scores.append(_best_prefix(chi_square, values))
+        groups = np.concatenate([_rs_groups(plane, _RS_GROUP_SIZE) for plane in planes], axis=1)
+        rs_scores.append(_rs_estimate(groups))
+    chi_scores = [score for score in chi_scores if score is not None]
+    rs_scores = [score for score in rs_scores if score is not None]
+    return max(chi_scores, default=None), max(rs_scores, default=None)
+
+
+def _scan_pixels(path, sampling, result):
+    width, height, top, regions = sample_pixels(path, sampling)
+    result.update(width=width, height=height, sampled=sum(region.shape[0] * region.shape[1] for region in regions))
+    result["chi_square"], result["rs"] = _pixel_detectors(regions)
+    try:
+        header = LSB.parse_header(top, width * height)
+    except ValueError:
+        header = None
+    if header is not None and 0 < header.length <= header.capacity:
+        result["header"] = {"length": int(header.length), "is_string": bool(header.is_string),
+                            "version": int(header.version), "bits": header.codec.bits,
+                            "channels": header.codec.channels, "features": int(header.features)}
+
+
+def _scan_jpeg(path, sampling, result):
+    with jpeg.JPEG(path) as image:
+        frame = image.frame()
+        result.update(width=frame.width, height=frame.height)
+        # the same budget as for pixel images, in coefficients: JSteg also fills the image from the start
+        count = sampling.rows * frame.width
+        values = image.decode_coefficients(max_ac=count, blocks=False).ac_values[:count]
+        result["sampled"] = len(values)
+        result["chi_square"] = _best_prefix(chi_square_coefficients, values)
+        try:
+            length, is_string = jsteg.read_header(image)
+        except ValueError:
+            length = 0
+    if 0 < length <= os.path.getsize(path):
+        result["header"] = {"length": length, "is_string": bool(is_string)}
+
+
+def scan_image(path, sampling=DEFAULT_SAMPLING):
+    """
+    scan_image(path, sampling)
+    Runs the detectors on one image. An image that cannot be read is reported with an 'error' rather than raising.
+
+    :param path:        path to a PNG, BMP or JPEG file
+    :param sampling:    a Sampling
+    :return:            dict with path, format, width, height, sampled (pixels or coefficients), chi_square, rs,
+                        header (what a plausible header claims, or None), suspicious and seconds
+    """
+
+    start = time.perf_counter()
+    is_jpeg = path.lower().endswith(_JPEG_EXTENSIONS)
+    result = {"path": path, "format": "JPEG" if is_jpeg else os.path.splitext(path)[1][1:].upper(), "width": None,
+              "height": None, "sampled": 0, "chi_square": None, "rs": None, "header": None}
+    try:
+        if is_jpeg:
+            _scan_jpeg(path, sampling, result)
+        else:
+            _scan_pixels(path, sampling, result)
+    except (OSError, ValueError, jpeg.InvalidFormatError) as error:
+        result["error"] = type(error).__name__ + ": " + str(error)
+        logger.debug("Could not scan %s: %s", path, result["error"])
+    result["suspicious"] = result["header"] is not None or \
+        (result["chi_square"] or 0) >= CHI_SQUARE_THRESHOLD or (result["rs"] or 0) >= RS_THRESHOLD
+    result["seconds"] = time.perf_counter() - start
+    return result
+
+
+def iter_images(paths):
+    """Yields the image files among 'paths', walking directories recursively in sorted order; files given
+    explicitly are yielded whatever their extension"""
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for root, directories, files in os.walk(path):
+            directories.sort()
+            for name in sorted(files):
+                if name.lower().endswith(IMAGE_EXTENSIONS):
+                    yield os.path.join(root, name)
+
+
+def _scan_batch(paths, sampling):
+    return [scan_image(path, sampling) for path in paths]
+
+
+def _batches(paths, size):
+    batch = []
+    for path in paths:
+        batch.append(path)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def scan(paths, sampling=DEFAULT_SAMPLING, workers=None, batch_size=_BATCH_SIZE):
+    """
+    scan(paths, sampling, workers, batch_size)
+    Scans images across a process pool and yields the results of scan_image in the order the files were found.
+    Files are handed out 'batch_size' at a time and only a few batches per worker are queued, so a sweep of millions
+    of files starts yielding at once and holds only a bounded number of results.
+
+    :param paths:       an iterable of files and directories
+    :param sampling:    a Sampling
+    :param workers:     the number of worker processes; defaults to the number of CPUs. 1 scans in this process.
+    :param batch_size:  the number of files per job
+    :return:            generator of dict
+    """
+
+    workers = workers or os.cpu_count() or 1
+    if workers == 1:
+        for path in iter_images(paths):
+            yield scan_image(path, sampling)
+        return
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for batch in _batches(iter_images(paths), batch_size):
+            pending.append(executor.submit(_scan_batch, batch, sampling))
+            if len(pending) >= 2 * workers:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+
+def write_jsonl(results, file):
+    """
+    write_jsonl(results, file)
+    Writes each result as a line of JSON as soon as it arrives.
+
+    :param results: an iterable of dict, e.g. from scan
+    :param file:    a writable text file
+    :return:        dict of totals: images, suspicious, errors and seconds
+    """
+
+    totals = {"images": 0, "suspicious": 0, "errors": 0}
+    start = time.perf_counter()
+    for result in results:
+        file.write(json.dumps(result) + "\n")
+        totals["images"] += 1
+        totals["suspicious"] += bool(result["suspicious"])
+        totals["errors"] += "error" in result
+    file.flush()
+    totals["seconds"] = time.perf_counter() - start
+    return totals
@@ -0,0 +1,129 @@
+"""
+scatter.py
+
+Keyed placement of message pixels. Instead of filling the pixels after the header in order, a scattered message puts
+its n-th pixel at a position given by a permutation of all the pixels after the header, derived from a passphrase,
+so that the message is spread thinly over the whole image rather than packed into its top rows.
+
+The permutation is a 4-round Feistel network keyed from the passphrase with scrypt and a fixed salt, restricted to
+the number of pixels by cycle walking. It is defined here rather than taken from NumPy's random generators, whose
+output may change between NumPy versions, so that a message can always be found again. Position arrays are computed
+with NumPy for as many pixels as a message needs and cached per (key, image size, header size), so that hiding in or
+revealing from an image of the same size again costs one gather or scatter over the pixel buffer.
+"""
+
+import hashlib
+from collections import OrderedDict
+from functools import lru_cache
+
+import numpy as np
+
+# scrypt parameters for the permutation key; the salt is fixed rather than random, since the permutation has to be
+# found again from the passphrase alone
+_SALT = b"Stegosaurus scatter"
+_SCRYPT_N = 1 << 14
+_SCRYPT_R = 8
+_SCRYPT_P = 1
+
+_ROUNDS = 4
+
+# Positions are computed this many at a time, to bound the memory the Feistel network needs
+_CHUNK = 1 << 20
+
+# The cached position arrays are trimmed back to this size, least recently used first
+CACHE_BYTES = 256 << 20
+
+_cache = OrderedDict()
+_cache_used = 0
+
+
+@lru_cache(maxsize=16)
+def _round_keys(key):
+    """Returns the round keys of the permutation for a passphrase (str or bytes)"""
+    if isinstance(key, str):
+        key = key.encode("utf-8")
+    derived = hashlib.scrypt(bytes(key), salt=_SALT, n=_SCRYPT_N, r=_SCRYPT_R, p=_SCRYPT_P, dklen=8 * _ROUNDS)
+    return np.frombuffer(derived, dtype=">u8").astype(np.uint64)
+
+
+def _mix(values):
+    """The splitmix64 finalizer; a fast, well-spread 64-bit mixing function"""
+    values = (values ^ (values >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    values = (values ^ (values >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return values ^ (values >> np.uint64(31))
+
+
+def _feistel(values, round_keys, half_bits):
+    """Applies the keyed permutation of [0, 4^half_bits) to each of 'values'"""
+    mask = np.uint64((1 << half_bits) - 1)
+    shift = np.uint64(half_bits)
+    left, right = values >> shift, values & mask
+    for round_key in round_keys:
+        left, right = right, left ^ (_mix(right ^ round_key) & mask)
+    return left << shift | right
+
+
+def _positions(round_keys, size, first, last):
+    """Returns where the permutation of [0, size) sends each of first ... last - 1. The Feistel network permutes the
+    smallest even power of two that covers 'size'; values it sends beyond 'size' are sent through it again until they
+    land inside, which keeps the result a permutation of [0, size)."""
+    half_bits = max(-(-(size - 1).bit_length() // 2), 1)
+    limit = np.uint64(size)
+    values = _feistel(np.arange(first, last, dtype=np.uint64), round_keys, half_bits)
+    outside = np.flatnonzero(values >= limit)
+    while len(outside):
+        values[outside] = _feistel(values[outside], round_keys, half_bits)
+        outside = outside[values[outside] >= limit]
+    return values.astype(np.int64)
+
+
+def _remember(cache_key, positions):
+    global _cache_used
+    if cache_key in _cache:
+        _cache_used -= _cache.pop(cache_key).nbytes
+    _cache[cache_key] = positions
+    _cache_used += positions.nbytes
+    while _cache_used > CACHE_BYTES and len(_cache) > 1:
+        _, evicted = _cache.popitem(last=False)
+        _cache_used -= evicted.nbytes
+
+
+def indexes(key, pixel_count, start, count):
+    """
+    indexes(key, pixel_count, start, count)
+    Returns the pixels that hold the first 'count' pixels of a message scattered with 'key' over the pixels
+    [start, pixel_count) of an image.
+
+    :param key:         the passphrase, as str or bytes
+    :param pixel_count: the number of pixels in the image
+    :param start:       the first pixel after the header
+    :param count:       the number of message pixels
+    :return:            a read-only int64 array of 'count' pixel indexes, all distinct and in [start, pixel_count)
+    """
+
+    size = pixel_count - start
+    if count > size:
+        raise ValueError("Cannot scatter " + str(count) + " pixels over " + str(max(size, 0)))
+    cache_key = (key, pixel_count, start)
+    positions = _cache.get(cache_key)
+    if positions is None or len(positions) < count:
+        known = 0 if positions is None else len(positions)
+        # grow geometrically, so that a series of longer messages does not recompute the array each time
+        wanted = min(max(count, 2 * known), size)
+        round_keys = _round_keys(key)
+        parts = [] if positions is None else [positions]
+        for first in range(known, wanted, _CHUNK):
+            parts.append(start + _positions(round_keys, size, first, min(first + _CHUNK, wanted)))
+        positions = np.concatenate(parts) if parts else np.empty(0, dtype=np.int64)
+        positions.flags.writeable = False
+        _remember(cache_key, positions)
+    else:
+        _cache.move_to_end(cache_key)
+    return positions[:count]
+
+
+def clear():
+    """Empties the cache of position arrays"""
+    global _cache_used
+    _cache.clear()
+    _cache_used = 0
@@ -0,0 +1,470 @@
+"""
+service.py
+
+A long-running server that answers hide, reveal, capacity and peek requests, so that callers pay for interpreter
+startup and library imports once rather than on every call.
+
+The protocol is plain HTTP/1.1, served either on a UNIX socket or on a TCP port bound to localhost:
+
+    POST /hide?carrier=PATH[&output=PATH][&bits=2][&channels=RGBA][&string=1][&compress=auto][&ecc=N][&scatter=1]
+                                                      body: the message
+    POST /hide?carrier_length=N[&...]                 body: N bytes of carrier image followed by the message
+    POST /reveal?carrier=PATH[&output=PATH]           or the carrier image as the body
+    GET  /capacity?carrier=PATH[&bits=2][&channels=RGBA]
+    GET  /peek?carrier=PATH
+
+hide returns the new image (or writes it to 'output' and returns JSON) and reveal returns the message (with an X-Is-
+String header), or writes it to 'output'. capacity and peek return JSON. compress is auto, zlib, lzma or none, ecc
+the number of Reed-Solomon parity bytes per block; an X-Key header carries the passphrase to encrypt a message with
+on hide, or to decrypt it with on reveal, and scatter=1 also spreads the message over the image in an order derived
+from it. Request bodies are spooled to disk as they arrive and response bodies are
+streamed from disk, so memory use does not depend on the size of the images.
+
+If the server is given a cache directory, carriers and messages named by path are looked up in a cache.Cache: each
+worker keeps decoded carriers in memory, and headers and messages are shared on disk.
+
+Encoding and decoding run on a process pool. At most 'concurrency' jobs are handed to the pool at once; up to
+'max_pending' more requests wait for a slot, and requests beyond that are turned away with 503 so that a burst of
+callers slows down instead of piling up work. Paths in requests are opened with the permissions of the server, which
+is why it only listens locally.
+"""
+
+import asyncio
+import concurrent.futures
+import json
+import os
+import shutil
+import signal
+import tempfile
+import time
+import urllib.parse
+from collections import namedtuple
+
+from PIL import Image
+
+import LSB
+import ecc
+import payload
+import cache
+import pngio
+from metrics import Metrics, get_logger
+
+logger = get_logger("service")
+
+DEFAULT_PORT = 8470
+DEFAULT_MAX_BODY = 1 << 30
+
+# Size of the reads and writes used to stream bodies
+_BLOCK_SIZE = 1 << 16
+
+_CONTENT_TYPES = {".png": "image/png", ".bmp": "image/bmp"}
+
+_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 411: "Length Required",
+            413: "Payload Too Large", 422: "Unprocessable Entity", 500: "Internal Server Error",
+            503: "Service Unavailable"}
+
+Request = namedtuple("Request", ["method", "path", "query", "headers"])
+
+# Each worker process's cache, if the server has a cache directory
+_cache = None
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        # both arguments go to Exception so that errors raised in worker processes can be pickled back
+        super(HTTPError, self).__init__(status, message)
+        self.status = status
+        self.message = message
+
+
+def _codec(query):
+    try:
+        return LSB.Codec(int(query.get("bits", 2)), query.get("channels", "RGBA"))
+    except ValueError as error:
+        raise HTTPError(400, str(error))
+
+
+def _compression(query):
+    try:
+        return payload.compression_method(query.get("compress", "none"))
+    except ValueError as error:
+        raise HTTPError(400, str(error))
+
+
+def _ecc_symbols(query):
+    try:
+        symbols = int(query.get("ecc", 0))
+        if symbols:
+            ecc.check_symbols(symbols)
+    except ValueError as error:
+        raise HTTPError(400, str(error))
+    return symbols
+
+
+def _init_worker(cache_dir):
+    global _cache
+    _cache = cache.Cache(cache_dir) if cache_dir is not None else None
+
+
+def _open_carrier(carrier_path, cached):
+    """Returns the carrier as an RGBA image to write into, from the worker's cache if 'cached' is set"""
+    if cached and _cache is not None:
+        return _cache.carrier(carrier_path)
+    with Image.open(carrier_path) as carrier:
+        carrier.load()
+        return carrier if carrier.mode == "RGBA" else carrier.convert("RGBA")
+
+
+def _hide_job(carrier_path, message_path, is_string, codec, output_path, metrics, cached=False, compression=None,
+              key=None, ecc_symbols=0, scattered=False):
+    """Process pool job; hides the message file in the carrier and saves the result"""
+    with metrics.phase("open"):
+        image = _open_carrier(carrier_path, cached)
+    try:
+        with open(message_path, "rb") as message:
+            rows = LSB.hide_stream_in_place(image, message, is_string=is_string, codec=codec, metrics=metrics,
+                                            compression=compression, key=key, ecc_symbols=ecc_symbols,
+                                            scattered=scattered)
+    except ValueError as error:
+        raise HTTPError(422, str(error))
+    if rows is None:
+        raise HTTPError(422, "The message is too large for the carrier")
+    with metrics.phase("save"):
+        # rewrite_png turns down a source that is not an RGBA PNG, and the image is then written in full
+        pngio.save_image(image, output_path, workers=1, source=carrier_path, rows=rows)
+    return metrics
+
+
+def _reveal_job(carrier_path, output_path, metrics, cached=False, key=None):
+    """Process pool job; writes the message in the carrier to 'output_path' and returns (is_string, metrics)"""
+    try:
+        if cached and _cache is not None:
+            message = _cache.reveal(carrier_path, key)
+            with open(output_path, "wb") as sink:
+                sink.write(bytes(message, "utf-8") if type(message) is str else message)
+            return type(message) is str, metrics
+        with Image.open(carrier_path) as image, open(output_path, "wb") as sink:
+            _, is_string = LSB.reveal_stream(image, sink, metrics=metrics, key=key)
+    except ValueError as error:
+        raise HTTPError(422, str(error))
+    return is_string, metrics
+
+
+def _capacity_job(carrier_path, codec):
+    return {"capacity": LSB.capacity(carrier_path, codec)}
+
+
+def _peek_job(carrier_path):
+    try:
+        header = LSB.read_header(carrier_path)
+    except ValueError as error:
+        return {"message": False, "error": str(error)}
+    if header.length > header.capacity:
+        return {"message": False, "capacity": header.capacity}
+    compression = header.features & payload.COMPRESSION_MASK
+    return {"message": True, "length": header.length, "is_string": header.is_string, "capacity": header.capacity,
+            "version": header.version, "bits": header.codec.bits, "channels": header.codec.channels,
+            "compression": payload.COMPRESSORS[compression][0] if compression else None,
+            "encrypted": bool(header.features & payload.ENCRYPTED), "ecc": header.ecc_symbols,
+            "scattered": bool(header.features & payload.SCATTERED)}
+
+
+async def _read_request(reader):
+    """Reads a request line and headers; returns None when the client has closed the connection"""
+    line = await reader.readline()
+    if not line.strip():
+        return None
+    try:
+        method, target, _ = line.decode("latin-1").split()
+    except ValueError:
+        raise HTTPError(400, "Malformed request line")
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    url = urllib.parse.urlsplit(target)
+    return Request(method.upper(), url.path, dict(urllib.parse.parse_qsl(url.query)), headers)
+
+
+async def _body_chunks(reader, headers):
+    """Yields the request body as it arrives, for both Content-Length and chunked transfer encoding"""
+    if headers.get("transfer-encoding", "").lower() == "chunked":
+        while True:
+            size = int((await reader.readline()).split(b";")[0], 16)
+            if size == 0:
+                # skip any trailers
+                while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    pass
+                return
+            yield await reader.readexactly(size)
+            await reader.readline()
+    else:
+        remaining = int(headers.get("content-length", 0))
+        while remaining > 0:
+            chunk = await reader.read(min(remaining, _BLOCK_SIZE))
+            if not chunk:
+                raise HTTPError(400, "Request body ended early")
+            remaining -= len(chunk)
+            yield chunk
+
+
+async def _respond(writer, status, body=b"", content_type="application/json", headers=None):
+    if isinstance(body, dict):
+        body = json.dumps(body).encode() + b"\n"
+    head = ["HTTP/1.1 %d %s" % (status, _REASONS.get(status, "")), "Content-Type: " + content_type,
+            "Content-Length: " + str(len(body))]
+    head += [name + ": " + value for name, value in (headers or {}).items()]
+    writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + body)
+    await writer.drain()
+
+
+async def _respond_file(writer, path, content_type, headers=None):
+    """Streams a file as the response body; drain() holds us back whenever the client reads more slowly than we send"""
+    head = ["HTTP/1.1 200 OK", "Content-Type: " + content_type, "Content-Length: " + str(os.path.getsize(path))]
+    head += [name + ": " + value for name, value in (headers or {}).items()]
+    writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1"))
+    with open(path, "rb") as file:
+        while True:
+            block = file.read(_BLOCK_SIZE)
+            if not block:
+                break
+            writer.write(block)
+            await writer.drain()
+
+
+class Service:
+    """
+    Service(workers, concurrency, max_pending, max_body, cache_dir)
+    Handles requests on a pool of 'workers' processes; see the module documentation for the protocol.
+
+    :param workers:     the number of worker processes; defaults to the number of CPUs
+    :param concurrency: the number of jobs handed to the pool at once; defaults to 'workers'
+    :param max_pending: the number of requests that may wait for a slot before new ones are refused with 503
+    :param max_body:    the largest request body accepted, in bytes
+    :param cache_dir:   a cache.Cache directory for the workers to share, or None not to cache
+    """
+
+    def __init__(self, workers=None, concurrency=None, max_pending=64, max_body=DEFAULT_MAX_BODY, cache_dir=None):
+        self.workers = workers or os.cpu_count() or 1
+        self.cache_dir = cache_dir
+        self.concurrency = concurrency or self.workers
+        self.max_pending = max_pending
+        self.max_body = max_body
+        self.executor = None
+        self.slots = None
+        self.pending = 0
+        self.spool = None
+
+    async def start(self):
+        self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker,
+                                                               initargs=(self.cache_dir,))
+        self.slots = asyncio.Semaphore(self.concurrency)
+        self.spool = tempfile.mkdtemp(prefix="stegosaurus-")
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+        if self.spool is not None:
+            shutil.rmtree(self.spool, ignore_errors=True)
+
+    def _temporary(self, suffix=""):
+        handle, path = tempfile.mkstemp(dir=self.spool, suffix=suffix)
+        os.close(handle)
+        return path
+
+    async def _run(self, function, *args):
+        """Runs a job on the process pool once a slot is free, or refuses it if too many requests are waiting"""
+        if self.pending >= self.concurrency + self.max_pending:
+            raise HTTPError(503, "The server is busy")
+        self.pending += 1
+        try:
+            async with self.slots:
+                return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+        finally:
+            self.pending -= 1
+
+    async def _spool_body(self, body, request, path, head_path=None, head_length=0):
+        """Writes the request body to 'path' as it arrives and returns its length; if 'head_path' is given, the first
+        'head_length' bytes of the body are written to that file instead"""
+        if "content-length" not in request.headers and "transfer-encoding" not in request.headers:
+            raise HTTPError(411, "A Content-Length or chunked body is required")
+        length = 0
+        with open(path, "wb") as file, open(head_path or os.devnull, "wb") as head:
+            async for chunk in body:
+                length += len(chunk)
+                if length > self.max_body:
+                    raise HTTPError(413, "The request body is larger than " + str(self.max_body) + " bytes")
+                split = max(min(head_length - (length - len(chunk)), len(chunk)), 0)
+                head.write(chunk[:split])
+                file.write(chunk[split:])
+        if length < head_length:
+            raise HTTPError(400, "carrier_length is longer than the body")
+        return length
+
+    async def _carrier(self, body, request, temporary):
+        """Returns the path of the carrier: the 'carrier' parameter, or the request body spooled to disk"""
+        if "carrier" in request.query:
+            if not os.path.isfile(request.query["carrier"]):
+                raise HTTPError(404, "No such carrier: " + request.query["carrier"])
+            return request.query["carrier"]
+        path = self._temporary()
+        temporary.append(path)
+        await self._spool_body(body, request, path)
+        return path
+
+    async def hide(self, body, writer, request, temporary):
+        if request.method != "POST":
+            raise HTTPError(405, "hide requires POST")
+        codec = _codec(request.query)
+        compression = _compression(request.query)
+        ecc_symbols = _ecc_symbols(request.query)
+        is_string = request.query.get("string", "0") not in ("0", "false", "")
+        scattered = request.query.get("scatter", "0") not in ("0", "false", "")
+        if scattered and "x-key" not in request.headers:
+            raise HTTPError(400, "scatter requires an X-Key header")
+        message = self._temporary()
+        temporary.append(message)
+        if "carrier" in request.query:
+            carrier = await self._carrier(body, request, temporary)
+            await self._spool_body(body, request, message)
+        elif "carrier_length" in request.query:
+            # the carrier and the message arrive in one body and are split as it is spooled
+            carrier = self._temporary()
+            temporary.append(carrier)
+            try:
+                carrier_length = int(request.query["carrier_length"])
+            except ValueError:
+                raise HTTPError(400, "carrier_length must be an integer")
+            await self._spool_body(body, request, message, carrier, carrier_length)
+        else:
+            raise HTTPError(400, "hide requires a carrier path or carrier_length")
+
+        suffix = os.path.splitext(request.query.get("carrier", ""))[1].lower() or ".png"
+        output = request.query.get("output")
+        if output is None:
+            output = self._temporary(suffix)
+            temporary.append(output)
+        metrics = await self._run(_hide_job, carrier, message, is_string, codec, output, Metrics("hide"),
+                                  "carrier" in request.query, compression, request.headers.get("x-key"),
+                                  ecc_symbols, scattered)
+        headers = {"X-Metrics": metrics.to_json()}
+        if "output" in request.query:
+            await _respond(writer, 200, {"output": output}, headers=headers)
+        else:
+            await _respond_file(writer, output, _CONTENT_TYPES.get(suffix.lower(), "application/octet-stream"),
+                                headers)
+
+    async def reveal(self, body, writer, request, temporary):
+        if request.method != "POST" and "carrier" not in request.query:
+            raise HTTPError(405, "reveal requires POST when the carrier is sent as the body")
+        carrier = await self._carrier(body, request, temporary)
+        output = request.query.get("output")
+        if output is None:
+            output = self._temporary()
+            temporary.append(output)
+        is_string, metrics = await self._run(_reveal_job, carrier, output, Metrics("reveal"),
+                                             "carrier" in request.query, request.headers.get("x-key"))
+        headers = {"X-Is-String": "1" if is_string else "0", "X-Metrics": metrics.to_json()}
+        if "output" in request.query:
+            await _respond(writer, 200, {"output": output, "is_string": is_string}, headers=headers)
+        else:
+            content_type = "text/plain; charset=utf-8" if is_string else "application/octet-stream"
+            await _respond_file(writer, output, content_type, headers)
+
+    async def capacity(self, body, writer, request, temporary):
+        carrier = await self._carrier(body, request, temporary)
+        # only the image header is read, but the job still takes a slot, so that these requests are refused with the
+        # others when the server is busy
+        await _respond(writer, 200, await self._run(_capacity_job, carrier, _codec(request.query)))
+
+    async def peek(self, body, writer, request, temporary):
+        carrier = await self._carrier(body, request, temporary)
+        await _respond(writer, 200, await self._run(_peek_job, carrier))
+
+    async def handle(self, reader, writer):
+        """Serves the requests on one connection, keeping it open between requests unless the client asks not to"""
+        routes = {"/hide": self.hide, "/reveal": self.reveal, "/capacity": self.capacity, "/peek": self.peek}
+        try:
+            while True:
+                request = body = None
+                temporary = []
+                start = time.perf_counter()
+                status = 200
+                try:
+                    request = await _read_request(reader)
+                    if request is None:
+                        break
+                    body = _body_chunks(reader, request.headers)
+                    if request.path not in routes:
+                        raise HTTPError(404, "Unknown operation " + request.path)
+                    await routes[request.path](body, writer, request, temporary)
+                except HTTPError as error:
+                    status = error.status
+                    await self._fail(writer, request, body, error.status, error.message)
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+                except Exception as error:
+                    logger.exception("Request failed")
+                    status = 500
+                    await self._fail(writer, request, body, 500, type(error).__name__ + ": " + str(error))
+                finally:
+                    for path in temporary:
+                        if os.path.exists(path):
+                            os.unlink(path)
+                if request is not None:
+                    logger.info("%s %s %d %.3f s", request.method, request.path, status, time.perf_counter() - start)
+                if status != 200 or request.headers.get("connection", "").lower() == "close":
+                    break
+        except asyncio.CancelledError:
+            # the server is shutting down
+            pass
+        finally:
+            writer.close()
+
+    async def _fail(self, writer, request, body, status, message):
+        """Sends an error response and closes the connection. Whatever is left of the request body is read first
+        (unless it is too large), so that a client still sending it sees the response rather than a broken pipe."""
+        if body is not None and status != 413:
+            try:
+                async for _ in body:
+                    pass
+            except (HTTPError, ValueError):
+                pass
+        await _respond(writer, status, {"error": message}, headers={"Connection": "close"})
+
+
+async def _serve(service, socket_path, host, port):
+    # SIGTERM stops the server the same way as an interrupt, so the worker processes are shut down with it
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    await service.start()
+    try:
+        if socket_path is not None:
+            server = await asyncio.start_unix_server(service.handle, path=socket_path, limit=_BLOCK_SIZE)
+            logger.warning("Listening on %s", socket_path)
+        else:
+            server = await asyncio.start_server(service.handle, host, port, limit=_BLOCK_SIZE)
+            logger.warning("Listening on http://%s:%d", host, port)
+        async with server:
+            await server.serve_forever()
+    finally:
+        service.close()
+        if socket_path is not None and os.path.exists(socket_path):
+            os.unlink(socket_path)
+
+
+def serve(socket_path=None, host="127.0.0.1", port=DEFAULT_PORT, workers=None, concurrency=None, max_pending=64,
+          max_body=DEFAULT_MAX_BODY, cache_dir=None):
+    """
+    serve(socket_path, host, port, workers, concurrency, max_pending, max_body, cache_dir)
+    Runs the service until interrupted, on the UNIX socket 'socket_path' if given and otherwise on host:port. See
+    Service for the other parameters.
+    """
+
+    service = Service(workers, concurrency, max_pending, max_body, cache_dir)
+    try:
+        asyncio.run(_serve(service, socket_path, host, port))
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        pass
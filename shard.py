@@ -0,0 +1,247 @@
+"""
+shard.py
+
+Splits a single message across several carrier images so that messages larger than one image can be hidden, and
+encodes or decodes the shards in parallel.
+
+Each shard is an ordinary LSB message whose payload begins with a shard header:
+
+    magic "StgS", version, shard index, shard count, total message length, offset of this shard, payload id
+
+so that the shards can be revealed in any order and reassembled.
+"""
+
+import concurrent.futures
+import itertools
+import os
+import struct
+from collections import namedtuple
+
+from PIL import Image
+
+import LSB
+import pngio
+
+SHARD_MAGIC = b"StgS"
+SHARD_VERSION = 1
+_SHARD_HEADER = struct.Struct(">4sBIIQQ16s")
+SHARD_HEADER_SIZE = _SHARD_HEADER.size
+
+# Size of the reads used to stream a shard's slice of the message file into its image
+_READ_SIZE = 1 << 20
+
+ShardHeader = namedtuple("ShardHeader", ["index", "count", "total_length", "offset", "payload_id"])
+
+
+class ShardError(ValueError):
+    def __init__(self, message):
+        super(ShardError, self).__init__(message)
+        self.message = message
+
+
+def pack_header(header):
+    """Returns the bytes of a ShardHeader"""
+    return _SHARD_HEADER.pack(SHARD_MAGIC, SHARD_VERSION, *header)
+
+
+def unpack_header(data):
+    """Parses the bytes at the start of a shard's payload into a ShardHeader"""
+    if len(data) < SHARD_HEADER_SIZE:
+        raise ShardError("Message is too short to be a shard")
+    magic, version, *fields = _SHARD_HEADER.unpack_from(data)
+    if magic != SHARD_MAGIC:
+        raise ShardError("Message is not a shard")
+    if version != SHARD_VERSION:
+        raise ShardError("Unsupported shard version " + str(version))
+    return ShardHeader(*fields)
+
+
+def plan_shards(total_length, sizes):
+    """
+    plan_shards(total_length, sizes)
+    Divides a message between carriers in proportion to their capacity, so that every shard takes about as long to
+    encode as the others.
+
+    :param total_length:    the length of the message in bytes
+    :param sizes:           a list of (width, height) of each carrier
+    :return:                list of (offset, length), one per carrier
+    """
+
+    capacities = [max(LSB.capacity(size) - SHARD_HEADER_SIZE, 0) for size in sizes]
+    total_capacity = sum(capacities)
+    if total_length > total_capacity:
+        raise ShardError("message is too large; the carriers can hold " + str(total_capacity) +
+                         " bytes and the message is " + str(total_length) + " bytes")
+
+    lengths = [total_length * capacity // total_capacity if total_capacity else 0 for capacity in capacities]
+    # hand out the bytes lost to rounding to carriers that still have room
+    remainder = total_length - sum(lengths)
+    for index, capacity in enumerate(capacities):
+        extra = min(remainder, capacity - lengths[index])
+        lengths[index] += extra
+        remainder -= extra
+
+    offsets = itertools.accumulate([0] + lengths[:-1])
+    return list(zip(offsets, lengths))
+
+
+def check_shards(headers):
+    """Makes sure a set of ShardHeaders describes exactly one complete message and returns them sorted by index"""
+    if not headers:
+        raise ShardError("No shards were given")
+    if len(set(header.payload_id for header in headers)) != 1:
+        raise ShardError("Shards belong to more than one message")
+    headers = sorted(headers, key=lambda header: header.index)
+    count = headers[0].count
+    if [header.index for header in headers] != list(range(count)):
+        raise ShardError("Expected shards 0 to " + str(count - 1) + "; got " +
+                         str([header.index for header in headers]))
+    return headers
+
+
+def _message_chunks(file, offset, length):
+    """Yields 'length' bytes of a file, starting at 'offset', in bounded reads"""
+    file.seek(offset)
+    while length > 0:
+        chunk = file.read(min(length, _READ_SIZE))
+        if not chunk:
+            raise ShardError("Message file ended early")
+        length -= len(chunk)
+        yield chunk
+
+
+def _split_shard(chunks):
+    """Takes the chunks of a revealed shard and returns (ShardHeader, iterator of the shard's data chunks)"""
+    head = b""
+    for chunk in chunks:
+        head += chunk
+        if len(head) >= SHARD_HEADER_SIZE:
+            break
+    return unpack_header(head), itertools.chain([head[SHARD_HEADER_SIZE:]], chunks)
+
+
+def hide_sharded(images, message, workers=None):
+    """
+    hide_sharded(images, message, workers)
+    Splits 'message' across a list of PIL images and hides one shard in each, encoding the shards on a thread pool.
+
+    :param images:  a list of PIL image objects; the originals are not modified
+    :param message: a bytes-like object
+    :param workers: the number of threads to use; defaults to the executor's default
+    :return:        list of modified images, in the same order as 'images'
+    """
+
+    message = memoryview(bytes(message))
+    plan = plan_shards(len(message), [image.size for image in images])
+    payload_id = os.urandom(16)
+
+    def hide_one(index):
+        offset, length = plan[index]
+        header = pack_header(ShardHeader(index, len(images), len(message), offset, payload_id))
+        return LSB.hide_stream(images[index], [header, message[offset:offset + length]],
+                               length=SHARD_HEADER_SIZE + length)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(hide_one, range(len(images))))
+
+
+def reveal_sharded(images, workers=None):
+    """
+    reveal_sharded(images, workers)
+    Reveals and reassembles a message that was split with hide_sharded; the images may be given in any order.
+
+    :param images:  a list of PIL image objects, one per shard
+    :param workers: the number of threads to use; defaults to the executor's default
+    :return:        bytearray
+    """
+
+    def reveal_one(image):
+        header, chunks = _split_shard(LSB.iter_message(image))
+        return header, b"".join(chunks)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        shards = list(executor.map(reveal_one, images))
+
+    headers = check_shards([header for header, _ in shards])
+    message = bytearray(headers[0].total_length)
+    for header, data in shards:
+        message[header.offset:header.offset + len(data)] = data
+    return message
+
+
+def _hide_file_shard(carrier_path, message_path, output_path, header, length):
+    """Process pool job; streams one shard of a message file into a carrier and saves it"""
+    with Image.open(carrier_path) as image, open(message_path, "rb") as message:
+        chunks = itertools.chain([pack_header(header)], _message_chunks(message, header.offset, length))
+        result = LSB.hide_stream(image, chunks, length=SHARD_HEADER_SIZE + length)
+        pngio.save_image(result, output_path, workers=1)
+    return output_path
+
+
+def _read_file_shard_header(path):
+    """Process pool job; returns the ShardHeader of a carrier file"""
+    with Image.open(path) as image:
+        header, _ = _split_shard(LSB.iter_message(image, band_rows=1))
+    return header
+
+
+def _extract_file_shard(path, output_path):
+    """Process pool job; writes the data of one shard into its place in the (already sized) output file"""
+    with Image.open(path) as image, open(output_path, "r+b") as sink:
+        header, chunks = _split_shard(LSB.iter_message(image))
+        sink.seek(header.offset)
+        for chunk in chunks:
+            sink.write(chunk)
+    return header.index
+
+
+def hide_sharded_files(carrier_paths, message_path, output_paths, workers=None):
+    """
+    hide_sharded_files(carrier_paths, message_path, output_paths, workers)
+    Splits the file at 'message_path' across the carrier images and saves each shard to the matching output path.
+    Every shard is encoded in its own process and reads only its slice of the message file.
+
+    :param carrier_paths:   a list of paths to carrier images
+    :param message_path:    path to the message file
+    :param output_paths:    a list of output paths, one per carrier
+    :param workers:         the number of worker processes; defaults to the number of CPUs
+    :return:                list of (offset, length) describing each shard
+    """
+
+    sizes = []
+    for path in carrier_paths:
+        with Image.open(path) as image:     # only the file header is read here
+            sizes.append(image.size)
+    total_length = os.path.getsize(message_path)
+    plan = plan_shards(total_length, sizes)
+    payload_id = os.urandom(16)
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = []
+        for index, (offset, length) in enumerate(plan):
+            header = ShardHeader(index, len(plan), total_length, offset, payload_id)
+            futures.append(executor.submit(_hide_file_shard, carrier_paths[index], message_path,
+                                           output_paths[index], header, length))
+        for future in futures:
+            future.result()
+    return plan
+
+
+def reveal_sharded_files(paths, output_path, workers=None):
+    """
+    reveal_sharded_files(paths, output_path, workers)
+    Reassembles a message split with hide_sharded_files into 'output_path'. The shard headers are checked first;
+    then every shard is decoded in its own process and written straight into its place in the output file.
+
+    :param paths:       a list of paths to the shard images, in any order
+    :param output_path: the file to write the message to
+    :param workers:     the number of worker processes; defaults to the number of CPUs
+    :return:            the length of the message
+    """
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        headers = check_shards(list(executor.map(_read_file_shard_header, paths)))
+        with open(output_path, "wb") as file:
+            file.truncate(headers[0].total_length)
+        list(executor.map(_extract_file_shard, paths, itertools.repeat(output_path)))
+    return headers[0].total_length
@@ -0,0 +1,55 @@
+"""Checks that the chi-square attack in scan.py separates clean carriers from fully embedded ones"""
+
+import math
+import os
+import tempfile
+import unittest
+
+import numpy as np
+from PIL import Image
+
+import jpeg
+import jsteg
+import LSB
+import scan
+
+SAMPLE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sample.png")
+
+
+class ChiSquareTest(unittest.TestCase):
+
+    def setUp(self):
+        with Image.open(SAMPLE) as image:
+            self.clean = image.convert("RGBA")
+
+    def test_statistic(self):
+        # pairs of (60, 40) and (40, 60) give Westfeld's statistic 2 * (60 - 50)^2 / 50 = 4 with one degree of
+        # freedom, for which the probability is erfc(sqrt(2)); the Pearson statistic over both members would be 8
+        self.assertAlmostEqual(scan._pair_probability(np.array([60, 40]), np.array([40, 60])),
+                               math.erfc(math.sqrt(2)), places=9)
+        self.assertEqual(scan._pair_probability(np.array([50, 50, 50]), np.array([50, 50, 50])), 1.0)
+        self.assertIsNone(scan._pair_probability(np.array([60, 5]), np.array([40, 4])))
+
+    def test_pixels(self):
+        embedded = LSB.hide_message(self.clean, os.urandom(LSB.capacity(self.clean)))
+        for channel in range(3):
+            self.assertLess(scan.chi_square(np.asarray(self.clean)[:, :, channel]), 0.01)
+            self.assertGreaterEqual(scan.chi_square(np.asarray(embedded)[:, :, channel]), 0.99)
+
+    def test_coefficients(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "clean.jpg")
+            self.clean.convert("RGB").save(path, quality=90)
+            embedded_path = os.path.join(directory, "embedded.jpg")
+            with open(embedded_path, "wb") as file:
+                file.write(bytes(jsteg.hide_message(path, os.urandom(jsteg.capacity(path)))))
+            scores = []
+            for candidate in (path, embedded_path):
+                with jpeg.JPEG(candidate) as image:
+                    scores.append(scan.chi_square_coefficients(image.decode_coefficients(blocks=False).ac_values))
+        self.assertLess(scores[0], 0.01)
+        self.assertGreaterEqual(scores[1], 0.99)
+
+
+if __name__ == "__main__":
+    unittest.main()